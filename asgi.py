@@ -0,0 +1,532 @@
+"""Asyncio serving mode for the device-facing routes.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+The routes the desktop clients poll (`/`, `/demo`, `/popup_logs_check`, the
+answer and log recording routes and customer registration) are served by
+coroutines on an asyncpg pool, so one process holds thousands of in-flight
+requests, queued on ASYNC_DB_POOL_MAX connections rather than on worker
+threads. Responses have the same shapes as the Flask routes in main.py.
+Every other path is handed to the Flask app through asgiref's WSGI adapter.
+
+`/events` streams prompt and configuration changes from main's push hub;
+an open stream costs a queue here instead of a worker thread.
+
+The in-memory state of main.py is shared: device cache, question catalog,
+configuration snapshot, acknowledgements, the write-behind log queues, the
+push hub and the server error log sink. Their background work keeps using main's
+psycopg2 pool. benchmark_serving.sh compares both modes at equal CPU.
+"""
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import time
+import urllib.parse
+
+import asyncpg
+from asgiref.wsgi import WsgiToAsgi
+
+import main
+from main import (DB_CONNECT_ARGS, DB_PREPARED_STATEMENTS, PUSH_KEEPALIVE, PUSH_LONG_POLL_TIMEOUT, PUSH_QUEUE_SIZE,
+                  RELOAD_CHANNEL, DuplicateIngest, ack_tracker, config_snapshot, demo_logs_queue, device_cache,
+                  enqueue_log, ingest_key_check, ingest_keys, log_payload, logger, logs_queue, normalize_text,
+                  popup_schedule, push_hub, question_catalog, replayed, request_latency, server_logs, statements,
+                  timed_query)
+
+ASYNC_DB_POOL_MIN = int(os.getenv('ASYNC_DB_POOL_MIN', '2'))
+ASYNC_DB_POOL_MAX = int(os.getenv('ASYNC_DB_POOL_MAX', '50'))
+ASYNC_DB_POOL_TIMEOUT = float(os.getenv('ASYNC_DB_POOL_TIMEOUT', '10'))
+
+# asyncpg runs each query as a prepared statement and caches it per connection,
+# behind PgBouncer transaction pooling that cache has to be off
+STATEMENT_CACHE_SIZE = 100 if DB_PREPARED_STATEMENTS else 0
+
+INTEGER_TYPES = {'int2', 'int4', 'int8'}
+TEXT_TYPES = {'text', 'varchar', 'bpchar'}
+
+class Database:
+    """asyncpg pool running main.py's registered statements.
+
+    psycopg2 sends parameters as untyped literals, asyncpg encodes them by the
+    statement's parameter types and rejects e.g. a string for an integer
+    column. The types are looked up once per statement and values coerced
+    the way Postgres would have converted the literal.
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.parameter_types = {}
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def open(self):
+        args = dict(DB_CONNECT_ARGS)
+        self.pool = await asyncpg.create_pool(
+            user=args['user'], password=args['password'], host=args['host'], port=int(args['port']),
+            database=args['database'], ssl=args['sslmode'],
+            min_size=ASYNC_DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX,
+            statement_cache_size=STATEMENT_CACHE_SIZE)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        # counters need no lock, everything runs on the event loop
+        started = time.monotonic()
+        try:
+            conn = await self.pool.acquire(timeout=ASYNC_DB_POOL_TIMEOUT)
+        except Exception:
+            self.checkout_failures += 1
+            raise
+        waited = time.monotonic() - started
+        self.checkouts += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    async def _arguments(self, conn, name, args):
+        types = self.parameter_types.get(name)
+        if types is None:
+            prepared = await conn.prepare(statements.positional[name])
+            types = self.parameter_types[name] = [parameter.name for parameter in prepared.get_parameters()]
+        return [coerce(value, type_name) for value, type_name in zip(args, types)]
+
+    async def fetch(self, conn, name, *args):
+        return await conn.fetch(statements.positional[name], *await self._arguments(conn, name, args))
+
+    async def fetchrow(self, conn, name, *args):
+        return await conn.fetchrow(statements.positional[name], *await self._arguments(conn, name, args))
+
+    async def execute(self, conn, name, *args):
+        return await conn.execute(statements.positional[name], *await self._arguments(conn, name, args))
+
+    def stats(self):
+        """Same keys as main's ConnectionPool.stats()."""
+        size = self.pool.get_size() if self.pool is not None else 0
+        idle = self.pool.get_idle_size() if self.pool is not None else 0
+        return {
+            'size': size,
+            'in_use': size - idle,
+            'idle': idle,
+            'max': ASYNC_DB_POOL_MAX,
+            'checkouts': self.checkouts,
+            'checkout_failures': self.checkout_failures,
+            'wait_seconds_total': round(self.wait_seconds, 6),
+            'max_wait_seconds': round(self.max_wait_seconds, 6),
+        }
+
+
+def coerce(value, type_name):
+    if value is None:
+        return None
+    if type_name in INTEGER_TYPES and isinstance(value, str):
+        return int(value)
+    if type_name in TEXT_TYPES and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+database = Database()
+
+async def ensure_fresh(snapshot):
+    # never blocks, a due reload runs on the snapshot's own refresh thread
+    snapshot.ensure_fresh()
+
+async def lookup_device(conn, table, device_id):
+    """Async counterpart of main.lookup_device, shares its cache."""
+    device, found = device_cache.get((table, device_id))
+    if found:
+        return device
+
+    generation = device_cache.generation()
+    with timed_query('device_lookup'):
+        row = await database.fetchrow(conn, main.SELECT_DEVICE_STATEMENTS[table], device_id)
+    device = dict(row) if row is not None else None
+    device_cache.put((table, device_id), device, generation)
+    return device
+
+async def acknowledged(conn, device_id):
+    """Async counterpart of AckTracker.acknowledged."""
+    today = datetime.date.today()
+    if ack_tracker.contains(device_id, today):
+        return True
+    with timed_query('popup_check'):
+        row = await database.fetchrow(conn, main.SELECT_ACK_STATEMENT, device_id, today)
+    if row is None:
+        return False
+    ack_tracker.record([device_id], today)
+    return True
+
+
+# ---- routes -----
+
+async def index(request):
+    device_id = request.args.get('device_id')
+    try:
+      async with database.acquire() as conn:
+        device = await lookup_device(conn, 'Devices', device_id)
+      if device is None:
+        return { 'prompt_type': 'customer_register' }
+      await ensure_fresh(question_catalog)
+      r = question_catalog.question(device['company'], device['department'], device['prompt_group'])
+      return dict(r) if r is not None else {}
+    except Exception as e:
+      logger.error('quiz popup request error: %s', e)
+      server_logs(device_id,'Quiz popup request',str(e) )
+    return {}
+
+class NoQuestion(Exception):
+    """Rolls back a demo claim that found no question at its occurrence."""
+
+
+async def demo(request):
+    device_id = request.args.get('device_id')
+    try:
+      await ensure_fresh(question_catalog)
+      async with database.acquire() as conn:
+        try:
+          async with conn.transaction():
+            with timed_query('demo_prompt'):
+              device = await database.fetchrow(conn, main.CLAIM_DEMO_PROMPT_STATEMENT, device_id)
+            if device is None:
+              return { 'prompt_type': 'customer_register' }
+
+            r = question_catalog.demo_question(device['company'], device['department'], device['occurrence'], device['prompt_group'])
+            if r is None:
+              # no question at this occurrence, call_count stays where it was
+              if not device['prompt_group_defaulted']:
+                raise NoQuestion()
+              await database.execute(conn, main.RELEASE_DEMO_PROMPT_STATEMENT, device_id)
+        except NoQuestion:
+          return {}
+      if device['prompt_group_defaulted']:
+        logger.info('setting prompt_group to %s for device_id %s', device['prompt_group'], device_id)
+        device_cache.invalidate(('DemoDevices', device_id))
+      return dict(r) if r is not None else {}
+    except Exception as e:
+      logger.error('demo quiz popup request error: %s', e)
+      server_logs(device_id,'Demo Quiz popup request',str(e) )
+    return {}
+
+async def popup_logs_check(request):
+    device_id = request.args.get('device_id')
+    response = {
+        "show_app_window_once_more": False,
+        "prompt_group_is_number": False,
+    }
+    config_json = None
+    try:
+      await ensure_fresh(config_snapshot)
+      async with database.acquire() as conn:
+        if not await acknowledged(conn, normalize_text(device_id)):
+          response["show_app_window_once_more"] = True
+
+        config_version, config_json = config_snapshot.current()
+        response["app_configuration_version"] = config_version
+        include_config = request.args.get('config_version') != config_version
+
+        device_data = await lookup_device(conn, 'Devices', device_id)
+      if device_data is not None and device_data['prompt_group'] is not None:
+        try:
+          int(device_data['prompt_group'])
+          response["prompt_group_is_number"] = True
+        except ValueError:
+          pass
+      # acknowledgements only come from flushed popup logs, as in the Flask route
+      popup_schedule.annotate(response, device_data, not response["show_app_window_once_more"])
+    except Exception as e:
+      logger.error('popup Logs check error: %s', e)
+      server_logs(device_id,'Popup alternative time to display checking',str(e) )
+
+    if config_json is None:
+      return response
+    config_snapshot.count(not include_config, len(config_json))
+    body = main.app.json.dumps(response)
+    if include_config:
+      body = body[:-1] + ', "app_configuration": ' + config_json + '}'
+    return RawResponse(body + '\n', headers={'X-App-Configuration-Version': config_version})
+
+async def claim_ingest_key(conn, scope, key):
+    """ingest_keys.claim() on an asyncpg connection, inside the caller's transaction."""
+    if await database.fetchrow(conn, main.CLAIM_INGEST_KEY_STATEMENT, scope, key) is not None:
+        return
+    row = await database.fetchrow(conn, main.SELECT_INGEST_KEY_STATEMENT, scope, key)
+    response = ingest_keys.parse_response(row[0] if row is not None else None)
+    ingest_keys.remember(scope, key, response)
+    raise DuplicateIngest(response)
+
+def record_data_route(table, source_details, batch_source_details, label):
+    async def record_data(request):
+        payload = request.json
+        key, response = ingest_key_check(request.headers, table, payload)
+        if response is not None:
+            return response
+        if isinstance(payload, list):
+            # batches keep using main's multi-row INSERT on the psycopg2 pool
+            try:
+                results = await asyncio.to_thread(main.record_answers, table, payload, batch_source_details, key)
+            except DuplicateIngest as e:
+                return replayed(e.response)
+            return {'results': results}
+        if table == 'Answers':
+          main.answer_rollups.ensure_started()
+        try:
+          log_payload(label, payload)
+          async with database.acquire() as conn, conn.transaction():
+            if key is not None:
+              await claim_ingest_key(conn, table, key)
+            answer_id = (await database.fetchrow(conn, main.INSERT_ANSWER_STATEMENTS[table],
+                                                 payload['device_id'], payload['question_id'], payload['answer']))[0]
+          if key is not None:
+            ingest_keys.remember(table, key)
+          logger.debug('answer inserted with id %s', answer_id)
+        except DuplicateIngest as e:
+          return replayed(e.response)
+        except Exception as e:
+          logger.error('answer recording error: %s', e)
+          server_logs(payload['device_id'], source_details, str(e))
+        return {}
+    return record_data
+
+def logs_record_data_route(queue, source_details):
+    async def logs_record_data(request):
+        return enqueue_log(queue, request.json, source_details, request.headers)
+    return logs_record_data
+
+def register_customer_route(table, source_details, label):
+    async def register_customer(request):
+        payload = request.json
+        key, response = ingest_key_check(request.headers, table, payload)
+        if response is not None:
+            return response
+        try:
+          log_payload(label, payload)
+          async with database.acquire() as conn, conn.transaction():
+            if key is not None:
+              await claim_ingest_key(conn, table, key)
+            inserted = await database.fetchrow(conn, main.INSERT_DEVICE_STATEMENTS[table], payload['device_id'],
+                                               normalize_text(payload['company']), normalize_text(payload['department']))
+            if table == 'Devices' and inserted is not None:
+              await database.execute(conn, main.NOTIFY_STATEMENT, RELOAD_CHANNEL, 'device:' + payload['device_id'])
+          if key is not None:
+            ingest_keys.remember(table, key)
+        except DuplicateIngest as e:
+          return replayed(e.response)
+        except Exception as e:
+          logger.error('customer registration error: %s', e)
+          server_logs(payload['device_id'], source_details, str(e))
+        finally:
+          device_cache.invalidate((table, payload['device_id']))
+        return {}
+    return register_customer
+
+async def events(request):
+    device_id = request.args.get('device_id')
+    if not device_id:
+      return {'error': 'device_id is required'}, 400
+    long_poll = request.args.get('wait') == '1'
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue(PUSH_QUEUE_SIZE)
+
+    def put(event):
+        try:
+            pending.put_nowait(event)
+        except asyncio.QueueFull:
+            subscription.lagging = True
+
+    def deliver(event, event_id, body):
+        # called from the push hub's thread as well as on the loop
+        loop.call_soon_threadsafe(put, (event, event_id, body))
+        return True
+
+    subscription = push_hub.subscribe(device_id, deliver, main.push_known_versions(request.args) if long_poll else None)
+    try:
+      await ensure_fresh(question_catalog)
+      await ensure_fresh(config_snapshot)
+      async with database.acquire() as conn:
+        device = await lookup_device(conn, 'Devices', device_id)
+      push_hub.initial_events(subscription, device)
+    except Exception as e:
+      push_hub.unsubscribe(subscription)
+      logger.error('push subscribe error: %s', e)
+      server_logs(device_id, 'Push subscription', str(e))
+      return {'error': 'subscription failed'}, 503
+
+    if long_poll:
+      try:
+        event = await asyncio.wait_for(pending.get(), PUSH_LONG_POLL_TIMEOUT)
+      except asyncio.TimeoutError:
+        return RawResponse('', 204)
+      finally:
+        push_hub.unsubscribe(subscription)
+      return RawResponse(main.long_poll_body(*event))
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    event, event_id, body = await asyncio.wait_for(pending.get(), PUSH_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield main.sse_message(event, event_id, body)
+                if subscription.lagging and pending.empty():
+                    return
+        finally:
+            push_hub.unsubscribe(subscription)
+
+    return EventStream(stream())
+
+async def stats(request):
+    # main's pool only serves the background work here
+    return dict(main.service_stats(), async_pool=database.stats())
+
+# (method, path) -> (endpoint name used in metrics, handler)
+ROUTES = {
+    ('GET', '/stats'): ('stats', stats),
+    ('GET', '/'): ('index', index),
+    ('GET', '/demo'): ('demo', demo),
+    ('GET', '/popup_logs_check'): ('popup_logs_check', popup_logs_check),
+    ('GET', '/events'): ('events', events),
+    ('POST', '/record_data'): ('record_data', record_data_route(
+        'Answers', 'Answer recording', 'Answer batch recording', 'answer')),
+    ('POST', '/demo/record_data'): ('demo_record_data', record_data_route(
+        'DemoAnswers', 'Demo Answer recording', 'Demo Answer batch recording', 'demo answer')),
+    ('POST', '/logs/record_data'): ('logs_record_data', logs_record_data_route(logs_queue, 'App logs recording')),
+    ('POST', '/demo/logs/record_data'): ('demo_logs_record_data', logs_record_data_route(
+        demo_logs_queue, 'Demo App logs recording')),
+    ('POST', '/register_customer'): ('register_customer', register_customer_route(
+        'Devices', 'Customer registration', 'register customer')),
+    ('POST', '/demo/register_customer'): ('demo_register_customer', register_customer_route(
+        'DemoDevices', 'Demo Customer register', 'demo register customer')),
+}
+
+
+# ---- ASGI plumbing -----
+
+class Request:
+    def __init__(self, scope, body):
+        self.args = {}
+        # first value wins, as with Flask's request.args.get()
+        for name, value in urllib.parse.parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True):
+            self.args.setdefault(name, value)
+        # title-cased like Flask's, e.g. Idempotency-Key
+        self.headers = {name.decode('latin-1').title(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+
+    @property
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+
+class RawResponse:
+    """A pre-serialized JSON body."""
+
+    def __init__(self, body, status=200, headers=None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+
+
+class EventStream:
+    """A text/event-stream response fed by an async generator."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def send(self, send, receive):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'), (b'access-control-allow-origin', b'*')]})
+
+        async def forward():
+            async for chunk in self.chunks:
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(forward()), asyncio.ensure_future(disconnected())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.chunks.aclose()
+
+
+def render(result):
+    """Turns a handler result into a RawResponse, like Flask does for views."""
+    if isinstance(result, RawResponse):
+        return result
+    status, headers = 200, {}
+    if isinstance(result, tuple):
+        result, status, headers = (result + ({},))[:3]
+    return RawResponse(main.app.json.dumps(result) + '\n', status, headers)
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await database.open()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await database.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+flask_app = WsgiToAsgi(main.app)
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    route = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if route is None:
+        return await flask_app(scope, receive, send)
+
+    endpoint, handler = route
+    started = time.perf_counter()
+    try:
+        request = Request(scope, await read_body(receive))
+        try:
+            response = await handler(request)
+            if isinstance(response, EventStream):
+                # latency of a stream is its lifetime, not worth recording
+                endpoint = None
+                return await response.send(send, receive)
+            response = render(response)
+        except (ValueError, TypeError) as e:
+            # unparsable JSON body, Flask answers these with 400 as well
+            response = render(({'error': str(e)}, 400))
+        headers = [(b'content-type', b'application/json'), (b'access-control-allow-origin', b'*')]
+        headers += [(name.lower().encode(), str(value).encode()) for name, value in response.headers.items()]
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': response.body.encode()})
+    finally:
+        if endpoint is not None:
+            request_latency.observe(endpoint, time.perf_counter() - started)
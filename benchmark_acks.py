@@ -0,0 +1,165 @@
+"""Popup acknowledgement check: scanning "Logs" vs the "LogAcknowledgements" lookup.
+
+Builds a scratch copy of "Logs" in its own schema, with the (device_id,
+created_at) index create_service_tables.sh adds, and fills it with synthetic
+popup logs spread over the last --days days. At each checkpoint the rollup is
+backfilled the way AckTracker.rebuild() does it and three checks are timed
+for --samples devices, half of which acknowledged a popup today:
+
+  logs scan     the query /popup_logs_check ran before the rollup,
+                created_at::date = %s AND recived_status = 'true' on "Logs"
+  ack lookup    AckTracker.acknowledged() with an empty in-memory set, the
+                primary-key lookup on "LogAcknowledgements" every worker does
+                for a device it has not seen acknowledge yet
+  ack tracker   AckTracker.acknowledged() once the device is in memory, for
+                the devices that acknowledged
+
+Each check reports p50 and p99. The scratch schema is dropped afterwards.
+
+  python benchmark_acks.py --rows 5000000 --checkpoints 1000000,2000000,5000000
+
+Connects with the DB_* variables of the service (.env is read) and imports
+main.py for AckTracker.
+"""
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+
+import psycopg2
+
+import main as service
+from schema import DB_CONNECT_ARGS
+
+SCHEMA = 'benchmark_acks'
+
+OLD_CHECK_SQL = f"""
+SELECT * FROM {SCHEMA}."Logs" WHERE "device_id"=%s AND created_at::date = %s AND recived_status = %s;
+"""
+
+
+def create_tables(cursor):
+    cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};')
+    cursor.execute(f"""
+        CREATE TABLE {SCHEMA}."Logs" (
+            id SERIAL PRIMARY KEY,
+            device_id TEXT,
+            company TEXT,
+            department TEXT,
+            prompt_group TEXT,
+            prompt_id TEXT,
+            answer TEXT,
+            recived_status TEXT,
+            error_log TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX ON {SCHEMA}."Logs" (device_id, created_at);
+        CREATE TABLE {SCHEMA}."LogAcknowledgements" (
+            device_id TEXT NOT NULL,
+            ack_date DATE NOT NULL,
+            PRIMARY KEY (device_id, ack_date)
+        );
+    """)
+
+def add_rows(cursor, first, count, days, devices):
+    """Adds rows `first` to `first + count`, spread over the last `days` days up to now.
+
+    Even devices post today, odd devices only on earlier days, so half of the
+    sampled devices acknowledged today.
+    """
+    cursor.execute(f"""
+        INSERT INTO {SCHEMA}."Logs" (device_id, company, department, prompt_group, prompt_id, answer,
+                                     recived_status, error_log, created_at)
+        SELECT 'device-' || device, 'Company', 'Department', '1', (n %% 10)::text, 'happy',
+               CASE WHEN n %% 4 = 0 THEN 'false' ELSE 'true' END, 'n/a',
+               now()::timestamp - CASE WHEN device %% 2 = 0
+                   THEN interval '1 second' * (n %% 3600)
+                   ELSE interval '1 day' * (1 + (n %% %(days)s)) END
+        FROM generate_series(%(first)s, %(last)s) AS n, LATERAL (SELECT n %% %(devices)s AS device) AS d;
+    """, {'first': first, 'last': first + count - 1, 'days': max(1, days - 1), 'devices': devices})
+
+def backfill(cursor):
+    today = datetime.date.today()
+    cursor.execute(service.BACKFILL_ACKS_SQL.replace('"Logs"', f'{SCHEMA}."Logs"').replace(
+        '"LogAcknowledgements"', f'{SCHEMA}."LogAcknowledgements"'), (today, today, today + datetime.timedelta(days=1)))
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return (timings[len(timings) // 2] * 1000,
+            timings[min(len(timings) - 1, int(0.99 * len(timings)))] * 1000)
+
+def time_checks(cursor, devices, samples):
+    today = datetime.date.today()
+    sampled = ['device-' + str(device) for device in random.Random(7).sample(range(devices), min(samples, devices))]
+    timings = {'logs scan': [], 'ack lookup': [], 'ack tracker': []}
+    for device_id in sampled:
+        started = time.perf_counter()
+        cursor.execute(OLD_CHECK_SQL, (device_id, today.isoformat(), 'true'))
+        old = cursor.fetchone() is not None
+        timings['logs scan'].append(time.perf_counter() - started)
+
+        tracker = service.AckTracker()
+        started = time.perf_counter()
+        new = tracker.acknowledged(cursor, device_id)
+        timings['ack lookup'].append(time.perf_counter() - started)
+        if old != new:
+            raise SystemExit(f'{device_id}: logs scan says {old}, ack lookup says {new}')
+
+        # a device that has not acknowledged is looked up again on every check
+        if new:
+            started = time.perf_counter()
+            tracker.acknowledged(cursor, device_id)
+            timings['ack tracker'].append(time.perf_counter() - started)
+    return {name: percentiles(values) for name, values in timings.items()}
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=5000000, help='"Logs" rows to build up')
+    parser.add_argument('--days', type=int, default=90, help='days of history the rows are spread over')
+    parser.add_argument('--devices', type=int, default=20000)
+    parser.add_argument('--checkpoints', default='1000000,2000000,5000000', help='"Logs" sizes to measure at')
+    parser.add_argument('--samples', type=int, default=500, help='devices checked at each checkpoint')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    checkpoints = sorted(int(value) for value in options.checkpoints.split(',') if int(value) <= options.rows)
+    conn = psycopg2.connect(**DB_CONNECT_ARGS)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    create_tables(cursor)
+    # the prepared lookup resolves "LogAcknowledgements" to the scratch copy
+    cursor.execute(f'SET search_path TO {SCHEMA}, public;')
+
+    results = []
+    print(f"{'rows':>10} {'check':<12} {'p50 ms':>9} {'p99 ms':>9}")
+    try:
+        rows = 0
+        for checkpoint in checkpoints:
+            add_rows(cursor, rows + 1, checkpoint - rows, options.days, options.devices)
+            rows = checkpoint
+            cursor.execute(f'VACUUM ANALYZE {SCHEMA}."Logs";')
+            started = time.perf_counter()
+            backfill(cursor)
+            backfill_ms = (time.perf_counter() - started) * 1000
+            cursor.execute(f'VACUUM ANALYZE {SCHEMA}."LogAcknowledgements";')
+            for name, (p50, p99) in time_checks(cursor, options.devices, options.samples).items():
+                results.append({'rows': rows, 'check': name, 'p50_ms': round(p50, 3), 'p99_ms': round(p99, 3)})
+                print(f'{rows:>10} {name:<12} {p50:>9.3f} {p99:>9.3f}')
+            results.append({'rows': rows, 'check': 'backfill', 'ms': round(backfill_ms, 3)})
+            print(f"{rows:>10} {'backfill':<12} {backfill_ms:>9.1f} {'(once)':>9}")
+    finally:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;')
+        conn.close()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""Answers per second through /record_data, one per request vs batched.
+
+Posts --answers answers to a running server from --clients threads, each
+on its own keep-alive connection, first one answer per request (the
+single-row path), then --batch-size answers per request (the multi-row
+INSERT path), and reports rows per second and per-request latency for
+both. Every answer in a batch response must come back with an id.
+
+  python benchmark_answers.py --target http://localhost:5000 --device-id bench-device
+  python benchmark_answers.py --target http://localhost:5000 --device-id bench-device \\
+      --answers 20000 --batch-size 200 --clients 16
+
+The answers are real rows in "Answers" (and "AnswerRollups"), so point it
+at a disposable database.
+"""
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+import urllib.parse
+
+
+class Benchmark:
+    def __init__(self, options):
+        self.options = options
+        self.parsed = urllib.parse.urlsplit(options.target)
+        self.path = self.parsed.path.rstrip('/') + '/record_data'
+        self._lock = threading.Lock()
+
+    def connect(self):
+        connection_class = http.client.HTTPSConnection if self.parsed.scheme == 'https' else http.client.HTTPConnection
+        return connection_class(self.parsed.netloc, timeout=60)
+
+    def answer(self, number):
+        return {
+            'device_id': self.options.device_id,
+            'question_id': self.options.question_id,
+            'answer': f'benchmark {number}',
+        }
+
+    def client(self, bodies, latencies, failures):
+        connection = self.connect()
+        for body in bodies:
+            started = time.perf_counter()
+            try:
+                connection.request('POST', self.path, json.dumps(body), {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                result = json.loads(response.read() or b'{}')
+                ok = response.status == 200 and (
+                    not isinstance(body, list) or all('id' in item for item in result.get('results', [])))
+            except (http.client.HTTPException, OSError, ValueError):
+                connection.close()
+                connection = self.connect()
+                ok = False
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                latencies.append(elapsed)
+                if not ok:
+                    failures.append(body)
+        connection.close()
+
+    def run_mode(self, batch_size):
+        """Posts every answer in requests of `batch_size`, 1 meaning the single-answer body."""
+        answers = [self.answer(number) for number in range(self.options.answers)]
+        if batch_size == 1:
+            bodies = answers
+        else:
+            bodies = [answers[start:start + batch_size] for start in range(0, len(answers), batch_size)]
+        clients = self.options.clients
+        latencies = []
+        failures = []
+        threads = [threading.Thread(target=self.client, args=(bodies[index::clients], latencies, failures))
+                   for index in range(clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return {
+            'batch_size': batch_size,
+            'requests': len(bodies),
+            'failed_requests': len(failures),
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(len(answers) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        }
+
+    def run(self):
+        return [self.run_mode(1), self.run_mode(self.options.batch_size)]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', required=True, help='URL of a running server')
+    parser.add_argument('--device-id', required=True, help='device the answers are recorded for')
+    parser.add_argument('--question-id', type=int, default=1)
+    parser.add_argument('--answers', type=int, default=5000, help='answers posted in each mode')
+    parser.add_argument('--batch-size', type=int, default=100, help='answers per request in batched mode')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent connections')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = Benchmark(options).run()
+    print(f"{'mode':<10} {'requests':>9} {'failed':>7} {'seconds':>8} {'rows/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for result in results:
+        mode = 'single' if result['batch_size'] == 1 else f"batch {result['batch_size']}"
+        print(f"{mode:<10} {result['requests']:>9} {result['failed_requests']:>7} {result['seconds']:>8} "
+              f"{result['rows_per_second']:>10} {result['p50_ms']:>8} {result['p99_ms']:>8}")
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'modes': results}, f, indent=2)
+    return 1 if any(result['failed_requests'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
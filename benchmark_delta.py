@@ -0,0 +1,113 @@
+"""Bytes transferred by delta updates between consecutive versions.
+
+For each consecutive pair in --versions, downloads the older file (the copy
+an installed client already has), then builds the newer one the way a
+client would: the delta manifest from /my-app-updates/delta/..., the fetched
+runs from its /data route, and copies from the old file. Each rebuilt file
+is checked against the manifest's sha256, and the bytes a delta update
+transfers are compared with a full download.
+
+  python benchmark_delta.py --target http://localhost:5000 --platform win32 \\
+      --versions 1.2.3,1.2.4,1.2.5 --filename Croissant-Setup.exe
+
+--filename is the file's name in each version; when a version has no file of
+that name, the server uses its installer with the same extension.
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import sys
+import time
+import urllib.parse
+
+
+class Client:
+    """GETs over one keep-alive connection, counting the body bytes received."""
+
+    def __init__(self, url):
+        self.parsed = urllib.parse.urlsplit(url)
+        self.prefix = self.parsed.path.rstrip('/')
+        connection_class = http.client.HTTPSConnection if self.parsed.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(self.parsed.netloc, timeout=120)
+        self.received = 0
+
+    def get(self, path):
+        self.connection.request('GET', path if path.startswith(self.prefix + '/') else self.prefix + path)
+        response = self.connection.getresponse()
+        body = response.read()
+        self.received += len(body)
+        if response.status != 200:
+            raise SystemExit(f'GET {path} answered {response.status}: {body[:200]!r}')
+        return body
+
+
+def delta_update(client, platform, from_version, version, filename, old):
+    """Rebuilds `filename` of `version` from `old`, returns (file, manifest, bytes received)."""
+    received = client.received
+    query = urllib.parse.urlencode({'from': from_version})
+    manifest = json.loads(client.get(f'/my-app-updates/delta/{platform}/{version}/{filename}?{query}'))
+    data = client.get(manifest['data_url']) if manifest['fetch_bytes'] else b''
+
+    parts = []
+    position = 0
+    for kind, offset, length in manifest['operations']:
+        if kind == 'copy':
+            parts.append(old[offset:offset + length])
+        else:
+            parts.append(data[position:position + length])
+            position += length
+    new = b''.join(parts)
+    if hashlib.sha256(new).hexdigest() != manifest['to']['sha256']:
+        raise SystemExit(f'{version}: rebuilt file does not match the manifest sha256')
+    return new, manifest, client.received - received
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', required=True, help='URL of a running server')
+    parser.add_argument('--platform', required=True)
+    parser.add_argument('--versions', required=True, help='comma-separated, oldest first')
+    parser.add_argument('--filename', required=True, help='file name in each version')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    versions = options.versions.split(',')
+    client = Client(options.target)
+
+    # the client's starting point: the file the first manifest builds from
+    first = json.loads(client.get(f'/my-app-updates/delta/{options.platform}/{versions[1]}/{options.filename}'
+                                  f'?from={versions[0]}'))
+    old = client.get(f'/my-app-updates/{first["from"]["path"]}')
+
+    results = []
+    print(f"{'update':<24} {'full bytes':>12} {'delta bytes':>12} {'saved':>8} {'seconds':>8}")
+    for from_version, version in zip(versions, versions[1:]):
+        started = time.perf_counter()
+        old, manifest, received = delta_update(client, options.platform, from_version, version, options.filename, old)
+        elapsed = time.perf_counter() - started
+        full = manifest['to']['size']
+        results.append({
+            'from': from_version,
+            'to': version,
+            'full_bytes': full,
+            'delta_bytes': received,
+            'fetch_bytes': manifest['fetch_bytes'],
+            'copy_bytes': manifest['copy_bytes'],
+            'seconds': round(elapsed, 3),
+        })
+        saved = 1 - received / full if full else 0
+        print(f"{from_version + ' -> ' + version:<24} {full:>12} {received:>12} {saved:>8.1%} {elapsed:>8.3f}")
+
+    total_full = sum(result['full_bytes'] for result in results)
+    total_delta = sum(result['delta_bytes'] for result in results)
+    print(f"{'total':<24} {total_full:>12} {total_delta:>12} {1 - total_delta / total_full if total_full else 0:>8.1%}")
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'updates': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Connection checkout and request latency with and without the pool and device cache.
+
+Imports main.py against the database in .env and times, in process:
+
+  checkout      psycopg2.connect() plus preparing the registered statements,
+                what every request paid before the pool, against a
+                pool.getconn()/putconn() round trip
+  poll cycle    GET / and GET /popup_logs_check for --device-id through the
+                Flask test client in three configurations:
+                  no pool       every checkout opens a new connection
+                  no cache      pooled, every device lookup hits "Devices"
+                  pool + cache  pooled, device rows served from DeviceCache
+
+Each configuration reports p50/p99 latency per route and the "Devices"
+queries per poll cycle.
+
+  python benchmark_devices.py --device-id 0ab3d6de...
+  python benchmark_devices.py --device-id 0ab3d6de... --cycles 2000 --output devices.json
+
+The device must be registered in "Devices"; the routes only read it.
+"""
+import argparse
+import json
+import sys
+import time
+
+import psycopg2
+import psycopg2.extras
+
+import main as service
+
+ROUTES = ('/', '/popup_logs_check')
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summary(timings):
+    timings = sorted(timings)
+    return {'p50_ms': round(percentile(timings, 0.50) * 1000, 3), 'p99_ms': round(percentile(timings, 0.99) * 1000, 3)}
+
+def time_checkouts(count):
+    connects = []
+    for _ in range(count):
+        started = time.perf_counter()
+        conn = psycopg2.connect(**service.DB_CONNECT_ARGS)
+        service.statements.prepare(conn)
+        connects.append(time.perf_counter() - started)
+        conn.close()
+    checkouts = []
+    for _ in range(count):
+        started = time.perf_counter()
+        conn = service.pool.getconn()
+        service.pool.putconn(conn)
+        checkouts.append(time.perf_counter() - started)
+    return {'connect': summary(connects), 'pool': summary(checkouts)}
+
+def device_lookups():
+    return service.query_latency.get('device_lookup').count
+
+def time_cycles(client, device_id, cycles, pooled, cached):
+    pool_max_uses, cache_max_size = service.pool.max_uses, service.device_cache.max_size
+    # a connection used once is discarded, a cache of size 0 evicts every row it is given
+    service.pool.max_uses = pool_max_uses if pooled else 1
+    service.device_cache.max_size = cache_max_size if cached else 0
+    if not cached:
+        service.device_cache.invalidate(('Devices', device_id))
+    timings = {route: [] for route in ROUTES}
+    lookups = device_lookups()
+    try:
+        for _ in range(cycles):
+            for route in ROUTES:
+                started = time.perf_counter()
+                response = client.get(route, query_string={'device_id': device_id})
+                timings[route].append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise SystemExit(f'{route} answered {response.status_code}')
+    finally:
+        service.pool.max_uses, service.device_cache.max_size = pool_max_uses, cache_max_size
+    result = {route: summary(values) for route, values in timings.items()}
+    result['device_queries_per_cycle'] = round((device_lookups() - lookups) / cycles, 3)
+    return result
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--device-id', required=True, help='a device registered in "Devices"')
+    parser.add_argument('--cycles', type=int, default=500, help='poll cycles per configuration')
+    parser.add_argument('--checkouts', type=int, default=200, help='connections opened and checked out')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    client = service.app.test_client()
+    with service.pool.connection() as conn:
+        device = service.lookup_device(conn.cursor(cursor_factory=psycopg2.extras.DictCursor), 'Devices',
+                                       options.device_id)
+    if device is None:
+        print(f'Error: {options.device_id} is not registered in "Devices"')
+        return 1
+
+    checkout = time_checkouts(options.checkouts)
+    print(f"{'checkout':<14} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, result in checkout.items():
+        print(f"{name:<14} {result['p50_ms']:>8} {result['p99_ms']:>8}")
+    print('')
+
+    configurations = {'no pool': (False, False), 'no cache': (True, False), 'pool + cache': (True, True)}
+    cycles = {}
+    # one warm-up cycle so the pool and the cache start out the same for every configuration
+    time_cycles(client, options.device_id, 1, True, True)
+    for name, (pooled, cached) in configurations.items():
+        cycles[name] = time_cycles(client, options.device_id, options.cycles, pooled, cached)
+    print(f"{'configuration':<14} {'route':<18} {'p50 ms':>8} {'p99 ms':>8} {'device queries/cycle':>21}")
+    for name, result in cycles.items():
+        for route in ROUTES:
+            print(f"{name:<14} {route:<18} {result[route]['p50_ms']:>8} {result[route]['p99_ms']:>8} "
+                  f"{result['device_queries_per_cycle']:>21}")
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'checkout': checkout, 'cycles': cycles}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Concurrent download benchmark for the update file route.
+
+Simulates a fleet fetching a new release at the same moment: --clients
+threads each download the file at --path from a running server, every
+client on its own connection. With --resume a client stops after a random
+part of the body, reconnects and fetches the rest with Range/If-Range, the
+way an interrupted updater resumes. Every body is checked against the
+sha256 ETag and the run reports throughput, per-download latency and the
+status codes seen, then revalidates once with If-None-Match.
+
+  python benchmark_downloads.py --target http://localhost:5000 --path win32/1.2.3/Croissant-Setup.exe
+  python benchmark_downloads.py --target http://localhost:5000 --path win32/1.2.3/Croissant-Setup.exe \\
+      --clients 200 --downloads 2 --resume
+
+Compare gunicorn (sendfile for complete bodies) with and without
+UPDATES_SENDFILE_HEADER behind nginx to see what the front server takes off
+the workers.
+"""
+import argparse
+import collections
+import hashlib
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+READ_SIZE = 256 * 1024
+
+
+def connect(parsed):
+    connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+    return connection_class(parsed.netloc, timeout=60)
+
+def fetch(parsed, path, headers, limit=None):
+    """GETs `path`, reading at most `limit` body bytes; returns (status, headers, body)."""
+    connection = connect(parsed)
+    try:
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        chunks = []
+        received = 0
+        while limit is None or received < limit:
+            chunk = response.read(READ_SIZE if limit is None else min(READ_SIZE, limit - received))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            received += len(chunk)
+        return response.status, dict(response.getheaders()), b''.join(chunks)
+    finally:
+        # dropping the connection mid-body is the interruption being simulated
+        connection.close()
+
+
+class Benchmark:
+    def __init__(self, options):
+        self.options = options
+        self.parsed = urllib.parse.urlsplit(options.target)
+        self.path = self.parsed.path.rstrip('/') + '/my-app-updates/' + options.path.lstrip('/')
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.bytes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def download(self, rng):
+        started = time.perf_counter()
+        status, headers, body = fetch(self.parsed, self.path, {},
+                                      rng.randint(1, self.size - 1) if self.options.resume else None)
+        statuses = [status]
+        received = len(body)
+        if self.options.resume and status == 200:
+            status, headers, rest = fetch(self.parsed, self.path,
+                                          {'Range': f'bytes={len(body)}-', 'If-Range': self.etag})
+            statuses.append(status)
+            received += len(rest)
+            body = body + rest if status == 206 else rest
+        elapsed = time.perf_counter() - started
+        ok = hashlib.sha256(body).hexdigest() == self.etag.strip('"')
+        with self._lock:
+            self.latencies.append(elapsed)
+            self.statuses.update(statuses)
+            self.bytes += received
+            if not ok:
+                self.failures += 1
+
+    def client(self, index):
+        rng = random.Random(self.options.seed + index)
+        for _ in range(self.options.downloads):
+            try:
+                self.download(rng)
+            except (http.client.HTTPException, OSError) as e:
+                with self._lock:
+                    self.failures += 1
+                    self.statuses[type(e).__name__] += 1
+
+    def run(self):
+        status, headers, body = fetch(self.parsed, self.path, {})
+        if status != 200:
+            raise SystemExit(f'GET {self.path} answered {status}')
+        self.size = len(body)
+        self.etag = headers.get('ETag', '')
+
+        threads = [threading.Thread(target=self.client, args=(index,)) for index in range(self.options.clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        revalidation, _, _ = fetch(self.parsed, self.path, {'If-None-Match': self.etag})
+        latencies = sorted(self.latencies)
+        return {
+            'options': vars(self.options),
+            'file_bytes': self.size,
+            'etag': self.etag,
+            'downloads': len(latencies),
+            'failures': self.failures,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items(), key=str)},
+            'seconds': round(elapsed, 3),
+            'mb_per_second': round(self.bytes / elapsed / 1e6, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+            'revalidation_status': revalidation,
+        }
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', required=True, help='URL of a running server')
+    parser.add_argument('--path', required=True, help='file under my-app-updates/, e.g. win32/1.2.3/Setup.exe')
+    parser.add_argument('--clients', type=int, default=50, help='concurrent downloads')
+    parser.add_argument('--downloads', type=int, default=1, help='downloads per client')
+    parser.add_argument('--resume', action='store_true', help='interrupt each download and resume it with Range')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    result = Benchmark(options).run()
+    for key, value in result.items():
+        if key != 'options':
+            print(f'{key:<22} {value}')
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 1 if result['failures'] or result['revalidation_status'] != 304 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
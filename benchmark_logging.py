@@ -0,0 +1,91 @@
+"""Per-call cost of the request logging, against the print() calls it replaced.
+
+Times, with timeit, --calls calls of each of:
+
+  print           print() of a request payload, as the routes did before
+                  the logger, written to /dev/null
+  payload off     log_payload() with LOG_PAYLOADS off (the default)
+  payload on      log_payload() with LOG_PAYLOADS on, a record queued for the
+                  writer thread
+  debug filtered  logger.debug() below LOG_LEVEL
+  info queued     logger.info() with a message argument
+
+and reports the best of --repeat runs in microseconds per call. The writer
+thread writes to /dev/null; records it had to drop because its queue was full
+are counted, they cost a failed put instead of a write.
+
+  python benchmark_logging.py
+  python benchmark_logging.py --calls 500000 --output logging.json
+
+Imports main.py, so the DB_* variables of the service must be set (.env is
+read). /dev/null is the cheapest stream there is; print() to a terminal or a
+pipe costs more.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import timeit
+
+import main as service
+
+PAYLOAD = {'device_id': '0ab3d6de936ff051659306cab99a9536', 'question_id': 3, 'answer': 'happy'}
+
+
+def time_calls(statement, calls, repeat):
+    return min(timeit.repeat(statement, number=calls, repeat=repeat)) / calls * 1e6
+
+@contextlib.contextmanager
+def payload_logging(enabled):
+    previous = service.LOG_PAYLOADS
+    service.LOG_PAYLOADS = enabled
+    try:
+        yield
+    finally:
+        service.LOG_PAYLOADS = previous
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--calls', type=int, default=200000, help='calls per run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case, the best is reported')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    # records below INFO are filtered before they reach the handler
+    service.logger.setLevel(service.logging.INFO)
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        service.log_handler.stream = devnull
+        with contextlib.redirect_stdout(devnull):
+            results['print'] = time_calls(lambda: print(PAYLOAD), options.calls, options.repeat)
+        with payload_logging(False):
+            results['payload off'] = time_calls(
+                lambda: service.log_payload('answer', PAYLOAD), options.calls, options.repeat)
+        dropped = service.log_handler.dropped
+        with payload_logging(True):
+            results['payload on'] = time_calls(
+                lambda: service.log_payload('answer', PAYLOAD), options.calls, options.repeat)
+        results['debug filtered'] = time_calls(
+            lambda: service.logger.debug('answer %s', PAYLOAD), options.calls, options.repeat)
+        results['info queued'] = time_calls(
+            lambda: service.logger.info('answer %s', PAYLOAD), options.calls, options.repeat)
+        service.log_handler.close()
+        dropped = service.log_handler.dropped - dropped
+
+    print(f"{'call':<16} {'us/call':>8}")
+    for name, value in results.items():
+        print(f'{name:<16} {value:>8.3f}')
+    print(f'records dropped by a full queue: {dropped}')
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'us_per_call': {name: round(value, 4) for name, value in results.items()},
+                       'dropped': dropped}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""Query latency on a plain vs a monthly partitioned "Logs" as history grows.
+
+Builds two scratch copies of "Logs" in their own schema, one plain and one
+partitioned the way schema.py does it, with the same indexes. It fills them
+with the same synthetic rows one month of history at a time, and at each
+checkpoint times the queries the service runs on recent rows:
+
+  latest page   first page of the log viewer (ORDER BY created_at DESC, id DESC)
+  day backfill  devices that acknowledged today (the backfill of the acks cache)
+  device week   one device's rows of the last 7 days
+  month count   rows of the current month
+
+Each query reports the median of --repeat runs. At the end, one month of
+retention is applied to each copy: a DELETE on the plain table, and a
+DETACH and DROP of a partition. The scratch schema is dropped afterwards.
+
+  python benchmark_partitions.py --months 24 --rows-per-month 100000 \\
+      --checkpoints 1,6,12,24
+
+Connects with the DB_* variables of the service (.env is read).
+"""
+import argparse
+import datetime
+import json
+import statistics
+import sys
+import time
+
+import psycopg2
+import psycopg2.sql
+
+from schema import DB_CONNECT_ARGS, add_months, month_start, partition_name
+
+SCHEMA = 'benchmark_partitions'
+COLUMNS = """
+    id SERIAL,
+    device_id TEXT,
+    company TEXT,
+    department TEXT,
+    prompt_group TEXT,
+    prompt_id TEXT,
+    answer TEXT,
+    recived_status TEXT,
+    error_log TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+"""
+INDEXES = [('device_id', 'created_at'), ('created_at', 'id')]
+
+# bounds are bound as literals, as the service binds them, so partitions are pruned when planning
+QUERIES = {
+    'latest page': ('SELECT * FROM {table} ORDER BY created_at DESC, id DESC LIMIT 100;', ()),
+    'day backfill': ("""
+        SELECT DISTINCT device_id FROM {table}
+        WHERE created_at >= %(today)s AND created_at < %(tomorrow)s AND recived_status = 'true';
+    """, ('today', 'tomorrow')),
+    'device week': ("SELECT * FROM {table} WHERE device_id = 'device-7' AND created_at >= %(week)s;", ('week',)),
+    'month count': ('SELECT count(*) FROM {table} WHERE created_at >= %(month)s;', ('month',)),
+}
+
+
+def create_tables(cursor):
+    cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};')
+    cursor.execute(f'CREATE TABLE {SCHEMA}.plain ({COLUMNS});')
+    cursor.execute(f'CREATE TABLE {SCHEMA}.partitioned ({COLUMNS}) PARTITION BY RANGE (created_at);')
+    for table in ('plain', 'partitioned'):
+        for columns in INDEXES:
+            cursor.execute(f'CREATE INDEX ON {SCHEMA}.{table} ({", ".join(columns)});')
+
+def add_month(cursor, month, rows, devices):
+    """Adds `rows` rows spread over `month`, up to now for the current month."""
+    cursor.execute(psycopg2.sql.SQL('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);').format(
+        psycopg2.sql.Identifier(SCHEMA, partition_name('partitioned', month)),
+        psycopg2.sql.Identifier(SCHEMA, 'partitioned')), (month, add_months(month, 1)))
+    cursor.execute(f"""
+        INSERT INTO {SCHEMA}.plain (device_id, company, department, prompt_group, prompt_id, answer, recived_status,
+                                    error_log, created_at)
+        SELECT 'device-' || (n %% %(devices)s), 'Company', 'Department', '1', (n %% 10)::text, 'happy',
+               CASE WHEN n %% 4 = 0 THEN 'false' ELSE 'true' END, 'n/a',
+               %(start)s::timestamp + (least(%(end)s::timestamp, now()::timestamp) - %(start)s::timestamp) * (n::float / %(rows)s)
+        FROM generate_series(1, %(rows)s) AS n;
+    """, {'devices': devices, 'rows': rows, 'start': month, 'end': add_months(month, 1)})
+    cursor.execute(f"""
+        INSERT INTO {SCHEMA}.partitioned SELECT * FROM {SCHEMA}.plain
+        WHERE created_at >= %s AND created_at < %s;
+    """, (month, add_months(month, 1)))
+
+def time_query(cursor, sql, params, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+def table_size(cursor, table):
+    cursor.execute(f"""
+        SELECT coalesce(sum(pg_total_relation_size(relid)), pg_total_relation_size('{SCHEMA}.{table}'))
+        FROM pg_partition_tree('{SCHEMA}.{table}');
+    """)
+    return cursor.fetchone()[0]
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--months', type=int, default=24, help='months of history to build up')
+    parser.add_argument('--rows-per-month', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--checkpoints', default='1,6,12,24', help='history sizes in months to measure at')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per query, the median is reported')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    checkpoints = sorted(int(value) for value in options.checkpoints.split(','))
+    conn = psycopg2.connect(**DB_CONNECT_ARGS)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    create_tables(cursor)
+
+    results = []
+    current = month_start(datetime.date.today())
+    print(f"{'months':>6} {'rows':>10} {'query':<14} {'plain ms':>10} {'partitioned ms':>15}")
+    try:
+        # history accumulates backwards from the current month, the rows the queries read stay the same
+        for months in range(1, options.months + 1):
+            add_month(cursor, add_months(current, 1 - months), options.rows_per_month, options.devices)
+            if months not in checkpoints:
+                continue
+            cursor.execute(f'VACUUM ANALYZE {SCHEMA}.plain;')
+            cursor.execute(f'VACUUM ANALYZE {SCHEMA}.partitioned;')
+            now = datetime.datetime.now()
+            today = datetime.datetime.combine(now.date(), datetime.time())
+            bounds = {'today': today, 'tomorrow': today + datetime.timedelta(days=1),
+                      'week': now - datetime.timedelta(days=7), 'month': current}
+            for name, (sql, names) in QUERIES.items():
+                params = {key: bounds[key] for key in names}
+                plain = time_query(cursor, sql.format(table=f'{SCHEMA}.plain'), params, options.repeat)
+                partitioned = time_query(cursor, sql.format(table=f'{SCHEMA}.partitioned'), params, options.repeat)
+                results.append({'months': months, 'rows': months * options.rows_per_month, 'query': name,
+                                'plain_ms': round(plain, 3), 'partitioned_ms': round(partitioned, 3)})
+                print(f'{months:>6} {months * options.rows_per_month:>10} {name:<14} {plain:>10.2f} {partitioned:>15.2f}')
+            print(f"{'':>6} {'':>10} {'size MiB':<14} {table_size(cursor, 'plain') / 2 ** 20:>10.1f} "
+                  f"{table_size(cursor, 'partitioned') / 2 ** 20:>15.1f}")
+
+        oldest = add_months(current, 1 - options.months)
+        started = time.perf_counter()
+        cursor.execute(f'DELETE FROM {SCHEMA}.plain WHERE created_at < %s;', (add_months(oldest, 1),))
+        delete = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        partition = psycopg2.sql.Identifier(SCHEMA, partition_name('partitioned', oldest))
+        cursor.execute(psycopg2.sql.SQL('ALTER TABLE {} DETACH PARTITION {}; DROP TABLE {};').format(
+            psycopg2.sql.Identifier(SCHEMA, 'partitioned'), partition, partition))
+        drop = (time.perf_counter() - started) * 1000
+        print(f'retention of one month: DELETE {delete:.1f} ms, DETACH + DROP {drop:.1f} ms')
+    finally:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;')
+        conn.close()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'queries': results,
+                       'retention_ms': {'delete': round(delete, 3), 'detach_drop': round(drop, 3)}}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
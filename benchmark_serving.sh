@@ -0,0 +1,66 @@
+#!/bin/bash
+# Compares the synchronous Flask app (main.py under gunicorn threads) with the
+# asyncio mode (asgi.py under uvicorn) at equal CPU: each server is pinned to
+# SERVER_CPUS, the load generator to CLIENT_CPUS, and both are driven by
+# load_test.py with the same options against the database in .env.
+#
+#   ./benchmark_serving.sh
+#   SERVER_CPUS=0 CLIENT_CPUS=1-3 LOAD_TEST_ARGS="--devices 20000 --workers 2000 --duration 60" ./benchmark_serving.sh
+#
+# Needs gunicorn and uvicorn (pip install gunicorn uvicorn) and taskset.
+
+set -e
+
+# Load environment variables from .env file if it exists
+if [ -f .env ]; then
+    export $(cat .env | grep -v '^#' | xargs)
+fi
+
+SERVER_CPUS="${SERVER_CPUS:-0}"
+CLIENT_CPUS="${CLIENT_CPUS:-1}"
+SYNC_THREADS="${SYNC_THREADS:-32}"
+PORT="${PORT:-5100}"
+LOAD_TEST_ARGS="${LOAD_TEST_ARGS:---devices 5000 --workers 500 --duration 30}"
+RESULTS_DIR="${RESULTS_DIR:-bench-results}"
+
+mkdir -p "$RESULTS_DIR"
+
+wait_for_server() {
+    for _ in $(seq 1 50); do
+        if curl -s -o /dev/null "http://127.0.0.1:$PORT/stats"; then
+            return 0
+        fi
+        sleep 0.2
+    done
+    echo "Error: server on port $PORT did not start"
+    return 1
+}
+
+run() {
+    local name="$1"
+    shift
+    echo "==> $name"
+    taskset -c "$SERVER_CPUS" "$@" > "$RESULTS_DIR/$name-server.log" 2>&1 &
+    local server_pid=$!
+    if wait_for_server; then
+        taskset -c "$CLIENT_CPUS" python load_test.py --target "http://127.0.0.1:$PORT" $LOAD_TEST_ARGS \
+            --output "$RESULTS_DIR/$name.json" | tee "$RESULTS_DIR/$name.txt"
+    fi
+    kill "$server_pid"
+    wait "$server_pid" 2>/dev/null || true
+    echo ""
+}
+
+run sync gunicorn --workers 1 --threads "$SYNC_THREADS" --bind "127.0.0.1:$PORT" main:app
+run async uvicorn asgi:app --workers 1 --host 127.0.0.1 --port "$PORT" --log-level warning
+
+python - "$RESULTS_DIR" <<'EOF'
+import json, sys
+results = {name: json.load(open(f'{sys.argv[1]}/{name}.json')) for name in ('sync', 'async')}
+print(f"{'':<30} {'sync':>12} {'async':>12}")
+print(f"{'req/s':<30} {results['sync']['rps']:>12} {results['async']['rps']:>12}")
+for route in results['sync']['routes']:
+    for key in ('p50_ms', 'p99_ms'):
+        values = [results[name]['routes'].get(route, {}).get(key, '-') for name in ('sync', 'async')]
+        print(f"{route + ' ' + key[:3]:<30} {values[0]:>12} {values[1]:>12}")
+EOF
@@ -0,0 +1,113 @@
+#!/bin/bash
+# filepath: create_service_tables.sh
+# Helper tables used by the Flask service (main.py), uses environment variables
+
+# Load environment variables from .env file if it exists
+if [ -f .env ]; then
+    export $(cat .env | grep -v '^#' | xargs)
+fi
+
+# Database connection parameters from environment variables
+PGHOST="${DB_HOST:-localhost}"
+PGPORT="${DB_PORT:-5432}"
+PGUSER="${DB_USER:-postgres}"
+PGDATABASE="${DB_NAME:-defaultdb}"
+PGPASSWORD="${DB_PASSWORD}"
+RELOAD_CHANNEL="${RELOAD_CHANNEL:-croissant_reload}"
+
+export PGPASSWORD
+
+# Check if required environment variables are set
+if [ -z "$DB_PASSWORD" ]; then
+    echo "Error: DB_PASSWORD environment variable is not set"
+    echo "Please create a .env file or set the environment variable"
+    exit 1
+fi
+
+psql "host=$PGHOST port=$PGPORT user=$PGUSER dbname=$PGDATABASE sslmode=require" <<EOSQL
+-- One row per device and day on which the device acknowledged a popup,
+-- written alongside "Logs" so /popup_logs_check does not scan "Logs"
+CREATE TABLE IF NOT EXISTS "LogAcknowledgements" (
+    device_id TEXT NOT NULL,
+    ack_date DATE NOT NULL,
+    PRIMARY KEY (device_id, ack_date)
+);
+
+-- Range scans on created_at, used to backfill today's acknowledgements at startup
+CREATE INDEX IF NOT EXISTS "Logs_device_id_created_at_idx" ON "Logs" (device_id, created_at);
+
+-- Keyset pagination of the log viewers on (created_at, id)
+CREATE INDEX IF NOT EXISTS "Logs_created_at_id_idx" ON "Logs" (created_at, id);
+CREATE INDEX IF NOT EXISTS "DemoLogs_created_at_id_idx" ON "DemoLogs" (created_at, id);
+CREATE INDEX IF NOT EXISTS "ServerLogs_created_at_id_idx" ON "ServerLogs" (created_at, id);
+
+-- Answer counts per company, department, question, answer and day, folded in
+-- from "Answers" above the watermark so dashboards do not scan "Answers"
+CREATE TABLE IF NOT EXISTS "AnswerRollups" (
+    company TEXT NOT NULL,
+    department TEXT NOT NULL,
+    question_id TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    answer_date DATE NOT NULL,
+    answers BIGINT NOT NULL,
+    PRIMARY KEY (company, department, question_id, answer, answer_date)
+);
+
+CREATE TABLE IF NOT EXISTS "RollupWatermarks" (
+    name TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL,
+    updated_at TIMESTAMP
+);
+
+-- The rollup refresh leaves the most recent answers for its next run
+CREATE INDEX IF NOT EXISTS "Answers_created_at_id_idx" ON "Answers" (created_at, id);
+
+-- Idempotency keys of ingest requests, claimed in the same transaction as the
+-- write so a retried request is acknowledged without writing again
+CREATE TABLE IF NOT EXISTS "IngestKeys" (
+    scope TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    response JSONB,
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (scope, idempotency_key)
+);
+CREATE INDEX IF NOT EXISTS "IngestKeys_created_at_idx" ON "IngestKeys" (created_at);
+
+-- Registration inserts with ON CONFLICT (device_id) DO NOTHING, which needs a
+-- unique index; this fails while duplicates exist, list them with
+-- SELECT device_id FROM "Devices" GROUP BY device_id HAVING count(*) > 1;
+CREATE UNIQUE INDEX IF NOT EXISTS "Devices_device_id_key" ON "Devices" (device_id);
+CREATE UNIQUE INDEX IF NOT EXISTS "DemoDevices_device_id_key" ON "DemoDevices" (device_id);
+
+-- Edits made outside the service (psql, admin tools) reach the workers' reload
+-- listeners and the devices connected to /events
+CREATE OR REPLACE FUNCTION croissant_notify_device() RETURNS trigger AS \$\$
+BEGIN
+    PERFORM pg_notify('$RELOAD_CHANNEL', 'device:' || NEW.device_id);
+    RETURN NULL;
+END;
+\$\$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION croissant_notify_table() RETURNS trigger AS \$\$
+BEGIN
+    PERFORM pg_notify('$RELOAD_CHANNEL', TG_ARGV[0]);
+    RETURN NULL;
+END;
+\$\$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS "Devices_notify" ON "Devices";
+CREATE TRIGGER "Devices_notify" AFTER INSERT OR UPDATE ON "Devices"
+    FOR EACH ROW EXECUTE FUNCTION croissant_notify_device();
+DROP TRIGGER IF EXISTS "Questions_notify" ON "Questions";
+CREATE TRIGGER "Questions_notify" AFTER INSERT OR UPDATE OR DELETE ON "Questions"
+    FOR EACH STATEMENT EXECUTE FUNCTION croissant_notify_table('questions');
+DROP TRIGGER IF EXISTS "DemoQuestions_notify" ON "DemoQuestions";
+CREATE TRIGGER "DemoQuestions_notify" AFTER INSERT OR UPDATE OR DELETE ON "DemoQuestions"
+    FOR EACH STATEMENT EXECUTE FUNCTION croissant_notify_table('questions');
+DROP TRIGGER IF EXISTS "AppConfiguration_notify" ON "AppConfiguration";
+CREATE TRIGGER "AppConfiguration_notify" AFTER INSERT OR UPDATE OR DELETE ON "AppConfiguration"
+    FOR EACH STATEMENT EXECUTE FUNCTION croissant_notify_table('app_configuration');
+EOSQL
+
+unset PGPASSWORD
+echo "Service tables created (if not already present)."
@@ -0,0 +1,745 @@
+"""Load test for the Flask service in main.py.
+
+Simulates a fleet of desktop clients running the real polling cycle: poll
+`/`, register when the server asks for it, call `/popup_logs_check`, post
+the answer to `/record_data` and the popup log to `/logs/record_data`.
+Every post carries an Idempotency-Key and --retries of them are sent again
+with the same key, as a client does when a response got lost.
+Reports throughput and p50/p95/p99 latency per route, pool saturation and
+database query counts, and compares them against a stored baseline.
+
+Two targets:
+
+  --target inprocess  (default) imports main.py against an in-memory fake
+                      database, for CPU-only profiling of the hot paths.
+                      --db-latency adds a per-statement delay so pool
+                      saturation behaves like a real round trip.
+  --target URL        drives a running server, e.g. one started with
+                      ./start-dev.sh against a disposable Postgres. Pool and
+                      query figures are read from its /stats and /metrics.
+
+Examples:
+
+  python load_test.py --devices 2000 --duration 30
+  python load_test.py --devices 2000 --db-latency 2 --save-baseline
+  python load_test.py --target http://localhost:5000 --poll-interval 60
+
+The run fails (exit status 1) when a route's latency (p50 by default, see
+--percentile), the throughput or the queries per cycle regressed by more
+than --tolerance against --baseline. In process, client and service threads
+share the GIL; with more than one worker the tail percentiles measure GIL
+handoffs rather than the service. Baselines are only comparable between
+runs on the same machine with the same options.
+"""
+import argparse
+import collections
+import hashlib
+import heapq
+import itertools
+import http.client
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+import psycopg2
+import psycopg2.sql
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_test_baseline.json')
+
+# options that change the numbers, a baseline is only compared when they match
+COMPARED_OPTIONS = ('target', 'devices', 'workers', 'db_latency', 'poll_interval',
+                    'unregistered', 'answers_batch', 'retries', 'warmup')
+
+
+# ---- in-process fake database -----
+
+class Row(dict):
+    """Stands in for DictCursor rows, which allow both row['name'] and row[0]."""
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return dict.__getitem__(self, key)
+
+
+# statement kind, e.g. 'SELECT Devices', used to count queries
+STATEMENT_RE = re.compile(r'^\s*(SELECT|INSERT INTO|UPDATE|DELETE FROM|LISTEN|COPY)\b.*?(?:"(\w+)"|$)', re.I | re.S)
+
+class FakeDatabase:
+    """Just enough of the schema behind main.py's hot paths, kept in memory.
+
+    Statements are matched by text, so only the queries the polling cycle
+    issues are answered; anything else returns no rows and is counted as is.
+    There is no lock around statements: a contended lock costs a waiting
+    thread a whole GIL switch interval, which would show up as service
+    latency. Single dict and set operations are atomic under the GIL.
+    """
+
+    def __init__(self, companies, latency):
+        self.latency = latency
+        self.devices = {'Devices': {}, 'DemoDevices': {}}
+        self.acks = set()
+        # (scope, idempotency key) -> saved response
+        self.ingest_keys = {}
+        self.ids = itertools.count(1)
+        # PREPAREd statement bodies by name, shared by every connection
+        self.prepared = {}
+        self._counters = []
+        self._local = threading.local()
+        self.questions = []
+        self.demo_questions = []
+        for company, department in companies:
+            self.questions.append({'id': self._id(), 'PickerDB': company, 'department': department,
+                                   'prompt_group': 1, 'question': f'How was your day at {department}?'})
+            for occurrence in range(5):
+                self.demo_questions.append({'id': self._id(), 'PickerDB': company, 'department': department,
+                                            'demo_occurence_no': occurrence, 'prompt_group': 1,
+                                            'question': f'Demo question {occurrence}'})
+        self.configuration = [{'id': 1, 'popup_allowed_time': '9,10,11,12,13,14,15,16,17'}]
+        # the reload listener select()s on a connection, this never becomes readable
+        self.listen_fd, self._listen_write_fd = os.pipe()
+
+    def _id(self):
+        return next(self.ids)
+
+    def add_device(self, table, device_id, company, department, prompt_group=1):
+        self.devices[table][device_id] = {
+            'id': self._id(), 'device_id': device_id, 'company': company,
+            'department': department, 'prompt_group': prompt_group, 'call_count': 0,
+        }
+
+    def connect(self, *args, **kwargs):
+        return FakeConnection(self)
+
+    def execute(self, statement, params, values):
+        """Returns the rows for one statement, `values` holds execute_values() rows."""
+        if self.latency:
+            time.sleep(self.latency)
+        sql = ' '.join(statement.split())
+        if sql.startswith('PREPARE '):
+            name, _, body = sql[len('PREPARE '):].partition(' AS ')
+            self.prepared[name] = re.sub(r'\$\d+', '%s', body)
+            self._counter()['PREPARE'] += 1
+            return []
+        if sql.startswith('EXECUTE '):
+            sql = self.prepared[re.match(r'EXECUTE (\w+)', sql).group(1)]
+        match = STATEMENT_RE.match(sql)
+        kind = f'{match.group(1).upper()} {match.group(2) or ""}'.strip() if match else sql[:40]
+        self._counter()[kind] += 1
+        return self._respond(sql, params or (), values)
+
+    def _counter(self):
+        # one counter per thread, summed by queries()
+        counter = getattr(self._local, 'counter', None)
+        if counter is None:
+            counter = self._local.counter = collections.Counter()
+            self._counters.append(counter)
+        return counter
+
+    def queries(self):
+        return dict(sum(list(self._counters), collections.Counter()))
+
+    def _respond(self, sql, params, values):
+        table = next((name for name in ('DemoDevices', 'Devices') if f'"{name}"' in sql), None)
+        if sql.startswith('SELECT 1;'):
+            return [(1,)]
+        if sql.startswith('SELECT * FROM "Questions"'):
+            return self.questions
+        if sql.startswith('SELECT * FROM "DemoQuestions"'):
+            return self.demo_questions
+        if sql.startswith('SELECT * FROM "AppConfiguration"'):
+            return self.configuration
+        if 'LogAcknowledgements' in sql:
+            if 'SELECT DISTINCT' in sql:
+                return []
+            if sql.startswith('INSERT'):
+                self.acks.update(row[0] for row in values or [params[:1]] if row)
+                return []
+            if 'device_id=%s' in sql:
+                return [(1,)] if params[0] in self.acks else []
+            return [(device_id,) for device_id in self.acks]
+        if '"IngestKeys"' in sql:
+            return self._ingest_keys(sql, params, values)
+        if table and sql.startswith('SELECT'):
+            if 'ANY(%s)' in sql:
+                return [self.devices[table][d] for d in params[0] if d in self.devices[table]]
+            device_id = params[0] if params else re.search(r"device_id\s*=\s*'([^']*)'", sql).group(1)
+            device = self.devices[table].get(device_id)
+            return [device] if device else []
+        if table and sql.startswith('INSERT'):
+            device_id = params[0]
+            self.devices[table][device_id] = {
+                'id': self._id(), 'device_id': device_id, 'company': params[1],
+                'department': params[2], 'prompt_group': None, 'call_count': 0}
+            return [(self.devices[table][device_id]['id'],)]
+        if table and sql.startswith('UPDATE'):
+            device_id = params[-1] if params else re.search(r"device_id\s*=\s*'([^']*)'", sql).group(1)
+            device = self.devices[table].get(device_id)
+            if device is None:
+                return []
+            if 'call_count' in sql:
+                device['call_count'] += 1
+            if 'prompt_group' in sql and params:
+                device['prompt_group'] = params[0] if len(params) > 1 else device['prompt_group'] or 1
+            return [device] if 'RETURNING' in sql else []
+        if 'RETURNING id' in sql:
+            return [(self._id(),) for _ in (values or [params])]
+        return []
+
+    def _ingest_keys(self, sql, params, values):
+        if sql.startswith('INSERT'):
+            claimed = []
+            for scope, key in values or [params]:
+                if (scope, key) not in self.ingest_keys:
+                    self.ingest_keys[(scope, key)] = None
+                    claimed.append(key)
+            # claim_many() gets the keys back, claim() a row when its key was new
+            return [(key,) for key in claimed] if values else [(1,)] * len(claimed)
+        if sql.startswith('SELECT'):
+            if tuple(params) not in self.ingest_keys:
+                return []
+            return [(self.ingest_keys[tuple(params)],)]
+        if sql.startswith('UPDATE'):
+            self.ingest_keys[(params[1], params[2])] = params[0]
+        return []
+
+
+def render_composed(statement):
+    # Composable.as_string() needs a real connection to quote identifiers
+    if isinstance(statement, psycopg2.sql.Composed):
+        return ''.join(render_composed(part) for part in statement.seq)
+    if isinstance(statement, psycopg2.sql.Identifier):
+        return '.'.join('"%s"' % name for name in statement.strings)
+    if isinstance(statement, psycopg2.sql.SQL):
+        return statement.string
+    if isinstance(statement, psycopg2.sql.Placeholder):
+        return '%s'
+    return repr(statement.wrapped)
+
+
+class FakeCursor:
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+        self.itersize = 2000
+        self.rowcount = -1
+        self._rows = []
+        self._values = []
+
+    def mogrify(self, template, args):
+        # execute_values() renders each row with mogrify(), keep them as values
+        self._values.append(args)
+        return b'%s'
+
+    def execute(self, statement, params=None):
+        if not isinstance(statement, (str, bytes)):
+            statement = render_composed(statement)
+        if isinstance(statement, bytes):
+            statement = statement.decode()
+        values, self._values = self._values, []
+        rows = self.connection.database.execute(statement, params, values)
+        self._rows = [row if isinstance(row, tuple) else Row(row) for row in rows]
+        self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size=None):
+        rows, self._rows = self._rows[:size or 1], self._rows[size or 1:]
+        return rows
+
+    def __iter__(self):
+        while self._rows:
+            yield self._rows.pop(0)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeConnection:
+    encoding = 'UTF8'
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = 0
+        self.autocommit = False
+        self.notifies = []
+
+    def cursor(self, name=None, cursor_factory=None, **kwargs):
+        return FakeCursor(self, name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def poll(self):
+        pass
+
+    def fileno(self):
+        return self.database.listen_fd
+
+    def get_transaction_status(self):
+        return 0
+
+
+def import_app(database):
+    """Imports main.py with psycopg2.connect pointed at `database`."""
+    os.environ.setdefault('DB_PASSWORD', 'load-test')
+    # keep the service's own logging out of the report
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('LOG_PAYLOADS', 'false')
+    psycopg2.connect = database.connect
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    return main
+
+
+# ---- clients -----
+
+class InProcessClient:
+    """Sends requests through Flask's test client, one per worker thread."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        data = response.get_data()
+        return response.status_code, json.loads(data) if data and response.is_json else data
+
+
+class HttpClient:
+    """Sends requests over one keep-alive HTTP connection."""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.prefix = parsed.path.rstrip('/')
+        connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parsed.netloc, timeout=30)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        payload = json.dumps(body) if body is not None else None
+        try:
+            self.connection.request(method, self.prefix + path, payload, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+        is_json = response.getheader('Content-Type', '').startswith('application/json')
+        return response.status, json.loads(data) if data and is_json else data
+
+
+# ---- server-side figures -----
+
+class InProcessServer:
+    def __init__(self, main, database):
+        self.main = main
+        self.database = database
+
+    def pool_stats(self):
+        return self.main.pool.stats()
+
+    def query_counts(self):
+        return self.database.queries()
+
+    def drain(self):
+        # count the log writes that are still queued
+        self.main.logs_queue.close()
+
+
+class RemoteServer:
+    QUERY_COUNT_RE = re.compile(r'^croissant_query_duration_seconds_count\{query="([^"]+)"\} (\S+)$', re.M)
+
+    def __init__(self, url):
+        self.client = HttpClient(url)
+
+    def pool_stats(self):
+        stats = self.client.request('GET', '/stats')[1]
+        # asgi.py serves device requests from its own asyncpg pool
+        return stats.get('async_pool') or stats['pool']
+
+    def query_counts(self):
+        # only the named hot queries are exported, see timed_query() in main.py
+        text = self.client.request('GET', '/metrics')[1].decode()
+        return {name: int(float(count)) for name, count in self.QUERY_COUNT_RE.findall(text)}
+
+    def drain(self):
+        pass
+
+
+class PoolSampler:
+    """Samples pool usage while the test runs, keeps the peak and the mean."""
+
+    def __init__(self, server, interval=0.25):
+        self.server = server
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pool-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                stats = self.server.pool_stats()
+            except Exception:
+                continue
+            self.samples.append((stats['in_use'], stats['max']))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+# ---- simulated fleet -----
+
+class Device:
+    def __init__(self, index, company, department, registered):
+        self.device_id = hashlib.sha256(f'load-test-device-{index}'.encode()).hexdigest()
+        self.company = company
+        self.department = department
+        self.registered = registered
+        self.config_version = None
+        self.answers = []
+
+
+class LoadTest:
+    """Runs the client cycle for every device from a pool of worker threads.
+
+    Without a poll interval the workers run closed-loop, each starting the
+    next due device's cycle as soon as the previous one finished, which
+    measures peak throughput. With one, every device polls on that interval
+    like the desktop client does and latency is measured at that load.
+    """
+
+    def __init__(self, options, make_client):
+        self.options = options
+        self.make_client = make_client
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.cycles = 0
+        self._lock = threading.Lock()
+        self._schedule = []
+        self._stop = threading.Event()
+
+    def add_devices(self, devices):
+        interval = self.options.poll_interval or 0
+        for index, device in enumerate(devices):
+            # spread the first polls over one interval
+            start = random.uniform(0, interval) if interval else 0
+            self._schedule.append((start, index, device))
+        heapq.heapify(self._schedule)
+
+    def _next_device(self):
+        with self._lock:
+            if not self._schedule:
+                return None, None
+            due, index, device = heapq.heappop(self._schedule)
+        return due, (index, device)
+
+    def _reschedule(self, due, entry):
+        interval = self.options.poll_interval
+        next_due = due + interval if interval else time.monotonic() - self.started
+        with self._lock:
+            heapq.heappush(self._schedule, (next_due, entry[0], entry[1]))
+
+    def _call(self, client, route, method, path, body=None, headers=None):
+        started = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body, headers)
+        except Exception as e:
+            with self._lock:
+                self.errors[f'{route}: {type(e).__name__}'] += 1
+            return None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[route].append(elapsed)
+            if status >= 400:
+                self.errors[f'{route}: HTTP {status}'] += 1
+        return data
+
+    def _post(self, client, route, path, body):
+        """Posts with an idempotency key, and again with the same key for --retries of the posts."""
+        headers = {'Idempotency-Key': uuid.uuid4().hex}
+        data = self._call(client, route, 'POST', path, body, headers)
+        if random.random() < self.options.retries:
+            data = self._call(client, route + ' (retry)', 'POST', path, body, headers)
+        return data
+
+    def cycle(self, client, device):
+        query = urllib.parse.urlencode({'device_id': device.device_id})
+        prompt = self._call(client, 'GET /', 'GET', f'/?{query}')
+        if prompt is None:
+            return
+        if prompt.get('prompt_type') == 'customer_register':
+            self._post(client, 'POST /register_customer', '/register_customer',
+                       {'device_id': device.device_id, 'company': device.company, 'department': device.department})
+            device.registered = True
+            return
+
+        check_query = {'device_id': device.device_id}
+        if device.config_version:
+            check_query['config_version'] = device.config_version
+        check = self._call(client, 'GET /popup_logs_check', 'GET', '/popup_logs_check?' + urllib.parse.urlencode(check_query))
+        if check:
+            device.config_version = check.get('app_configuration_version', device.config_version)
+
+        if prompt.get('id') is not None:
+            device.answers.append({'device_id': device.device_id, 'question_id': prompt['id'],
+                                   'answer': random.choice(('happy', 'neutral', 'sad'))})
+            if self.options.answers_batch <= 1:
+                self._post(client, 'POST /record_data', '/record_data', device.answers.pop())
+            elif len(device.answers) >= self.options.answers_batch:
+                self._post(client, 'POST /record_data (batch)', '/record_data', device.answers)
+                device.answers = []
+
+        self._post(client, 'POST /logs/record_data', '/logs/record_data', {
+            'device_id': device.device_id, 'prompt_id': prompt.get('id', 'n/a'),
+            'answer': 'popup displayed', 'recieved_status': 'true', 'error_log': 'n/a'})
+
+    def _worker(self):
+        client = self.make_client()
+        while not self._stop.is_set():
+            due, entry = self._next_device()
+            if entry is None:
+                return
+            delay = due - (time.monotonic() - self.started)
+            if delay > 0 and self._stop.wait(delay):
+                return
+            self.cycle(client, entry[1])
+            with self._lock:
+                self.cycles += 1
+            self._reschedule(due, entry)
+
+    def run(self, measuring):
+        """Runs the warm-up, calls measuring() and runs for the measured duration."""
+        self.started = time.monotonic()
+        workers = [threading.Thread(target=self._worker, name=f'load-worker-{n}', daemon=True)
+                   for n in range(self.options.workers)]
+        for worker in workers:
+            worker.start()
+        # first polls register devices and fill the caches, they are not measured
+        self._stop.wait(self.options.warmup)
+        with self._lock:
+            self.latencies.clear()
+            self.errors.clear()
+            self.cycles = 0
+        measuring()
+        measured_from = time.monotonic()
+        self._stop.wait(self.options.duration)
+        self._stop.set()
+        for worker in workers:
+            worker.join()
+        self.elapsed = time.monotonic() - measured_from
+
+
+# ---- report -----
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize(test, pool_before, pool_after, sampler, queries_before, queries_after, options):
+    routes = {}
+    total = 0
+    for route, values in sorted(test.latencies.items()):
+        values.sort()
+        total += len(values)
+        routes[route] = {
+            'requests': len(values),
+            'rps': round(len(values) / test.elapsed, 1),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3),
+        }
+    checkouts = pool_after['checkouts'] - pool_before['checkouts']
+    in_use = [used for used, _ in sampler.samples]
+    queries = {name: count - queries_before.get(name, 0) for name, count in sorted(queries_after.items())}
+    return {
+        'options': {name: getattr(options, name) for name in COMPARED_OPTIONS},
+        'duration_s': round(test.elapsed, 2),
+        'cycles': test.cycles,
+        'requests': total,
+        'rps': round(total / test.elapsed, 1),
+        'routes': routes,
+        'errors': dict(test.errors),
+        'pool': {
+            'max': pool_after['max'],
+            'peak_in_use': max(in_use, default=0),
+            'mean_in_use': round(sum(in_use) / len(in_use), 2) if in_use else 0,
+            'checkouts': checkouts,
+            'checkout_failures': pool_after['checkout_failures'] - pool_before['checkout_failures'],
+            'mean_wait_ms': round((pool_after['wait_seconds_total'] - pool_before['wait_seconds_total']) / checkouts * 1000, 3) if checkouts else 0,
+            'max_wait_ms': round(pool_after['max_wait_seconds'] * 1000, 3),
+        },
+        'queries': {name: count for name, count in queries.items() if count},
+        'queries_per_cycle': round(sum(queries.values()) / test.cycles, 2) if test.cycles else None,
+    }
+
+def print_report(result, out=sys.stdout):
+    out.write(f"{result['cycles']} client cycles, {result['requests']} requests in {result['duration_s']}s "
+              f"({result['rps']} req/s)\n\n")
+    out.write(f"{'route':<30} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}\n")
+    for route, figures in result['routes'].items():
+        out.write(f"{route:<30} {figures['requests']:>9} {figures['rps']:>8} {figures['p50_ms']:>8} "
+                  f"{figures['p95_ms']:>8} {figures['p99_ms']:>8} {figures['max_ms']:>8}\n")
+    pool = result['pool']
+    out.write(f"\npool: peak {pool['peak_in_use']}/{pool['max']} in use, mean {pool['mean_in_use']}, "
+              f"{pool['checkouts']} checkouts, {pool['checkout_failures']} timed out, "
+              f"wait mean {pool['mean_wait_ms']}ms max {pool['max_wait_ms']}ms\n")
+    out.write(f"queries ({result['queries_per_cycle']} per cycle):\n")
+    for name, count in result['queries'].items():
+        out.write(f"  {name:<40} {count:>9}\n")
+    if result['errors']:
+        out.write('errors:\n')
+        for error, count in sorted(result['errors'].items()):
+            out.write(f'  {error:<40} {count:>9}\n')
+
+def compare(result, baseline, tolerance, percentile):
+    """Returns the regressions of `result` against `baseline`."""
+    key = f'p{percentile}_ms'
+    regressions = []
+    if baseline['rps'] and result['rps'] < baseline['rps'] * (1 - tolerance):
+        regressions.append(f"throughput {result['rps']} req/s, baseline {baseline['rps']} req/s")
+    for route, figures in baseline['routes'].items():
+        current = result['routes'].get(route)
+        if current is None:
+            continue
+        if current[key] > figures[key] * (1 + tolerance):
+            regressions.append(f"{route} p{percentile} {current[key]}ms, baseline {figures[key]}ms")
+    if baseline.get('queries_per_cycle') and result['queries_per_cycle'] and \
+            result['queries_per_cycle'] > baseline['queries_per_cycle'] * (1 + tolerance):
+        regressions.append(f"{result['queries_per_cycle']} queries per cycle, baseline {baseline['queries_per_cycle']}")
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', default='inprocess', help='"inprocess" or the URL of a running server')
+    parser.add_argument('--devices', type=int, default=1000, help='simulated devices')
+    parser.add_argument('--workers', type=int,
+                        help='concurrent client threads, 1 in process (the clients would compete with the '
+                             'service for the GIL) and 32 against a URL')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to run')
+    parser.add_argument('--poll-interval', type=float, default=0,
+                        help='seconds between polls of one device, 0 runs closed-loop at peak throughput')
+    parser.add_argument('--unregistered', type=float, default=0.01,
+                        help='share of devices that register during the run')
+    parser.add_argument('--answers-batch', type=int, default=1,
+                        help='answers a device sends per /record_data request')
+    parser.add_argument('--retries', type=float, default=0.05,
+                        help='share of posts sent a second time with the same Idempotency-Key')
+    parser.add_argument('--companies', type=int, default=20, help='company/department pairs (inprocess only)')
+    parser.add_argument('--db-latency', type=float, default=0,
+                        help='milliseconds added to every statement (inprocess only)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed regression, 0.5 is 50%%')
+    parser.add_argument('--percentile', type=int, choices=(50, 95, 99), default=50,
+                        help='route latency compared against the baseline')
+    parser.add_argument('--warmup', type=float, default=3, help='seconds run before measuring')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.workers is None:
+        options.workers = 1 if options.target == 'inprocess' else 32
+    random.seed(options.seed)
+
+    companies = [(f'Company {n}', f'Department {n % 7}') for n in range(options.companies)]
+    devices = []
+    for index in range(options.devices):
+        company, department = companies[index % len(companies)]
+        devices.append(Device(index, company, department, random.random() >= options.unregistered))
+
+    if options.target == 'inprocess':
+        database = FakeDatabase(companies, options.db_latency / 1000)
+        for device in devices:
+            if device.registered:
+                database.add_device('Devices', device.device_id, device.company, device.department)
+        app_module = import_app(database)
+        server = InProcessServer(app_module, database)
+        make_client = lambda: InProcessClient(app_module.app)
+    else:
+        server = RemoteServer(options.target)
+        make_client = lambda: HttpClient(options.target)
+        # devices of an earlier run against the same database are registered already
+
+    test = LoadTest(options, make_client)
+    test.add_devices(devices)
+
+    before = {}
+    sampler = PoolSampler(server)
+
+    def measuring():
+        before.update(pool=server.pool_stats(), queries=server.query_counts())
+        sampler.start()
+
+    test.run(measuring)
+    sampler.stop()
+    server.drain()
+    result = summarize(test, before['pool'], server.pool_stats(), sampler,
+                       before['queries'], server.query_counts(), options)
+
+    print_report(result)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+        print(f'\nbaseline written to {options.baseline}')
+        return 0
+
+    if not os.path.exists(options.baseline):
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline['options'] != result['options']:
+        print(f'\nbaseline {options.baseline} was recorded with different options, not compared')
+        return 0
+    regressions = compare(result, baseline, options.tolerance, options.percentile)
+    if regressions:
+        print(f'\nregressions against {options.baseline}:')
+        for regression in regressions:
+            print('  ' + regression)
+        return 1
+    print(f'\nno regressions against {options.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
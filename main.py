@@ -1,9 +1,32 @@
 # from flask import Flask, abort, request
-from flask import Flask, request, redirect, render_template, url_for, flash, jsonify, send_from_directory
+from flask import Flask, abort, g, has_request_context, request, redirect, render_template, url_for, flash, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 import os
 import datetime
+import fcntl
 import json
+import logging
+import mimetypes
+import random
+import atexit
+import base64
+import binascii
+import bisect
+import collections
+import contextlib
+import hashlib
+import queue
+import re
+import sys
+import select
+import threading
+import time
+import uuid
+import weakref
+import zlib
+import werkzeug.exceptions
+import werkzeug.security
+import werkzeug.utils
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -12,7 +35,174 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# ---- background threads -----
+
+class BackgroundThread:
+    """A daemon thread running `target`, started by the first ensure_started().
+
+    Started lazily rather than at import so forked workers each get their own
+    thread, and started again if it died. Targets that loop until asked to
+    finish watch `stopping`, which stop() sets.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self.stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def ensure_started(self):
+        if self.is_alive():
+            return
+        with self._lock:
+            if not self.is_alive():
+                self.stopping.clear()
+                self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+                self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stop(self, timeout=None):
+        """Sets `stopping` and waits up to `timeout` seconds for the thread to finish."""
+        self.stopping.set()
+        self.join(timeout)
+
+
+# ---- logging -----
+
+# settings that could not be parsed, logged once the logger is set up
+ignored_log_settings = []
+
+def log_level(name):
+    """The numeric level for a name such as "warning".
+
+    Raises:
+      ValueError: on an unknown level name.
+    """
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError(f'unknown log level {name!r}')
+    return level
+
+def parse_route_settings(variable, convert):
+    """Parses "route=value,route=value" settings such as LOG_SAMPLE_RATES from the environment.
+
+    Values `convert` rejects with a ValueError are left out.
+    """
+    settings = {}
+    for item in filter(None, (part.strip() for part in os.getenv(variable, '').split(','))):
+        route, _, setting = item.partition('=')
+        try:
+            settings[route.strip()] = convert(setting.strip())
+        except ValueError as e:
+            ignored_log_settings.append(f'{variable}: {item} ignored, {e}')
+    return settings
+
+try:
+    LOG_LEVEL = log_level(os.getenv('LOG_LEVEL', 'INFO'))
+except ValueError as e:
+    ignored_log_settings.append(f'LOG_LEVEL: {e}, using INFO')
+    LOG_LEVEL = logging.INFO
+# per-route overrides keyed by endpoint name, e.g. LOG_LEVELS="index=WARNING"
+LOG_LEVELS = parse_route_settings('LOG_LEVELS', log_level)
+# share of records below WARNING kept per route, e.g. LOG_SAMPLE_RATES="index=0.01"
+LOG_SAMPLE_RATES = parse_route_settings('LOG_SAMPLE_RATES', float)
+# request payload dumps, LOG_PAYLOADS=true to turn them on while debugging
+LOG_PAYLOADS = os.getenv('LOG_PAYLOADS', 'false').lower() == 'true'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'route', None):
+            entry['route'] = record.route
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class RouteFilter(logging.Filter):
+    """Tags records with the current route and applies its level and sampling rate."""
+
+    def filter(self, record):
+        route = request.endpoint if has_request_context() else None
+        record.route = route
+        if record.levelno < LOG_LEVELS.get(route, LOG_LEVEL):
+            return False
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = LOG_SAMPLE_RATES.get(route, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+class AsyncLogHandler(logging.Handler):
+    """Hands records to a background thread that formats and writes them.
+
+    Request threads only pay for a queue put, the stream lock and the JSON
+    encoding stay on the writer thread. Records are dropped and counted when
+    the queue is full.
+    """
+
+    def __init__(self, stream, capacity):
+        super().__init__()
+        self.stream = stream
+        self.records = queue.Queue(capacity)
+        self.dropped = 0
+        self._writer = BackgroundThread(self._run, 'log-writer')
+
+    def emit(self, record):
+        self._writer.ensure_started()
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            try:
+                self.stream.write(self.format(record) + '\n')
+                if self.records.empty():
+                    self.stream.flush()
+            except Exception:
+                self.handleError(record)
+
+    def close(self):
+        if self._writer.is_alive():
+            self.records.put(None)
+            self._writer.join(5)
+        super().close()
+
+
+logger = logging.getLogger('croissant')
+logger.setLevel(min([LOG_LEVEL] + list(LOG_LEVELS.values())))
+logger.propagate = False
+logger.addFilter(RouteFilter())
+log_handler = AsyncLogHandler(sys.stdout, LOG_QUEUE_SIZE)
+log_handler.setFormatter(JsonFormatter())
+logger.addHandler(log_handler)
+atexit.register(log_handler.close)
+for message in ignored_log_settings:
+    logger.warning(message)
+
+def log_payload(message, payload):
+    """Logs a request payload unless LOG_PAYLOADS is off."""
+    if LOG_PAYLOADS:
+        logger.info(message, extra={'fields': {'payload': payload}})
+
 import psycopg2.pool
+import psycopg2.extensions
 
 # Get database configuration from environment variables
 DB_HOST = os.getenv('DB_HOST', 'localhost')
@@ -26,10 +216,7 @@ DB_SSL_MODE = os.getenv('DB_SSL_MODE', 'prefer')
 if not DB_PASSWORD:
     raise ValueError("DB_PASSWORD environment variable is required")
 
-# Create a connection pool with a minimum of 2 connections and
-# a maximum of 5 connections
-pool = psycopg2.pool.SimpleConnectionPool(
-    2, 5, 
+DB_CONNECT_ARGS = dict(
     user=DB_USER, 
     password=DB_PASSWORD,
     host=DB_HOST, 
@@ -38,293 +225,2354 @@ pool = psycopg2.pool.SimpleConnectionPool(
     sslmode=DB_SSL_MODE
 )
 
+# Connection pool limits, see ConnectionPool
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_USES = int(os.getenv('DB_POOL_MAX_USES', '10000'))
+DB_POOL_MAX_AGE = float(os.getenv('DB_POOL_MAX_AGE', '3600'))
+DB_POOL_CHECK_IDLE = float(os.getenv('DB_POOL_CHECK_IDLE', '30'))
+
+
+# ---- metrics -----
+
+# upper bounds in seconds, shared by every latency histogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Fixed-bucket latency histogram, rendered in the Prometheus text format.
+
+    Bucket counts are preallocated, so observe() is a bisect and a few integer
+    increments under a lock held only for those increments.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{{{labels}le="{le}"}} {cumulative}')
+        suffix = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {total}')
+        lines.append(f'{name}_count{suffix} {count}')
+        return lines
+
+
+class HistogramFamily:
+    """Histograms of one metric keyed by a single label value."""
+
+    def __init__(self, name, label, help_text):
+        self.name = name
+        self.label = label
+        self.help_text = help_text
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def get(self, value):
+        histogram = self.histograms.get(value)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(value, Histogram())
+        return histogram
+
+    def observe(self, value, seconds):
+        self.get(value).observe(seconds)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for value, histogram in sorted(self.histograms.items()):
+            lines.extend(histogram.render(self.name, f'{self.label}="{prometheus_escape(value)}",'))
+        return lines
+
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+request_latency = HistogramFamily('croissant_request_duration_seconds', 'route', 'Request latency by route.')
+query_latency = HistogramFamily('croissant_query_duration_seconds', 'query', 'Latency of the named hot queries.')
+pool_wait = Histogram()
+
+@contextlib.contextmanager
+def timed_query(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        query_latency.observe(name, time.perf_counter() - started)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.teardown_request
+def record_request_latency(exc):
+    started = g.pop('request_started', None)
+    if started is not None:
+        request_latency.observe(request.endpoint or 'not_found', time.perf_counter() - started)
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Raised when no connection became available within the checkout timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe connection pool with blocking checkout.
+
+    getconn() waits up to `timeout` seconds for a free connection instead of
+    failing as soon as `maxconn` are checked out. Connections are replaced
+    once they were used `max_uses` times or are older than `max_age` seconds,
+    and pinged before reuse when they sat idle longer than `check_idle`.
+    `on_connect(conn)` runs once for every new connection.
+    Routes can use `with pool.connection() as conn:`.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, max_uses, max_age, check_idle, on_connect=None, **connect_args):
+        self.maxconn = maxconn
+        self.on_connect = on_connect
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self.connect_args = connect_args
+        self._idle = []
+        self._meta = {}
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.created = 0
+        self.recycled = 0
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_args)
+        if self.on_connect is not None:
+            try:
+                self.on_connect(conn)
+            except Exception:
+                conn.close()
+                raise
+        now = time.monotonic()
+        # [created, uses, last returned]
+        self._meta[conn] = [now, 0, now]
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def _expired(self, conn):
+        created, uses, _ = self._meta[conn]
+        return (conn.closed or (self.max_uses and uses >= self.max_uses)
+                or time.monotonic() - created > self.max_age)
+
+    def _discard(self, conn):
+        self._meta.pop(conn, None)
+        with self._cond:
+            self.recycled += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn):
+        if self._expired(conn):
+            return False
+        if time.monotonic() - self._meta[conn][2] < self.check_idle:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1;')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self, timeout=None):
+        started = time.monotonic()
+        deadline = started + (self.timeout if timeout is None else timeout)
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.checkout_failures += 1
+                    raise PoolTimeout('connection pool exhausted')
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        try:
+            # connecting and health checks run outside the lock
+            if conn is not None and not self._healthy(conn):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self.checkout_failures += 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        pool_wait.observe(waited)
+        with self._cond:
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        meta = self._meta.get(conn)
+        if meta is not None:
+            meta[1] += 1
+            meta[2] = time.monotonic()
+            if not close and not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    close = True
+        reuse = meta is not None and not close and not self._expired(conn)
+        if not reuse:
+            self._discard(conn)
+        with self._cond:
+            self._in_use -= 1
+            if reuse:
+                self._idle.append(conn)
+            else:
+                self._size -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'max': self.maxconn,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+                'max_wait_seconds': round(self.max_wait_seconds, 6),
+                'created': self.created,
+                'recycled': self.recycled,
+            }
+
+
+# ---- prepared statements -----
+
+# Behind PgBouncer in transaction pooling mode a session's PREPAREd statements
+# are not visible to the next transaction, set DB_PREPARED_STATEMENTS=false there
+DB_PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() == 'true'
+
+class StatementRegistry:
+    """Named hot statements, PREPAREd on every pooled connection.
+
+    Statements are registered with psycopg2 placeholders and run with
+    execute(cursor, name, params), which sends `EXECUTE name (...)` so
+    Postgres skips parsing and planning. New connections prepare every
+    registered statement when they are created; a statement registered later
+    is prepared on first use. With `enabled` off the statement text is sent
+    as a plain parameterized query instead.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.statements = {}
+        # statement text with $n placeholders, for drivers that take it directly
+        self.positional = {}
+        self.executes = collections.Counter()
+        self.prepare_failures = 0
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def register(self, name, query):
+        """Adds `query` under `name` and returns the name."""
+        count = 0
+        def placeholder(match):
+            nonlocal count
+            if match.group(1) == '%':
+                return '%'
+            count += 1
+            return f'${count}'
+        body = re.sub(r'%([s%])', placeholder, query.strip().rstrip(';'))
+        arguments = ' (' + ', '.join(['%s'] * count) + ')' if count else ''
+        self.statements[name] = (query, f'PREPARE {name} AS {body};', f'EXECUTE {name}{arguments};')
+        self.positional[name] = body
+        return name
+
+    def _prepare(self, cursor, name):
+        cursor.execute(self.statements[name][1])
+        with self._lock:
+            self._prepared.setdefault(cursor.connection, set()).add(name)
+
+    def prepare(self, conn):
+        """Prepares every registered statement on a new connection."""
+        if not self.enabled:
+            return
+        # autocommit so a statement that fails to prepare (e.g. a missing
+        # table) does not abort the others
+        conn.autocommit = True
+        try:
+            cursor = conn.cursor()
+            for name in list(self.statements):
+                try:
+                    self._prepare(cursor, name)
+                except psycopg2.Error as e:
+                    with self._lock:
+                        self.prepare_failures += 1
+                    logger.error('prepare %s error: %s', name, e)
+            cursor.close()
+        finally:
+            conn.autocommit = False
+
+    def execute(self, cursor, name, params=()):
+        query, _, execute = self.statements[name]
+        with self._lock:
+            self.executes[name] += 1
+            prepared = name in self._prepared.get(cursor.connection, ())
+        if not self.enabled:
+            cursor.execute(query, params)
+            return
+        if not prepared:
+            # prepared statements outlive the transaction, a rollback keeps them
+            self._prepare(cursor, name)
+        cursor.execute(execute, params)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'statements': len(self.statements),
+                'prepare_failures': self.prepare_failures,
+                'executes': dict(self.executes),
+            }
+
+
+statements = StatementRegistry(DB_PREPARED_STATEMENTS)
+
+pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_MAX_USES,
+                      DB_POOL_MAX_AGE, DB_POOL_CHECK_IDLE, statements.prepare, **DB_CONNECT_ARGS)
+
 # Define your connection parameters
 import psycopg2
 
 import psycopg2.extras
+import psycopg2.sql
+
+
+# ---- device cache -----
+
+class DeviceCache:
+    """Thread-safe LRU cache of device rows with a TTL.
+
+    Unregistered device ids are cached as None (for a shorter TTL) so polling
+    clients that have not registered yet do not hit the database every time.
+    """
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (device, found), device is None for a cached negative lookup."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                if entry[1] is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return entry[1], True
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None, False
+
+    def generation(self):
+        with self._lock:
+            return self._invalidations
+
+    def put(self, key, device, generation):
+        """Caches a row read from the database.
+
+        `generation` is the value of generation() taken before the read, the row
+        is not cached if an invalidation happened in between.
+        """
+        expires = time.monotonic() + (self.ttl if device is not None else self.negative_ttl)
+        with self._lock:
+            if generation != self._invalidations:
+                return
+            self._entries[key] = (expires, device)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+device_cache = DeviceCache(
+    int(os.getenv('DEVICE_CACHE_MAX_SIZE', '50000')),
+    float(os.getenv('DEVICE_CACHE_TTL', '30')),
+    float(os.getenv('DEVICE_CACHE_NEGATIVE_TTL', '5')))
+
+SELECT_DEVICE_STATEMENTS = {
+    'Devices': statements.register('select_device', 'SELECT * FROM "Devices" WHERE device_id=%s;'),
+    'DemoDevices': statements.register('select_demo_device', 'SELECT * FROM "DemoDevices" WHERE device_id=%s;'),
+}
+
+def lookup_device(cursor, table, device_id):
+    """Returns the device row of `table` as a dict, or None when not registered."""
+    device, found = device_cache.get((table, device_id))
+    if found:
+        return device
+
+    generation = device_cache.generation()
+    with timed_query('device_lookup'):
+        statements.execute(cursor, SELECT_DEVICE_STATEMENTS[table], (device_id,))
+        row = cursor.fetchone()
+    device = dict(row) if row is not None else None
+    device_cache.put((table, device_id), device, generation)
+    return device
+
+
+# ---- reload notifications -----
+
+RELOAD_CHANNEL = os.getenv('RELOAD_CHANNEL', 'croissant_reload')
+
+class ReloadListener:
+    """LISTENs on RELOAD_CHANNEL and dispatches notification payloads.
+
+    Every worker runs one listener on a dedicated connection (it cannot live in
+    the pool, LISTEN is tied to the session), so a reload triggered on one
+    worker or by `NOTIFY croissant_reload, '<name>'` reaches all of them.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.handlers = {}
+        self._listener = BackgroundThread(self._run, 'reload-listener')
+
+    def register(self, name, handler):
+        self.handlers[name] = handler
+
+    def notify(self, name):
+        """Broadcasts `name` to the listeners of every worker."""
+        try:
+          with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_notify(%s, %s);', (self.channel, name))
+            cursor.close()
+            conn.commit()
+        except Exception as e:
+          logger.error('reload notify error: %s', e)
+
+    def ensure_started(self):
+        self._listener.ensure_started()
+
+    def _dispatch(self, payload):
+        name, _, argument = payload.partition(':')
+        handler = self.handlers.get(name)
+        if handler is None:
+            return
+        try:
+            handler(argument) if argument else handler()
+        except Exception as e:
+            logger.error('reload handler %s error: %s', name, e)
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**DB_CONNECT_ARGS)
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(psycopg2.sql.SQL('LISTEN {};').format(psycopg2.sql.Identifier(self.channel)))
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error('reload listener error: %s', e)
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+reload_listener = ReloadListener(RELOAD_CHANNEL)
+
+# ---- question catalog -----
+
+def normalize_text(value):
+    """Applies the NBSP normalization used for company and department names."""
+    return value.replace(u'\xa0', u' ') if isinstance(value, str) else value
+
+class TableSnapshot:
+    """Base for in-memory copies of tables that change rarely but are read per poll.
+
+    Subclasses implement load(), which reads the rows, swaps the new content in
+    and calls _mark_loaded(), then _changed() outside the lock. Readers call
+    ensure_fresh(), which never queries or waits: a background thread reloads
+    the snapshot once it is older than `max_age`, in case a notification was
+    missed, and readers keep serving the current content until then, or after
+    that reload failed. Routes hold a pooled connection while they read, a
+    reload on their thread would take a second one. on_change() callbacks run
+    after a reload that changed the content.
+    """
+
+    name = 'snapshot'
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.version = None
+        self.loaded_at = None
+        self._loaded_monotonic = None
+        self.reload_failures = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._refresher = BackgroundThread(self._run, self.name.replace(' ', '-') + '-refresh')
+        self._callbacks = []
+
+    def on_change(self, callback):
+        self._callbacks.append(callback)
+
+    def _changed(self, previous_version):
+        if previous_version is None or previous_version == self.version:
+            return
+        for callback in self._callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error('%s change callback error: %s', self.name, e)
+
+    def _fetch_rows(self, *queries):
+        """Runs each query on one pooled connection, returns a list of rows per query."""
+        with pool.connection() as conn:
+          cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+          results = []
+          for query in queries:
+            cursor.execute(query)
+            results.append([dict(row) for row in cursor.fetchall()])
+          cursor.close()
+          conn.commit()
+          return results
+
+    def _mark_loaded(self, version):
+        self.version = version
+        self.loaded_at = datetime.datetime.now().isoformat()
+        self._loaded_monotonic = time.monotonic()
+
+    def is_fresh(self):
+        loaded = self._loaded_monotonic
+        return loaded is not None and time.monotonic() - loaded <= self.max_age
+
+    def ensure_fresh(self):
+        reload_listener.ensure_started()
+        self._refresher.ensure_started()
+        if not self.is_fresh():
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            if not self.is_fresh():
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.error('%s reload error: %s', self.name, e)
+                    with self._lock:
+                        self.reload_failures += 1
+            loaded = self._loaded_monotonic
+            if self.is_fresh():
+                timeout = self.max_age - (time.monotonic() - loaded)
+            else:
+                # the load failed, try again soon without hammering the database
+                timeout = min(self.max_age, 5)
+            self._wake.wait(max(timeout, 0.1))
+
+
+class QuestionCatalog(TableSnapshot):
+    """In-memory copy of "Questions" and "DemoQuestions".
+
+    Questions are keyed by (company, department, prompt_group) and demo
+    questions by (company, department, demo_occurence_no, prompt_group), all as
+    normalized strings, so resolving a prompt costs no database round trip.
+    """
+
+    name = 'question catalog'
+
+    def __init__(self, max_age):
+        super().__init__(max_age)
+        self._questions = {}
+        self._demo_questions = {}
+
+    def load(self):
+        question_rows, demo_question_rows = self._fetch_rows(
+            'SELECT * FROM "Questions";', 'SELECT * FROM "DemoQuestions";')
+
+        questions = {}
+        for row in question_rows:
+            key = (normalize_text(row['PickerDB']), normalize_text(row['department']), str(row['prompt_group']))
+            questions.setdefault(key, row)
+        demo_questions = {}
+        for row in demo_question_rows:
+            key = (normalize_text(row['PickerDB']), normalize_text(row['department']),
+                   str(row['demo_occurence_no']), str(row['prompt_group']))
+            demo_questions.setdefault(key, row)
+
+        content = json.dumps([question_rows, demo_question_rows], sort_keys=True, default=str)
+        previous_version = self.version
+        with self._lock:
+            self._questions = questions
+            self._demo_questions = demo_questions
+            self._mark_loaded(hashlib.sha1(content.encode()).hexdigest()[:12])
+        logger.info('question catalog %s loaded: %d questions, %d demo questions', self.version, len(questions), len(demo_questions))
+        self._changed(previous_version)
+
+    def question(self, company, department, prompt_group):
+        with timed_query('question_lookup'):
+            self.ensure_fresh()
+            return self._questions.get((normalize_text(company), normalize_text(department), str(prompt_group)))
+
+    def demo_question(self, company, department, occurrence, prompt_group):
+        with timed_query('demo_question_lookup'):
+            self.ensure_fresh()
+            return self._demo_questions.get((normalize_text(company), normalize_text(department),
+                                             str(occurrence), str(prompt_group)))
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'loaded_at': self.loaded_at,
+            'reload_failures': self.reload_failures,
+            'questions': len(self._questions),
+            'demo_questions': len(self._demo_questions),
+        }
+
 
+question_catalog = QuestionCatalog(float(os.getenv('QUESTION_CATALOG_MAX_AGE', '300')))
+reload_listener.register('questions', question_catalog.load)
+
+try:
+  question_catalog.load()
+except Exception as e:
+  # the first poll starts the refresh thread, which retries the load
+  logger.error('question catalog load error: %s', e)
+
+@app.route('/admin/questions/reload', methods=["POST"])
+def reload_questions():
+    """Reloads the question catalog here and asks every other worker to do the same."""
+    try:
+      question_catalog.load()
+    except Exception as e:
+      logger.error('question catalog reload error: %s', e)
+      server_logs('n/a', 'Question catalog reload', str(e))
+      return jsonify({'error': str(e)}), 500
+    reload_listener.notify('questions')
+    return jsonify(question_catalog.stats())
+
+
+# ---- app configuration snapshot -----
+
+class ConfigSnapshot(TableSnapshot):
+    """Pre-serialized copy of "AppConfiguration".
+
+    The JSON is rendered once per load and versioned by its content hash, so
+    clients that already hold the current version can skip the payload.
+    """
+
+    name = 'app configuration'
+
+    def __init__(self, max_age):
+        super().__init__(max_age)
+        self.json = '[]'
+        self.rows = []
+        self.served = 0
+        self.skipped = 0
+        self.bytes_saved = 0
+        self._counter_lock = threading.Lock()
+
+    def load(self):
+        rows, = self._fetch_rows('SELECT * FROM "AppConfiguration";')
+        rendered = app.json.dumps(rows)
+        previous_version = self.version
+        with self._lock:
+            self.json = rendered
+            self.rows = rows
+            self._mark_loaded(hashlib.sha1(rendered.encode()).hexdigest()[:12])
+        self._changed(previous_version)
+
+    def current(self):
+        """Returns (version, json) of the latest snapshot."""
+        self.ensure_fresh()
+        with self._lock:
+            return self.version, self.json
+
+    def current_rows(self):
+        """Returns (version, rows) of the latest snapshot."""
+        self.ensure_fresh()
+        with self._lock:
+            return self.version, self.rows
+
+    def count(self, skipped, size):
+        with self._counter_lock:
+            self.served += 1
+            if skipped:
+                self.skipped += 1
+                self.bytes_saved += size
+
+    def stats(self):
+        with self._counter_lock:
+            return {
+                'version': self.version,
+                'loaded_at': self.loaded_at,
+                'reload_failures': self.reload_failures,
+                'bytes': len(self.json),
+                'served': self.served,
+                'skipped': self.skipped,
+                'bytes_saved': self.bytes_saved,
+                # every popup check used to run its own SELECT on the table
+                'queries_saved': self.served,
+            }
+
+
+config_snapshot = ConfigSnapshot(float(os.getenv('APP_CONFIG_REFRESH_INTERVAL', '60')))
+reload_listener.register('app_configuration', config_snapshot.load)
+
+try:
+  config_snapshot.load()
+except Exception as e:
+  # the first popup check starts the refresh thread, which retries the load
+  logger.error('app configuration load error: %s', e)
+
+@app.route('/admin/app_configuration/reload', methods=["POST"])
+def reload_app_configuration():
+    """Reloads the configuration snapshot here and on every other worker."""
+    try:
+      config_snapshot.load()
+    except Exception as e:
+      logger.error('app configuration reload error: %s', e)
+      server_logs('n/a', 'App configuration reload', str(e))
+      return jsonify({'error': str(e)}), 500
+    reload_listener.notify('app_configuration')
+    return jsonify(config_snapshot.stats())
+
+@app.route('/app_configuration', methods=["GET"])
+def app_configuration():
+    version, config_json = config_snapshot.current()
+    etag = f'"{version}"'
+    if etag in request.headers.get('If-None-Match', ''):
+      config_snapshot.count(True, len(config_json))
+      return '', 304, {'ETag': etag}
+    config_snapshot.count(False, 0)
+    return app.response_class(config_json, mimetype='application/json', headers={'ETag': etag})
+
+# ---- popup schedule -----
+
+# Upper bound on the sleep suggested to a client, so a configuration or
+# prompt_group change made while it sleeps is picked up within this time
+POPUP_MAX_CHECK_INTERVAL = int(os.getenv('POPUP_MAX_CHECK_INTERVAL', '3600'))
+# How often clients without next_check_at poll /popup_logs_check, used to
+# estimate the requests saved
+POPUP_POLL_INTERVAL = int(os.getenv('POPUP_POLL_INTERVAL', '60'))
+
+HOURS_PER_WEEK = 7 * 24
+
+def parse_numbers(value, low, high):
+    """Parses a comma-separated list such as "9,10,11", None when unset."""
+    if value is None or str(value).strip() == '':
+        return None
+    numbers = {int(part) for part in str(value).split(',') if part.strip()}
+    return {number for number in numbers if low <= number <= high}
+
+class PopupSchedule:
+    """Next time a device is eligible for a popup, from "AppConfiguration".
+
+    The configuration's popup_allowed_time (hours, "9,10,11") and, when the
+    column exists, popup_allowed_days (ISO weekdays, "1,2,3,4,5") define the
+    allowed hour slots of a week, in server local time like the
+    acknowledgement days. For every hour of the week the next allowed slot
+    and the first allowed slot of a later day are precomputed when the
+    configuration changes, so a device's schedule is two lookups:
+
+      * due (not acknowledged today, numeric prompt_group): the next allowed
+        hour, or POPUP_POLL_INTERVAL from now when the current hour is
+        allowed and the popup is shown right away;
+      * done (acknowledged today, or prompt_group not a number): the first
+        allowed hour of a later day.
+
+    The latest configuration row (highest id) is the one in effect.
+    """
+
+    def __init__(self):
+        self.version = None
+        # hours from the start of week hour h to the next allowed slot after it
+        self._next_slot = [None] * HOURS_PER_WEEK
+        # hours from the start of week day d to the first allowed slot of a later day
+        self._next_day = [None] * 7
+        self._allowed = [False] * HOURS_PER_WEEK
+        self._lock = threading.Lock()
+        self.served = 0
+        self.sleep_seconds = 0
+        self.requests_saved = 0
+
+    def rebuild(self):
+        version, rows = config_snapshot.current_rows()
+        if version == self.version:
+            return
+        row = max(rows, key=lambda row: row.get('id') or 0) if rows else {}
+        hours = parse_numbers(row.get('popup_allowed_time'), 0, 23)
+        days = parse_numbers(row.get('popup_allowed_days'), 1, 7)
+        allowed = [(hours is None or hour % 24 in hours) and (days is None or hour // 24 + 1 in days)
+                   for hour in range(HOURS_PER_WEEK)]
+
+        next_slot = [None] * HOURS_PER_WEEK
+        following = None
+        # two passes over the week so the slots wrap around to next week
+        for hour in reversed(range(2 * HOURS_PER_WEEK)):
+            if hour < HOURS_PER_WEEK:
+                next_slot[hour] = following - hour if following is not None else None
+            if allowed[hour % HOURS_PER_WEEK]:
+                following = hour
+        next_day = [None] * 7
+        for day in range(7):
+            # the slot after the day's last hour is the first one at or after the next midnight
+            offset = next_slot[day * 24 + 23]
+            next_day[day] = 23 + offset if offset is not None else None
+
+        with self._lock:
+            self._allowed, self._next_slot, self._next_day = allowed, next_slot, next_day
+            self.version = version
+        logger.info('popup schedule %s built, %d allowed hours per week', version, sum(allowed))
+
+    def next_check(self, due, now=None):
+        """Returns the datetime a device should check again."""
+        if self.version != config_snapshot.version:
+            self.rebuild()
+        now = now or datetime.datetime.now().astimezone()
+        hour_start = now.replace(minute=0, second=0, microsecond=0)
+        week_hour = now.weekday() * 24 + now.hour
+        with self._lock:
+            if due and self._allowed[week_hour]:
+                return now + datetime.timedelta(seconds=POPUP_POLL_INTERVAL)
+            if due:
+                offset = self._next_slot[week_hour]
+                start = hour_start
+            else:
+                offset = self._next_day[now.weekday()]
+                start = hour_start - datetime.timedelta(hours=now.hour)
+        latest = now + datetime.timedelta(seconds=POPUP_MAX_CHECK_INTERVAL)
+        if offset is None:
+            return latest
+        return min(start + datetime.timedelta(hours=offset), latest)
+
+    def annotate(self, response, device, acknowledged):
+        """Adds next_check_at and next_check_in to a /popup_logs_check response."""
+        restricted = device is not None and not response.get("prompt_group_is_number")
+        now = datetime.datetime.now().astimezone()
+        next_check = self.next_check(not acknowledged and not restricted, now)
+        seconds = max(0, int((next_check - now).total_seconds()))
+        response["next_check_at"] = next_check.isoformat(timespec='seconds')
+        response["next_check_in"] = seconds
+        with self._lock:
+            self.served += 1
+            self.sleep_seconds += seconds
+            # a client polling every POPUP_POLL_INTERVAL would have asked this many more times
+            self.requests_saved += max(0, seconds // POPUP_POLL_INTERVAL - 1)
+
+    def stats(self):
+        with self._lock:
+            polled = self.served + self.requests_saved
+            return {
+                'version': self.version,
+                'allowed_hours_per_week': sum(self._allowed),
+                'served': self.served,
+                'mean_sleep_seconds': round(self.sleep_seconds / self.served, 1) if self.served else 0,
+                'requests_saved': self.requests_saved,
+                'request_reduction': round(self.requests_saved / polled, 4) if polled else 0,
+            }
+
+
+popup_schedule = PopupSchedule()
+config_snapshot.on_change(popup_schedule.rebuild)
+
+# ---- idempotency keys -----
+
+# recent keys held per worker, a retry burst against one worker stops here
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '100000'))
+# keys are kept this long in "IngestKeys", client retries come well within it
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', str(7 * 24 * 3600)))
+IDEMPOTENCY_PURGE_INTERVAL = int(os.getenv('IDEMPOTENCY_PURGE_INTERVAL', '3600'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 200
+
+CLAIM_INGEST_KEY_STATEMENT = statements.register(
+    'claim_ingest_key',
+    'INSERT INTO "IngestKeys" (scope, idempotency_key) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING 1;')
+SELECT_INGEST_KEY_STATEMENT = statements.register(
+    'select_ingest_key', 'SELECT response FROM "IngestKeys" WHERE scope = %s AND idempotency_key = %s;')
+
+CLAIM_INGEST_KEYS_SQL = """
+INSERT INTO "IngestKeys" (scope, idempotency_key) VALUES %s ON CONFLICT DO NOTHING RETURNING idempotency_key;
+"""
+SAVE_INGEST_RESPONSE_SQL = 'UPDATE "IngestKeys" SET response = %s WHERE scope = %s AND idempotency_key = %s;'
+PURGE_INGEST_KEYS_SQL = 'DELETE FROM "IngestKeys" WHERE created_at < now() - %s * interval \'1 second\';'
+
+class DuplicateIngest(Exception):
+    """The request's idempotency key was already used, nothing was written."""
+
+    def __init__(self, response):
+        super().__init__('duplicate idempotency key')
+        self.response = response
+
+
+class IngestKeys:
+    """Idempotency keys of the ingest routes.
+
+    Clients may send an `Idempotency-Key` header (or an `idempotency_key`
+    field in the payload) with record_data, logs/record_data and
+    register_customer. A request whose key was seen before is answered with
+    the first response and writes nothing. Keys are claimed in "IngestKeys"
+    in the same transaction as the write, which catches retries that reach
+    another worker; the last IDEMPOTENCY_CACHE_SIZE keys are also held in
+    memory so retries to this worker never reach the database.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.cache_hits = 0
+        self.duplicates = 0
+        self.claimed = 0
+        self.purged = 0
+        self._recent = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._purger = BackgroundThread(self._run, 'ingest-keys-purge')
+
+    @staticmethod
+    def key(headers, payload):
+        """The request's key or None.
+
+        Raises:
+          ValueError: when the key is empty or too long.
+        """
+        key = headers.get('Idempotency-Key')
+        if key is None and isinstance(payload, dict):
+            key = payload.get('idempotency_key')
+        if key is None:
+            return None
+        key = str(key)
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise ValueError(f'idempotency key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+        return key
+
+    def recent(self, scope, key):
+        """The response to a recent request with this key, or None."""
+        with self._lock:
+            response = self._recent.get((scope, key))
+            if response is not None:
+                self._recent.move_to_end((scope, key))
+                self.cache_hits += 1
+            return response
+
+    def remember(self, scope, key, response=None):
+        self.ensure_started()
+        with self._lock:
+            self._recent[(scope, key)] = {} if response is None else response
+            self._recent.move_to_end((scope, key))
+            while len(self._recent) > self.size:
+                self._recent.popitem(last=False)
+
+    def claim(self, cursor, scope, key):
+        """Claims `key` within the caller's transaction.
+
+        Raises:
+          DuplicateIngest: when the key was claimed before, with its response.
+        """
+        statements.execute(cursor, CLAIM_INGEST_KEY_STATEMENT, (scope, key))
+        if cursor.fetchone() is not None:
+            with self._lock:
+                self.claimed += 1
+            return
+        statements.execute(cursor, SELECT_INGEST_KEY_STATEMENT, (scope, key))
+        row = cursor.fetchone()
+        response = self.parse_response(row[0] if row is not None else None)
+        self.remember(scope, key, response)
+        with self._lock:
+            self.duplicates += 1
+        raise DuplicateIngest(response)
+
+    def claim_many(self, cursor, scope, keys):
+        """Claims `keys` within the caller's transaction, returns the ones that were new."""
+        unique = set(keys)
+        if not unique:
+            return set()
+        rows = psycopg2.extras.execute_values(
+            cursor, CLAIM_INGEST_KEYS_SQL, [(scope, key) for key in unique], page_size=len(unique), fetch=True)
+        claimed = {row[0] for row in rows}
+        with self._lock:
+            self.claimed += len(claimed)
+            self.duplicates += len(keys) - len(claimed)
+        return claimed
+
+    def save_response(self, cursor, scope, key, response):
+        """Stores the response replayed to later requests with `key`, when it is not {}."""
+        cursor.execute(SAVE_INGEST_RESPONSE_SQL, (json.dumps(response), scope, key))
+
+    @staticmethod
+    def parse_response(value):
+        # psycopg2 decodes jsonb, asyncpg hands it over as text
+        if value is None:
+            return {}
+        return json.loads(value) if isinstance(value, str) else value
+
+    def purge(self):
+        with pool.connection() as conn:
+          cursor = conn.cursor()
+          cursor.execute(PURGE_INGEST_KEYS_SQL, (IDEMPOTENCY_KEY_TTL,))
+          purged = cursor.rowcount
+          cursor.close()
+          conn.commit()
+        with self._lock:
+            self.purged += purged
+
+    def ensure_started(self):
+        self._purger.ensure_started()
+
+    def _run(self):
+        while True:
+            time.sleep(IDEMPOTENCY_PURGE_INTERVAL)
+            try:
+                self.purge()
+            except Exception as e:
+                logger.error('idempotency keys purge error: %s', e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'recent': len(self._recent),
+                'cache_hits': self.cache_hits,
+                'claimed': self.claimed,
+                'duplicates': self.duplicates,
+                'purged': self.purged,
+            }
+
+
+ingest_keys = IngestKeys(IDEMPOTENCY_CACHE_SIZE)
+
+def replayed(response):
+    return response, 200, {'Idempotent-Replayed': 'true'}
+
+def ingest_key_check(headers, scope, payload):
+    """Reads the request's idempotency key.
+
+    Returns:
+      (key, response): response is what to answer right away, for an invalid
+      key or one this worker saw recently, otherwise None.
+    """
+    try:
+      key = ingest_keys.key(headers, payload)
+    except ValueError as e:
+      return None, ({'error': str(e)}, 400)
+    if key is None:
+      return None, None
+    response = ingest_keys.recent(scope, key)
+    if response is not None:
+      return key, replayed(response)
+    return key, None
+
+
+# ---- customer registration -----
+
+INSERT_DEVICE_STATEMENTS = {
+    'Devices': statements.register(
+        'insert_device', 'INSERT INTO "Devices" (device_id, company, department) VALUES (%s, %s, %s) '
+                         'ON CONFLICT (device_id) DO NOTHING RETURNING id;'),
+    'DemoDevices': statements.register(
+        'insert_demo_device', 'INSERT INTO "DemoDevices" (device_id, company, department) VALUES (%s, %s, %s) '
+                              'ON CONFLICT (device_id) DO NOTHING RETURNING id;'),
+}
+
+NOTIFY_STATEMENT = statements.register('notify', 'SELECT pg_notify(%s, %s);')
 
 @app.route('/register_customer', methods=["POST"])
 def register_customer():
+    key, response = ingest_key_check(request.headers, 'Devices', request.json)
+    if response is not None:
+      return response
+
     conn = pool.getconn()
 
     try:
       cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
       payload = request.json
-      print(payload)
-      cursor.execute('''
-      INSERT INTO "Devices" (device_id, company, department)
-      VALUES (%s, %s, %s)
-      RETURNING id;
-      ''', (payload['device_id'], payload['company'].replace(u'\xa0', u' '), payload['department'].replace(u'\xa0', u' ')))
-      # answer_id = cursor.fetchone()[0]
+      log_payload('register customer', payload)
+      if key is not None:
+        ingest_keys.claim(cursor, 'Devices', key)
+      # a device registered before is left as it is
+      statements.execute(cursor, INSERT_DEVICE_STATEMENTS['Devices'], (payload['device_id'], payload['company'].replace(u'\xa0', u' '), payload['department'].replace(u'\xa0', u' ')))
+      if cursor.fetchone() is not None:
+        # delivered on commit, so a connected /events client gets its first question
+        statements.execute(cursor, NOTIFY_STATEMENT, (RELOAD_CHANNEL, 'device:' + payload['device_id']))
       cursor.close()
       conn.commit()
+      if key is not None:
+        ingest_keys.remember('Devices', key)
+    except DuplicateIngest as e:
+      conn.rollback()
+      return replayed(e.response)
     except Exception as e:
-      print(e)
+      logger.error('customer registration error: %s', e)
       conn.rollback()
       server_logs(payload['device_id'],'Customer registration',str(e) )
     finally:
       pool.putconn(conn)
+      device_cache.invalidate(('Devices', payload['device_id']))
     return {}
 
 @app.route('/demo/register_customer', methods=["POST"])
 def demo_register_customer():
+    key, response = ingest_key_check(request.headers, 'DemoDevices', request.json)
+    if response is not None:
+      return response
+
     conn = pool.getconn()
 
     try:
       cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
       payload = request.json
-      print('demo register customer')
-      print(payload)
-      cursor.execute('''
-      INSERT INTO "DemoDevices" (device_id, company, department)
-      VALUES (%s, %s, %s)
-      RETURNING id;
-      ''', (payload['device_id'], payload['company'].replace(u'\xa0', u' '), payload['department'].replace(u'\xa0', u' ')))
-      # answer_id = cursor.fetchone()[0]
+      log_payload('demo register customer', payload)
+      if key is not None:
+        ingest_keys.claim(cursor, 'DemoDevices', key)
+      statements.execute(cursor, INSERT_DEVICE_STATEMENTS['DemoDevices'], (payload['device_id'], payload['company'].replace(u'\xa0', u' '), payload['department'].replace(u'\xa0', u' ')))
       cursor.close()
       conn.commit()
+      if key is not None:
+        ingest_keys.remember('DemoDevices', key)
+    except DuplicateIngest as e:
+      conn.rollback()
+      return replayed(e.response)
     except Exception as e:
-      print(e)
+      logger.error('demo customer registration error: %s', e)
       conn.rollback()
       server_logs(payload['device_id'],'Demo Customer register',str(e) )
     finally:
       pool.putconn(conn)
+      device_cache.invalidate(('DemoDevices', payload['device_id']))
     return {}
 
-@app.route('/record_data', methods=["POST"])
-def record_data():
-    conn = pool.getconn()
+# ---- answers ingestion -----
+
+# Upper bound on answers accepted in one batched request, keeps the
+# multi-row INSERT statement a reasonable size
+MAX_ANSWER_BATCH = int(os.getenv('MAX_ANSWER_BATCH', '1000'))
+
+ANSWER_FIELDS = ('device_id', 'question_id', 'answer')
+
+INSERT_ANSWER_STATEMENTS = {
+    'Answers': statements.register(
+        'insert_answer', 'INSERT INTO "Answers" (device_id, question_id, answer) VALUES (%s, %s, %s) RETURNING id;'),
+    'DemoAnswers': statements.register(
+        'insert_demo_answer', 'INSERT INTO "DemoAnswers" (device_id, question_id, answer) VALUES (%s, %s, %s) RETURNING id;'),
+}
+
+# multi-row, the VALUES list grows with the batch so it is not prepared
+INSERT_ANSWERS_SQL = {
+    'Answers': 'INSERT INTO "Answers" (device_id, question_id, answer) VALUES %s RETURNING id;',
+    'DemoAnswers': 'INSERT INTO "DemoAnswers" (device_id, question_id, answer) VALUES %s RETURNING id;',
+}
+
+def validate_answer(item):
+    """Checks a single answer payload.
+
+    Returns:
+      An error message, or None when the answer can be inserted.
+    """
+    if not isinstance(item, dict):
+        return 'answer must be an object'
+    missing = [field for field in ANSWER_FIELDS if item.get(field) is None]
+    if missing:
+        return 'missing field(s): ' + ', '.join(missing)
+    if not isinstance(item['device_id'], str):
+        return 'device_id must be a string'
+    # clients send question ids as numbers or as numeric strings
+    question_id = item['question_id']
+    if isinstance(question_id, bool) or not isinstance(question_id, (int, str)):
+        return 'question_id must be an integer'
+    if isinstance(question_id, str):
+        # int() also takes signs, spaces and underscores, and rejects "²" that isdigit() lets through
+        if not question_id.isdecimal():
+            return 'question_id must be an integer'
+        try:
+            int(question_id)
+        except ValueError:
+            return 'question_id must be an integer'
+    if not isinstance(item['answer'], str):
+        return 'answer must be a string'
+    return None
+
+def insert_answers_one_by_one(cursor, table, rows, positions, results, source_details):
+    """Inserts `rows` one at a time, each under a savepoint so a bad row only rejects itself."""
+    for index, row in zip(positions, rows):
+        cursor.execute('SAVEPOINT answer_row;')
+        try:
+            statements.execute(cursor, INSERT_ANSWER_STATEMENTS[table], row)
+            results[index] = {'id': cursor.fetchone()[0]}
+            cursor.execute('RELEASE SAVEPOINT answer_row;')
+        # ValueError: values psycopg2 cannot send, such as NUL characters
+        except (psycopg2.Error, ValueError) as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT answer_row;')
+            results[index] = {'error': str(e).strip()}
+            server_logs(row[0], source_details, str(e))
+
+def record_answers(table, items, source_details, key=None):
+    """Writes a batch of answers to `table` with one multi-row INSERT.
+
+    Invalid items are reported and skipped, the valid ones are inserted in a
+    single transaction so a wave of answers costs one round trip and one commit.
+    When the database still rejects the batch, its rows are retried one by one
+    so only the rows it rejects get an error.
+
+    Args:
+      table: "Answers" or "DemoAnswers".
+      items: list of answer payloads.
+      source_details: label used when the failure is written to ServerLogs.
+      key: the request's idempotency key, if any.
+
+    Returns:
+      A list with one {'id': ...} or {'error': ...} entry per item, in order.
+
+    Raises:
+      DuplicateIngest: when `key` was used before, nothing is inserted.
+    """
+    if table == 'Answers':
+        answer_rollups.ensure_started()
+    results = [None] * len(items)
+    rows = []
+    positions = []
+    for index, item in enumerate(items):
+        error = validate_answer(item)
+        if error is not None:
+            results[index] = {'error': error}
+            continue
+        rows.append((item['device_id'], int(item['question_id']), item['answer']))
+        positions.append(index)
 
+    if not rows:
+        return results
+
+    conn = pool.getconn()
     try:
-      payload = request.json
-      print(payload)
-      cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-      cursor.execute('''
-      INSERT INTO "Answers" (device_id, question_id, answer)
-      VALUES (%s, %s, %s)
-      RETURNING id;
-      ''', (payload['device_id'], payload['question_id'], payload['answer']))
-      answer_id = cursor.fetchone()[0]
+      cursor = conn.cursor()
+      if key is not None:
+        ingest_keys.claim(cursor, table, key)
+      cursor.execute('SAVEPOINT answer_batch;')
+      try:
+        # page_size covers the whole batch so this is a single statement, and the
+        # RETURNING rows come back in VALUES order
+        ids = psycopg2.extras.execute_values(cursor, INSERT_ANSWERS_SQL[table], rows, page_size=len(rows), fetch=True)
+        for index, row in zip(positions, ids):
+            results[index] = {'id': row[0]}
+      except (psycopg2.Error, ValueError) as e:
+        logger.warning('answer batch insert error, retrying row by row: %s', e)
+        cursor.execute('ROLLBACK TO SAVEPOINT answer_batch;')
+        insert_answers_one_by_one(cursor, table, rows, positions, results, source_details)
+      if key is not None:
+        ingest_keys.save_response(cursor, table, key, {'results': results})
       cursor.close()
       conn.commit()
-      print(f"Answer inserted with id: {answer_id}")
-      return {}
+      if key is not None:
+        ingest_keys.remember(table, key, {'results': results})
+      logger.debug('%d answers recorded into %s', len(rows), table)
+    except DuplicateIngest:
+      conn.rollback()
+      raise
     except Exception as e:
-      print(e)
+      logger.error('answer batch recording error: %s', e)
       conn.rollback()
-      cursor.close()
-      server_logs(payload['device_id'],'Answer recording',str(e) )
+      for index in positions:
+          results[index] = {'error': str(e)}
+      # the connection failed, not a row, the batch is reported once per device
+      for device_id in sorted({row[0] for row in rows}):
+          server_logs(device_id, source_details, str(e))
     finally:
       pool.putconn(conn)
-    return {}
+    return results
+
+def answers_batch_response(table, payload, source_details):
+    """Builds the response for a batched answers request."""
+    key, response = ingest_key_check(request.headers, table, payload)
+    if response is not None:
+        return response
+    answers = payload.get('answers') if isinstance(payload, dict) else payload
+    if not isinstance(answers, list):
+        return jsonify({'error': 'expected a list of answers'}), 400
+    if len(answers) > MAX_ANSWER_BATCH:
+        return jsonify({'error': f'at most {MAX_ANSWER_BATCH} answers per request'}), 413
+    try:
+        results = record_answers(table, answers, source_details, key)
+    except DuplicateIngest as e:
+        return replayed(e.response)
+    return jsonify({'results': results})
 
-@app.route('/demo/record_data', methods=["POST"])
-def demo_record_data():
+@app.route('/record_data/batch', methods=["POST"])
+def record_data_batch():
+    return answers_batch_response('Answers', request.json, 'Answer batch recording')
+
+@app.route('/demo/record_data/batch', methods=["POST"])
+def demo_record_data_batch():
+    return answers_batch_response('DemoAnswers', request.json, 'Demo Answer batch recording')
+
+@app.route('/record_data', methods=["POST"])
+def record_data():
+    # a list of answers is recorded in batched mode
+    if isinstance(request.json, list):
+      return answers_batch_response('Answers', request.json, 'Answer batch recording')
+
+    key, response = ingest_key_check(request.headers, 'Answers', request.json)
+    if response is not None:
+      return response
+
+    # every worker that takes answers folds them into the rollups
+    answer_rollups.ensure_started()
     conn = pool.getconn()
 
     try:
       payload = request.json
-      print('demo answer')
-      print(payload)
+      log_payload('answer', payload)
       cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-      cursor.execute('''
-      INSERT INTO "DemoAnswers" (device_id, question_id, answer)
-      VALUES (%s, %s, %s)
-      RETURNING id;
-      ''', (payload['device_id'], payload['question_id'], payload['answer']))
+      if key is not None:
+        ingest_keys.claim(cursor, 'Answers', key)
+      statements.execute(cursor, INSERT_ANSWER_STATEMENTS['Answers'], (payload['device_id'], payload['question_id'], payload['answer']))
       answer_id = cursor.fetchone()[0]
       cursor.close()
       conn.commit()
-      print(f"Answer inserted with id: {answer_id}")
+      if key is not None:
+        ingest_keys.remember('Answers', key)
+      logger.debug('answer inserted with id %s', answer_id)
       return {}
+    except DuplicateIngest as e:
+      conn.rollback()
+      return replayed(e.response)
     except Exception as e:
-      print(e)
+      logger.error('answer recording error: %s', e)
       conn.rollback()
       cursor.close()
-      server_logs(payload['device_id'],'Demo Answer recording',str(e) )
+      server_logs(payload['device_id'],'Answer recording',str(e) )
     finally:
       pool.putconn(conn)
     return {}
 
+@app.route('/demo/record_data', methods=["POST"])
+def demo_record_data():
+    if isinstance(request.json, list):
+      return answers_batch_response('DemoAnswers', request.json, 'Demo Answer batch recording')
 
+    key, response = ingest_key_check(request.headers, 'DemoAnswers', request.json)
+    if response is not None:
+      return response
 
-
-@app.route('/logs/record_data', methods=["POST"])
-def logs_record_data():
     conn = pool.getconn()
 
     try:
-
-      
-
       payload = request.json
-      print('logs save')
-      # return print(payload)
+      log_payload('demo answer', payload)
       cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-      cursor.execute('SELECT * FROM "Devices" where device_id=\'{}\';'.format(  #enable
-        payload['device_id']
-      ))
-
-      device_data = cursor.fetchone()
-
-      # db Logs layout rows slightly differs from Logsdemo layout
-      device_id= device_data[1]
-      company= device_data[2]
-      department= device_data[3]
-      prompt_group= device_data[5]
-      prompt_id=payload['prompt_id']
-      answer=payload['answer']
-      recived_status=payload['recieved_status']
-      error_log=payload['error_log']
-
-      cursor.execute('''
-      INSERT INTO "Logs" (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log )
-      VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-      ''', (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log))
-      # result = cursor.fetchone()
+      if key is not None:
+        ingest_keys.claim(cursor, 'DemoAnswers', key)
+      statements.execute(cursor, INSERT_ANSWER_STATEMENTS['DemoAnswers'], (payload['device_id'], payload['question_id'], payload['answer']))
+      answer_id = cursor.fetchone()[0]
       cursor.close()
       conn.commit()
-      # print(f"Logs added: {result}")
+      if key is not None:
+        ingest_keys.remember('DemoAnswers', key)
+      logger.debug('answer inserted with id %s', answer_id)
       return {}
+    except DuplicateIngest as e:
+      conn.rollback()
+      return replayed(e.response)
     except Exception as e:
-      print('logs add error : ',e)
+      logger.error('demo answer recording error: %s', e)
       conn.rollback()
       cursor.close()
-      server_logs(device_id,'App logs recording',str )
+      server_logs(payload['device_id'],'Demo Answer recording',str(e) )
     finally:
       pool.putconn(conn)
     return {}
 
 
-@app.route('/demo/logs/record_data', methods=["POST"])
-def demo_logs_record_data():
-    conn = pool.getconn()
-
+# ---- answer rollups -----
+
+# answers younger than this are left for the next refresh: an INSERT that is
+# still running may hold a lower id than rows already committed
+ROLLUP_LAG = int(os.getenv('ROLLUP_LAG', '60'))
+ROLLUP_INTERVAL = float(os.getenv('ROLLUP_INTERVAL', '30'))
+ROLLUP_BATCH_SIZE = int(os.getenv('ROLLUP_BATCH_SIZE', '50000'))
+
+ROLLUP_COLUMNS = ('company', 'department', 'question_id', 'answer', 'answer_date')
+ROLLUP_DEFAULT_GROUP_BY = ('company', 'department', 'question_id', 'answer')
+
+# the watermark row doubles as the lock: a worker that finds it locked leaves
+# the batch to the one holding it
+LOCK_ROLLUP_WATERMARK_SQL = """
+INSERT INTO "RollupWatermarks" (name, last_id) VALUES (%(name)s, 0) ON CONFLICT DO NOTHING;
+SELECT last_id FROM "RollupWatermarks" WHERE name = %(name)s FOR UPDATE SKIP LOCKED;
+"""
+
+ROLLUP_BOUNDS_SQL = """
+SELECT (SELECT max(id) FROM (SELECT id FROM "Answers" WHERE id > %(last_id)s ORDER BY id LIMIT %(batch)s) AS batch),
+       (SELECT min(id) FROM "Answers" WHERE id > %(last_id)s AND created_at > now() - %(lag)s * interval '1 second');
+"""
+
+# answers are counted under the device's current company and department,
+# those of unregistered devices under ''
+ROLLUP_ANSWERS_SQL = """
+INSERT INTO "AnswerRollups" (company, department, question_id, answer, answer_date, answers)
+SELECT coalesce(device.company, ''), coalesce(device.department, ''), answer.question_id::text,
+       coalesce(answer.answer, ''), coalesce(answer.created_at, now())::date, count(*)
+FROM "Answers" answer LEFT JOIN "Devices" device ON device.device_id = answer.device_id
+WHERE answer.id > %s AND answer.id <= %s
+GROUP BY 1, 2, 3, 4, 5
+ON CONFLICT (company, department, question_id, answer, answer_date)
+DO UPDATE SET answers = "AnswerRollups".answers + EXCLUDED.answers;
+"""
+
+class AnswerRollups:
+    """Keeps "AnswerRollups" up to date from new "Answers" rows.
+
+    Answers are counted per company, department, question, answer and day,
+    so dashboards read a row per group instead of scanning "Answers". A
+    background thread folds the rows above the watermark in "RollupWatermarks"
+    into the counts, in batches of ROLLUP_BATCH_SIZE, every ROLLUP_INTERVAL
+    seconds; each batch and its watermark move commit together, and only one
+    worker applies a batch at a time.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.groups_updated = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_id = None
+        self.last_refresh = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._refresher = BackgroundThread(self._run, 'answer-rollups')
+
+    def refresh_batch(self):
+        """Folds one batch into the counts.
+
+        Returns:
+          True when the watermark moved, there may be more rows waiting.
+        """
+        with pool.connection() as conn:
+          cursor = conn.cursor()
+          cursor.execute(LOCK_ROLLUP_WATERMARK_SQL, {'name': self.name})
+          row = cursor.fetchone()
+          if row is None:
+              conn.rollback()
+              with self._lock:
+                  self.skipped += 1
+              return False
+          last_id = row[0]
+          cursor.execute(ROLLUP_BOUNDS_SQL, {'last_id': last_id, 'batch': ROLLUP_BATCH_SIZE, 'lag': ROLLUP_LAG})
+          upper, recent = cursor.fetchone()
+          if upper is not None and recent is not None:
+              upper = min(upper, recent - 1)
+          if upper is None or upper <= last_id:
+              conn.rollback()
+              with self._lock:
+                  self.last_id = last_id
+                  self.last_refresh = time.time()
+              return False
+          cursor.execute(ROLLUP_ANSWERS_SQL, (last_id, upper))
+          groups = cursor.rowcount
+          cursor.execute('UPDATE "RollupWatermarks" SET last_id = %s, updated_at = now() WHERE name = %s;',
+                         (upper, self.name))
+          cursor.close()
+          conn.commit()
+        with self._lock:
+            self.batches += 1
+            self.groups_updated += groups
+            self.last_id = upper
+            self.last_refresh = time.time()
+        logger.debug('answer rollups advanced to id %s, %d groups updated', upper, groups)
+        return True
+
+    def refresh(self):
+        while self.refresh_batch():
+            pass
+
+    def rebuild(self):
+        """Clears the counts and rewinds the watermark, the thread then recounts every answer."""
+        with pool.connection() as conn:
+          cursor = conn.cursor()
+          cursor.execute('INSERT INTO "RollupWatermarks" (name, last_id) VALUES (%s, 0) ON CONFLICT DO NOTHING;',
+                         (self.name,))
+          # waits for a batch in progress instead of skipping it
+          cursor.execute('SELECT 1 FROM "RollupWatermarks" WHERE name = %s FOR UPDATE;', (self.name,))
+          cursor.execute('DELETE FROM "AnswerRollups";')
+          cursor.execute('UPDATE "RollupWatermarks" SET last_id = 0, updated_at = now() WHERE name = %s;',
+                         (self.name,))
+          cursor.close()
+          conn.commit()
+        self.ensure_started()
+        self._wake.set()
+
+    def ensure_started(self):
+        self._refresher.ensure_started()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error('answer rollups refresh error: %s', e)
+                with self._lock:
+                    self.failures += 1
+            self._wake.wait(ROLLUP_INTERVAL)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'last_id': self.last_id,
+                'last_refresh': self.last_refresh,
+                'batches': self.batches,
+                'groups_updated': self.groups_updated,
+                'skipped': self.skipped,
+                'failures': self.failures,
+            }
+
+
+answer_rollups = AnswerRollups('answers')
+
+def answer_rollups_query(args):
+    """Builds the aggregate over "AnswerRollups" for the /rollups/answers filters.
+
+    Raises:
+      ValueError: on an unknown group_by column.
+    """
+    group_by = tuple(args.get('group_by', ','.join(ROLLUP_DEFAULT_GROUP_BY)).split(','))
+    unknown = [column for column in group_by if column not in ROLLUP_COLUMNS]
+    if unknown or not group_by:
+        raise ValueError('group_by takes ' + ', '.join(ROLLUP_COLUMNS))
+
+    clauses = []
+    params = []
+    for column in ('company', 'department', 'question_id', 'answer'):
+        if args.get(column) is not None:
+            clauses.append(psycopg2.sql.SQL('{} = %s').format(psycopg2.sql.Identifier(column)))
+            params.append(args[column])
+    if args.get('since'):
+        clauses.append(psycopg2.sql.SQL('answer_date >= %s'))
+        params.append(args['since'])
+    if args.get('until'):
+        clauses.append(psycopg2.sql.SQL('answer_date < %s'))
+        params.append(args['until'])
+
+    columns = psycopg2.sql.SQL(', ').join(psycopg2.sql.Identifier(column) for column in group_by)
+    query = psycopg2.sql.SQL('SELECT {}, sum(answers)::bigint AS answers FROM "AnswerRollups"').format(columns)
+    if clauses:
+        query += psycopg2.sql.SQL(' WHERE ') + psycopg2.sql.SQL(' AND ').join(clauses)
+    query += psycopg2.sql.SQL(' GROUP BY {} ORDER BY {}').format(columns, columns)
+    return query, params, group_by
+
+@app.route('/rollups/answers', methods=["GET"])
+def answer_rollups_view():
+    """Answer counts grouped by `group_by` (default company,department,question_id,answer).
+
+    Filters: company, department, question_id, answer, and since/until
+    (dates, until exclusive). `last_id` and `as_of` tell how far the counts
+    have caught up with "Answers".
+    """
+    answer_rollups.ensure_started()
     try:
+      query, params, group_by = answer_rollups_query(request.args)
+    except ValueError as e:
+      return jsonify({'error': str(e)}), 400
 
-      
+    try:
+      with pool.connection() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(query, params)
+        groups = [dict(row) for row in cursor.fetchall()]
+        cursor.execute('SELECT last_id, updated_at FROM "RollupWatermarks" WHERE name = %s;', (answer_rollups.name,))
+        watermark = cursor.fetchone()
+        cursor.close()
+        conn.commit()
+    except Exception as e:
+      logger.error('answer rollups view error: %s', e)
+      server_logs('n/a', 'Answer rollups viewing function', str(e))
+      return {}
 
-      payload = request.json
-      print('demo logs save')
-      # return print(payload)
+    if 'answer_date' in group_by:
+      for group in groups:
+          group['answer_date'] = group['answer_date'].isoformat()
+    return jsonify({
+        'group_by': list(group_by),
+        'groups': groups,
+        'last_id': watermark['last_id'] if watermark else 0,
+        'as_of': watermark['updated_at'].isoformat() if watermark and watermark['updated_at'] else None,
+    })
+
+@app.route('/admin/rollups/answers/rebuild', methods=["POST"])
+def rebuild_answer_rollups():
+    """Recounts every answer, e.g. after devices were moved to another department."""
+    try:
+      answer_rollups.rebuild()
+    except Exception as e:
+      logger.error('answer rollups rebuild error: %s', e)
+      server_logs('n/a', 'Answer rollups rebuild', str(e))
+      return jsonify({'error': str(e)}), 500
+    return jsonify({'rebuilding': True}), 202
+
+
+# ---- popup acknowledgements -----
+
+def is_received(status):
+    """Clients send recieved_status either as a boolean or as the string 'true'."""
+    return str(status).lower() == 'true'
+
+INSERT_ACKS_SQL = 'INSERT INTO "LogAcknowledgements" (device_id, ack_date) VALUES %s ON CONFLICT DO NOTHING;'
+
+# seeds today's rollup from "Logs" with a range scan rather than a cast on created_at
+BACKFILL_ACKS_SQL = """
+INSERT INTO "LogAcknowledgements" (device_id, ack_date)
+SELECT DISTINCT device_id, %s::date FROM "Logs"
+WHERE created_at >= %s AND created_at < %s AND recived_status = 'true'
+ON CONFLICT DO NOTHING;
+"""
+
+SELECT_ACK_STATEMENT = statements.register(
+    'select_ack', 'SELECT 1 FROM "LogAcknowledgements" WHERE device_id=%s AND ack_date=%s;')
+
+class AckTracker:
+    """Remembers which devices acknowledged a popup today.
+
+    Backed by the "LogAcknowledgements" rollup that the log writers fill in as
+    they insert into "Logs". Today's set is held in memory; a device missing
+    from it is confirmed with a primary-key lookup, since another worker may
+    have written the acknowledgement.
+    """
+
+    def __init__(self):
+        self._day = None
+        self._devices = set()
+        self._lock = threading.Lock()
+
+    def _devices_for(self, day):
+        # callers hold self._lock; the set starts over when the day changes
+        if self._day != day:
+            self._day = day
+            self._devices = set()
+        return self._devices
+
+    def record(self, device_ids, day=None):
+        day = day or datetime.date.today()
+        with self._lock:
+            # a late write for a day that already ended is not kept
+            if self._day is None or day >= self._day:
+                self._devices_for(day).update(device_ids)
+
+    def contains(self, device_id, day):
+        """Checks the in-memory set only."""
+        with self._lock:
+            return device_id in self._devices_for(day)
+
+    def acknowledged(self, cursor, device_id):
+        today = datetime.date.today()
+        if self.contains(device_id, today):
+            return True
+        with timed_query('popup_check'):
+            statements.execute(cursor, SELECT_ACK_STATEMENT, (device_id, today))
+            row = cursor.fetchone()
+        if row is None:
+            return False
+        self.record([device_id], today)
+        return True
+
+    def rebuild(self):
+        """Reloads today's set, backfilling the rollup from today's "Logs" rows."""
+        today = datetime.date.today()
+        with pool.connection() as conn:
+          cursor = conn.cursor()
+          cursor.execute(BACKFILL_ACKS_SQL, (today, today, today + datetime.timedelta(days=1)))
+          cursor.execute('SELECT device_id FROM "LogAcknowledgements" WHERE ack_date=%s;', (today,))
+          devices = {row[0] for row in cursor.fetchall()}
+          cursor.close()
+          conn.commit()
+        with self._lock:
+            self._devices_for(today).update(devices)
+
+    def stats(self):
+        with self._lock:
+            return {'day': str(self._day), 'devices': len(self._devices)}
+
+
+ack_tracker = AckTracker()
+
+try:
+  ack_tracker.rebuild()
+except Exception as e:
+  logger.error('acknowledgements rebuild error: %s', e)
+
+# ---- write-behind logs ingestion -----
+
+class WriteBehindQueue:
+    """Bounded in-process queue that a background thread drains in batches.
+
+    Producers call put() and return immediately; the flusher hands batches to
+    `flush` once `batch_size` items are waiting or `interval` seconds have
+    passed since the first one arrived. When the queue is full new items are
+    dropped and counted so a slow database pushes back on clients instead of
+    piling up memory.
+    """
+
+    def __init__(self, name, flush, max_size, batch_size, interval):
+        self.name = name
+        self.flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_size)
+        self.enqueued = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        self._flusher = BackgroundThread(self._run, name)
+
+    def put(self, item):
+        """Enqueues an item, returns False when it was dropped."""
+        self._flusher.ensure_started()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _next_batch(self, block):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.interval) if block else self.queue.get_nowait())
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if block and remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.flush(batch)
+            with self._lock:
+                self.flushed += len(batch)
+                self.batches += 1
+        except Exception as e:
+            logger.error('%s flush error: %s', self.name, e)
+            with self._lock:
+                self.failed += len(batch)
+
+    def _run(self):
+        while not self._flusher.stopping.is_set():
+            batch = self._next_batch(block=True)
+            if batch:
+                self._write(batch)
+        # drain whatever is left once asked to stop
+        while True:
+            batch = self._next_batch(block=False)
+            if not batch:
+                break
+            self._write(batch)
+
+    def close(self, timeout=10):
+        """Stops the flusher after it has written everything still queued."""
+        self._flusher.stop(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self.queue.qsize(),
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'flushed': self.flushed,
+                'failed': self.failed,
+                'batches': self.batches,
+            }
+
+
+LOGS_QUEUE_MAX_SIZE = int(os.getenv('LOGS_QUEUE_MAX_SIZE', '10000'))
+LOGS_FLUSH_BATCH_SIZE = int(os.getenv('LOGS_FLUSH_BATCH_SIZE', '500'))
+LOGS_FLUSH_INTERVAL = float(os.getenv('LOGS_FLUSH_INTERVAL', '1.0'))
+
+LOG_FIELDS = ('device_id', 'prompt_id', 'answer', 'recieved_status', 'error_log')
+
+LOG_DEVICES_TABLE = {
+    'Logs': 'Devices',
+    'DemoLogs': 'DemoDevices',
+}
+
+SELECT_LOG_DEVICES_STATEMENTS = {
+    'Logs': statements.register('select_log_devices', 'SELECT * FROM "Devices" WHERE device_id = ANY(%s);'),
+    'DemoLogs': statements.register('select_demo_log_devices', 'SELECT * FROM "DemoDevices" WHERE device_id = ANY(%s);'),
+}
+
+INSERT_LOGS_SQL = {
+    'Logs': 'INSERT INTO "Logs" (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log) VALUES %s;',
+    'DemoLogs': 'INSERT INTO "DemoLogs" (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log) VALUES %s;',
+}
+
+def write_logs(table, entries, source_details):
+    """Writes a batch of client log entries to `table` in one transaction.
+
+    The device columns are looked up once for the whole batch, entries from
+    devices that are not registered are skipped and reported to ServerLogs.
+    Entries whose idempotency key was used before are skipped as well.
+    """
+    conn = pool.getconn()
+    try:
       cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-      cursor.execute('SELECT * FROM "DemoDevices" where device_id=\'{}\';'.format(  #enable
-        payload['device_id']
-      ))
-
-      device_data = cursor.fetchone()
-
-      # return print(device_data)
-
-      device_id= device_data[0]
-      company= device_data[1]
-      department= device_data[2]
-      prompt_group= device_data[4]
-      prompt_id=payload['prompt_id']
-      answer=payload['answer']
-      recived_status=payload['recieved_status']
-      error_log=payload['error_log']
-
-      cursor.execute('''
-      INSERT INTO "DemoLogs" (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log )
-      VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-      ''', (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log))
-      # result = cursor.fetchone()
+      devices_table = LOG_DEVICES_TABLE[table]
+      devices = {}
+      missing = set()
+      for device_id in {entry['device_id'] for entry in entries}:
+        device, found = device_cache.get((devices_table, device_id))
+        if found:
+          devices[device_id] = device
+        else:
+          missing.add(device_id)
+
+      if missing:
+        generation = device_cache.generation()
+        statements.execute(cursor, SELECT_LOG_DEVICES_STATEMENTS[table], (list(missing),))
+        fetched = {row['device_id']: dict(row) for row in cursor.fetchall()}
+        for device_id in missing:
+          devices[device_id] = fetched.get(device_id)
+          device_cache.put((devices_table, device_id), devices[device_id], generation)
+
+      keys = [entry['idempotency_key'] for entry in entries if entry.get('idempotency_key') is not None]
+      claimed = ingest_keys.claim_many(cursor, table, keys)
+
+      rows = []
+      unknown = set()
+      for entry in entries:
+        key = entry.get('idempotency_key')
+        if key is not None:
+          if key not in claimed:
+            continue
+          # the first of several retries queued together
+          claimed.discard(key)
+        device = devices.get(entry['device_id'])
+        if device is None:
+          unknown.add(entry['device_id'])
+          continue
+        rows.append((device['device_id'], device['company'], device['department'], device['prompt_group'],
+                     entry['prompt_id'], entry['answer'], entry['recieved_status'], entry['error_log']))
+
+      acks = set()
+      if table == 'Logs':
+        acks = {row[0] for row in rows if is_received(row[6])}
+
+      if rows:
+        with timed_query('log_insert'):
+          psycopg2.extras.execute_values(cursor, INSERT_LOGS_SQL[table], rows, page_size=len(rows))
+      if acks:
+        ack_day = datetime.date.today()
+        psycopg2.extras.execute_values(cursor, INSERT_ACKS_SQL, [(device_id, ack_day) for device_id in acks])
       cursor.close()
       conn.commit()
-      # print(f"Logs added: {result}")
-      return {}
+      if acks:
+        ack_tracker.record(acks, ack_day)
+      # claimed by this batch or committed before it, retries of them can be acknowledged
+      for key in keys:
+        ingest_keys.remember(table, key)
     except Exception as e:
-      print('logs add error : ',e)
       conn.rollback()
-      cursor.close()
-      server_logs(device_id,'Demo App logs recording',str(e))
+      server_logs('n/a', source_details, str(e))
+      raise
     finally:
       pool.putconn(conn)
-    return {}
 
-@app.route('/logs_view', methods=["GET"])
-def logs_view():
-    conn = pool.getconn()
+    for device_id in unknown:
+      server_logs(device_id, source_details, 'device is not registered')
+
+logs_queue = WriteBehindQueue(
+    'logs-writer',
+    lambda entries: write_logs('Logs', entries, 'App logs recording'),
+    LOGS_QUEUE_MAX_SIZE, LOGS_FLUSH_BATCH_SIZE, LOGS_FLUSH_INTERVAL)
+
+demo_logs_queue = WriteBehindQueue(
+    'demo-logs-writer',
+    lambda entries: write_logs('DemoLogs', entries, 'Demo App logs recording'),
+    LOGS_QUEUE_MAX_SIZE, LOGS_FLUSH_BATCH_SIZE, LOGS_FLUSH_INTERVAL)
+
+LOG_QUEUE_TABLES = {
+    logs_queue.name: 'Logs',
+    demo_logs_queue.name: 'DemoLogs',
+}
+
+def enqueue_log(logs_queue, payload, source_details, headers=None):
+    """Queues a client log payload for the background writer.
+
+    A retry whose idempotency key this worker already wrote is not queued
+    again. Keys are only remembered once write_logs() committed them, so a
+    retry of an entry still queued, or lost with a failed flush, is queued
+    again; write_logs() skips the ones whose key was claimed first.
+    """
+    table = LOG_QUEUE_TABLES[logs_queue.name]
+    key, response = ingest_key_check(headers or {}, table, payload)
+    if response is not None:
+      return response
 
     try:
-      cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-      # cursor.execute('SELECT * FROM "Logs";')
-      
-      cursor.execute('SELECT * FROM "Logs" ORDER BY created_at DESC LIMIT 1000;')
+      entry = {field: payload[field] for field in LOG_FIELDS}
+    except (KeyError, TypeError) as e:
+      logger.warning('logs add error: %s', e)
+      device_id = payload.get('device_id', 'n/a') if isinstance(payload, dict) else 'n/a'
+      server_logs(device_id, source_details, f'invalid log payload: {e!r}')
+      return {}
 
-      res = jsonify(cursor.fetchall())
+    if key is not None:
+      entry['idempotency_key'] = key
+    if not logs_queue.put(entry):
+      return {'error': 'logs queue is full'}, 503, {'Retry-After': '1'}
+    return {}
 
-      cursor.close()
-      conn.commit()
+@app.route('/logs/record_data', methods=["POST"])
+def logs_record_data():
+    logger.debug('logs save')
+    return enqueue_log(logs_queue, request.json, 'App logs recording', request.headers)
 
-      return res
-    
-    except Exception as e:
-      print(e)
-      conn.rollback()
-      server_logs('n/a','Logs viewing function',str(e) )
-    finally:
-      pool.putconn(conn)
-    return {}
 
+@app.route('/demo/logs/record_data', methods=["POST"])
+def demo_logs_record_data():
+    logger.debug('demo logs save')
+    return enqueue_log(demo_logs_queue, request.json, 'Demo App logs recording', request.headers)
+
+def prometheus_metrics():
+    """Renders request, query, pool and ingestion metrics in the Prometheus text format."""
+    lines = request_latency.render() + query_latency.render()
+    lines += ['# HELP croissant_pool_wait_seconds Time spent waiting for a pooled connection.',
+              '# TYPE croissant_pool_wait_seconds histogram']
+    lines += pool_wait.render('croissant_pool_wait_seconds', '')
+
+    pool_stats = pool.stats()
+    gauges = [
+        ('croissant_pool_connections_in_use', 'gauge', 'Connections checked out of the pool.', pool_stats['in_use']),
+        ('croissant_pool_connections_idle', 'gauge', 'Idle connections in the pool.', pool_stats['idle']),
+        ('croissant_pool_connections_max', 'gauge', 'Pool size limit.', pool_stats['max']),
+        ('croissant_pool_checkout_failures_total', 'counter', 'Checkouts that timed out or failed to connect.', pool_stats['checkout_failures']),
+        ('croissant_device_cache_hits_total', 'counter', 'Device cache hits, including negative entries.',
+         device_cache.hits + device_cache.negative_hits),
+        ('croissant_device_cache_misses_total', 'counter', 'Device cache misses.', device_cache.misses),
+    ]
+    for name, metric_type, help_text, value in gauges:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+
+    lines += ['# HELP croissant_logs_queue_total Client log entries by queue and outcome.',
+              '# TYPE croissant_logs_queue_total counter']
+    for writer in (logs_queue, demo_logs_queue):
+        queue_stats = writer.stats()
+        for outcome in ('enqueued', 'dropped', 'flushed', 'failed'):
+            lines.append(f'croissant_logs_queue_total{{queue="{writer.name}",outcome="{outcome}"}} {queue_stats[outcome]}')
+
+    lines += ['# HELP croissant_server_logs_total Errors passed to server_logs() by source_details.',
+              '# TYPE croissant_server_logs_total counter']
+    for source, count in sorted(server_log_sink.stats()['by_source'].items()):
+        lines.append(f'croissant_server_logs_total{{source_details="{prometheus_escape(source)}"}} {count}')
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    return app.response_class(prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+def service_stats():
+    return {
+        'logs_queue': logs_queue.stats(),
+        'demo_logs_queue': demo_logs_queue.stats(),
+        'device_cache': device_cache.stats(),
+        'question_catalog': question_catalog.stats(),
+        'app_configuration': config_snapshot.stats(),
+        'popup_schedule': popup_schedule.stats(),
+        'acknowledgements': ack_tracker.stats(),
+        'answer_rollups': answer_rollups.stats(),
+        'idempotency_keys': ingest_keys.stats(),
+        'pool': pool.stats(),
+        'statements': statements.stats(),
+        'server_logs': server_log_sink.stats(),
+        'update_checksums': checksum_index.stats(),
+        'delta_blocks': block_index.stats(),
+        'releases': release_index.stats(),
+        'chunked_uploads': chunked_uploads.stats(),
+        'push': push_hub.stats(),
+    }
+
+@app.route('/stats', methods=["GET"])
+def stats():
+    return jsonify(service_stats())
+
+# ---- log viewer -----
+
+LOG_VIEW_DEFAULT_LIMIT = 1000
+LOG_VIEW_MAX_LIMIT = int(os.getenv('LOG_VIEW_MAX_LIMIT', '5000'))
+
+# equality filters accepted as query parameters, per table
+LOG_VIEW_FILTERS = {
+    'Logs': ('device_id', 'company', 'department', 'prompt_group', 'recived_status'),
+    'DemoLogs': ('device_id', 'company', 'department', 'prompt_group', 'recived_status'),
+    'ServerLogs': ('device_id', 'source_details'),
+}
+
+def encode_log_cursor(row):
+    value = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+def decode_log_cursor(cursor):
+    created_at, _, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().partition('|')
+    return created_at, int(row_id)
+
+def log_view_query(table, args):
+    """Builds the keyset-paginated query for a log view.
+
+    Rows are ordered newest first on (created_at, id). `before` pages towards
+    older rows, `after` returns the rows newer than a cursor in ascending order,
+    which is what an incremental refresh needs. `since`/`until` bound created_at.
+
+    Returns:
+      The query, its parameters and whether rows come back ascending.
+    """
+    clauses = []
+    params = []
+    for column in LOG_VIEW_FILTERS[table]:
+        if args.get(column) is not None:
+            clauses.append(psycopg2.sql.SQL('{} = %s').format(psycopg2.sql.Identifier(column)))
+            params.append(args[column])
+    if args.get('since'):
+        clauses.append(psycopg2.sql.SQL('created_at >= %s'))
+        params.append(args['since'])
+    if args.get('until'):
+        clauses.append(psycopg2.sql.SQL('created_at < %s'))
+        params.append(args['until'])
+
+    ascending = bool(args.get('after'))
+    if ascending:
+        clauses.append(psycopg2.sql.SQL('(created_at, id) > (%s, %s)'))
+        params.extend(decode_log_cursor(args['after']))
+    elif args.get('before'):
+        clauses.append(psycopg2.sql.SQL('(created_at, id) < (%s, %s)'))
+        params.extend(decode_log_cursor(args['before']))
+
+    query = psycopg2.sql.SQL('SELECT * FROM {}').format(psycopg2.sql.Identifier(table))
+    if clauses:
+        query += psycopg2.sql.SQL(' WHERE ') + psycopg2.sql.SQL(' AND ').join(clauses)
+    query += psycopg2.sql.SQL(' ORDER BY created_at ASC, id ASC' if ascending else ' ORDER BY created_at DESC, id DESC')
+
+    limit = args.get('limit', type=int)
+    if limit is None and args.get('format') != 'ndjson':
+        limit = LOG_VIEW_DEFAULT_LIMIT
+    if limit is not None:
+        query += psycopg2.sql.SQL(' LIMIT %s')
+        params.append(max(1, min(limit, LOG_VIEW_MAX_LIMIT)))
+    return query, params, ascending
+
+def stream_log_rows(query, params):
+    """Yields rows as NDJSON from a server-side cursor, in constant memory."""
+    with pool.connection() as conn:
+        cursor = conn.cursor(name='log_view_stream', cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = 2000
+        cursor.execute(query, params)
+        for row in cursor:
+            yield app.json.dumps(row) + '\n'
+        cursor.close()
+        conn.commit()
+
+def log_view_response(table, source_details):
+    """Serves a log table for the /logs UI and for exports.
+
+    The JSON response keeps the list-of-rows shape, with the cursors of the
+    newest and oldest rows returned in X-Newer-Cursor / X-Older-Cursor.
+    `format=ndjson` streams every matching row instead.
+    """
+    try:
+      query, params, ascending = log_view_query(table, request.args)
+    except (ValueError, UnicodeDecodeError, binascii.Error) as e:
+      return jsonify({'error': f'invalid cursor: {e}'}), 400
 
-@app.route('/demo/logs_view', methods=["GET"])
-def demo_logs_view():
-    conn = pool.getconn()
+    if request.args.get('format') == 'ndjson':
+      return app.response_class(stream_with_context(stream_log_rows(query, params)), mimetype='application/x-ndjson')
 
     try:
-      cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+      with pool.connection() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.commit()
+    except Exception as e:
+      logger.error('log view error: %s', e)
+      server_logs('n/a', source_details, str(e))
+      return {}
 
-      # cursor.execute('SELECT * FROM "Logs";')
-      
-      cursor.execute('SELECT * FROM "DemoLogs" ORDER BY created_at DESC LIMIT 1000;')
+    res = jsonify(rows)
+    if rows:
+      newest, oldest = (rows[-1], rows[0]) if ascending else (rows[0], rows[-1])
+      res.headers['X-Newer-Cursor'] = encode_log_cursor(newest)
+      res.headers['X-Older-Cursor'] = encode_log_cursor(oldest)
+    return res
 
-      res = jsonify(cursor.fetchall())
+@app.route('/logs_view', methods=["GET"])
+def logs_view():
+    return log_view_response('Logs', 'Logs viewing function')
 
-      cursor.close()
-      conn.commit()
 
-      return res
-    
-    except Exception as e:
-      print(e)
-      conn.rollback()
-      server_logs('n/a','Demo Logs viewing function',str(e))
-    finally:
-      pool.putconn(conn)
-    return {}
+@app.route('/demo/logs_view', methods=["GET"])
+def demo_logs_view():
+    return log_view_response('DemoLogs', 'Demo Logs viewing function')
 
 @app.route('/server_logs_view', methods=["GET"])
 def server_logs_view():
+    return log_view_response('ServerLogs', 'Logs viewing function')
+
+# ---- bulk export -----
+
+EXPORT_DATASETS = {
+    'answers': 'Answers',
+    'logs': 'Logs',
+    'demo_answers': 'DemoAnswers',
+}
+
+# rows newer than now() minus this lag are left for the next export, so
+# transactions still in flight when an export starts are not skipped
+EXPORT_WATERMARK_LAG = os.getenv('EXPORT_WATERMARK_LAG', '60 seconds')
+# optional read replica for exports, defaults to the primary through the pool
+EXPORT_DB_HOST = os.getenv('EXPORT_DB_HOST')
+EXPORT_MAX_CONCURRENT = int(os.getenv('EXPORT_MAX_CONCURRENT', '2'))
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+class CopyPipe:
+    """File-like sink for copy_expert() that hands chunks to the response generator.
+
+    The queue is bounded, so COPY only runs as fast as the client reads and
+    memory stays constant whatever the export size.
+    """
+
+    def __init__(self, max_chunks=16):
+        self.chunks = queue.Queue(max_chunks)
+        self.cancelled = threading.Event()
+
+    def write(self, data):
+        while True:
+            if self.cancelled.is_set():
+                raise IOError('export cancelled by the client')
+            try:
+                self.chunks.put(bytes(data), timeout=1)
+                return len(data)
+            except queue.Full:
+                continue
+
+    def finish(self, error=None):
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(error, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+def open_export_connection():
+    """Returns a connection for an export and the function that releases it."""
+    if EXPORT_DB_HOST:
+        conn = psycopg2.connect(**dict(DB_CONNECT_ARGS, host=EXPORT_DB_HOST))
+        return conn, conn.close
     conn = pool.getconn()
+    return conn, lambda: pool.putconn(conn)
 
-    try:
-      cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def export_chunks(conn, copy_sql, compress):
+    """Runs COPY on a worker thread and yields its output, gzip-compressed if asked."""
+    pipe = CopyPipe()
 
-      # cursor.execute('SELECT * FROM "Logs";')
-      
-      cursor.execute('SELECT * FROM "ServerLogs" ORDER BY created_at DESC LIMIT 1000;')
+    def produce():
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(copy_sql, pipe, size=EXPORT_CHUNK_SIZE)
+            cursor.close()
+            conn.commit()
+            pipe.finish()
+        except Exception as e:
+            pipe.finish(e)
+
+    producer = threading.Thread(target=produce, name='export-copy', daemon=True)
+    producer.start()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    try:
+        while True:
+            chunk = pipe.chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                logger.error('export error: %s', chunk)
+                server_logs('n/a', 'Data export', str(chunk))
+                raise chunk
+            yield compressor.compress(chunk) if compressor else chunk
+        if compressor:
+            yield compressor.flush()
+    finally:
+        if producer.is_alive():
+            # the client went away, stop COPY on the server
+            pipe.cancelled.set()
+            conn.cancel()
+            producer.join()
+
+@app.route('/export/<dataset>', methods=["GET"])
+def export_dataset(dataset):
+    """Streams a table as CSV produced by COPY ... TO STDOUT.
+
+    `since` exports only rows created after a previous export's watermark,
+    `until` overrides the upper bound, which defaults to now() minus
+    EXPORT_WATERMARK_LAG. The bound used is returned in X-Export-Watermark so
+    a nightly sync can pass it back as `since`. `compress=gzip` gzips the stream.
+    `since` and `until` are ISO-8601 timestamps.
+    """
+    table = EXPORT_DATASETS.get(dataset)
+    if table is None:
+      return jsonify({'error': f'unknown dataset, expected one of {sorted(EXPORT_DATASETS)}'}), 404
+    if request.args.get('compress') not in (None, '', 'gzip'):
+      return jsonify({'error': 'compress takes gzip'}), 400
+    compress = request.args.get('compress') == 'gzip'
+    bounds = {}
+    for name in ('since', 'until'):
+      if request.args.get(name):
+        try:
+          bounds[name] = datetime.datetime.fromisoformat(request.args[name])
+        except ValueError:
+          return jsonify({'error': f'{name} must be an ISO-8601 timestamp'}), 400
 
-      res = jsonify(cursor.fetchall())
+    if not export_slots.acquire(blocking=False):
+      return jsonify({'error': 'too many exports running'}), 429, {'Retry-After': '60'}
 
+    conn, release = None, None
+    try:
+      conn, release = open_export_connection()
+      cursor = conn.cursor()
+      until = bounds.get('until')
+      if until is None:
+        cursor.execute('SELECT (now() - %s::interval)::timestamp;', (EXPORT_WATERMARK_LAG,))
+        until = cursor.fetchone()[0]
+
+      query = psycopg2.sql.SQL('SELECT * FROM {} WHERE created_at <= %s').format(psycopg2.sql.Identifier(table))
+      params = [until]
+      if 'since' in bounds:
+        query += psycopg2.sql.SQL(' AND created_at > %s')
+        params.append(bounds['since'])
+      # COPY takes no bind parameters, so the query is rendered client-side
+      copy_sql = b'COPY (' + cursor.mogrify(query, params) + b') TO STDOUT WITH (FORMAT csv, HEADER)'
       cursor.close()
-      conn.commit()
-
-      return res
-    
     except Exception as e:
-      print(e)
-      conn.rollback()
-      server_logs('n/a','Logs viewing function',str(e) )
-    finally:
-      pool.putconn(conn)
-    return {}
+      if release is not None:
+        release()
+      export_slots.release()
+      logger.error('export error: %s', e)
+      server_logs('n/a', 'Data export', str(e))
+      return jsonify({'error': str(e)}), 500
+
+    def cleanup():
+      release()
+      export_slots.release()
+
+    filename = f"{dataset}-{until.strftime('%Y%m%dT%H%M%S')}.csv" + ('.gz' if compress else '')
+    res = app.response_class(
+        export_chunks(conn, copy_sql, compress),
+        mimetype='application/gzip' if compress else 'text/csv',
+        headers={
+            'Content-Disposition': f'attachment; filename={filename}',
+            'X-Export-Watermark': until.isoformat(),
+        })
+    # runs after the WSGI server closed the body, also when it was never read
+    res.call_on_close(cleanup)
+    return res
+
+def prompt_for(device):
+    """The / response for a device row, None when it is not registered."""
+    if device is None:
+      return { 'prompt_type': 'customer_register' }
+    r = question_catalog.question(device['company'], device['department'], device['prompt_group'])
+    if r is None:
+      return {}
+    return dict(r)
 
 @app.route('/')
 def index():
@@ -337,116 +2585,86 @@ def index():
 
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    cursor.execute('SELECT * FROM "Devices" where device_id=\'{}\';'.format(  #enable
-      device_id
-    ))
-
-    # cursor.execute('SELECT * FROM "Devices"')
-
-    device = cursor.fetchone()
+    device = lookup_device(cursor, 'Devices', device_id)
 
-    print(device)
+    logger.debug('device', extra={'fields': {'device': device}})
 
-    if device is None:
-      return { 'prompt_type': 'customer_register' }
-
-    # Check if 'prompt_group' exists and set it to 1 if not 
-    if 'prompt_group' not in device or device['prompt_group'] is None: 
-      prompt_group = None
-      print(f"Setting prompt_group to {prompt_group} for device_id {device_id}") 
-      cursor.execute('UPDATE "Devices" SET prompt_group=%s WHERE device_id=%s;', (prompt_group, device_id)) 
-      conn.commit() 
-      
-      # Re-fetch the device to verify the update 
-      cursor.execute('SELECT * FROM "Devices" WHERE device_id=%s;', (device_id,)) 
-      device = cursor.fetchone() 
-      print(f"Updated device: {device}")
-
-
-
-    cursor.execute('SELECT * FROM "Questions" where "PickerDB"=\'{}\' and department=\'{}\' and prompt_group=\'{}\';'.format(device['company'].replace(u'\xa0', u' '), device['department'].replace(u'\xa0', u' '),device['prompt_group']))  #enable
-
-
-
-    r = cursor.fetchone()
-    res = {}
-
-    for key in r.keys():
-      res[key] = r[key]
     cursor.close()
     conn.commit()
-    if r is None:
-      return {}
-    return res
+    return prompt_for(device)
   except Exception as e:
-    print(e)
+    logger.error('quiz popup request error: %s', e)
     conn.rollback()
     server_logs(device_id,'Quiz popup request',str(e) )
   finally:
     pool.putconn(conn)
   return {}
 
+# Locks the device row, defaults prompt_group to 1 and increments call_count.
+# Returns the row with `occurrence`, the call_count the question is picked for.
+CLAIM_DEMO_PROMPT_STATEMENT = statements.register('claim_demo_prompt', """
+WITH previous AS (
+  SELECT device_id, prompt_group, call_count FROM "DemoDevices" WHERE device_id=%s FOR UPDATE
+)
+UPDATE "DemoDevices" AS device
+SET prompt_group = COALESCE(device.prompt_group, '1'), call_count = device.call_count + 1
+FROM previous
+WHERE device.device_id = previous.device_id
+RETURNING device.*, previous.call_count AS occurrence, previous.prompt_group IS NULL AS prompt_group_defaulted;
+""")
+
+RELEASE_DEMO_PROMPT_STATEMENT = statements.register(
+    'release_demo_prompt', 'UPDATE "DemoDevices" SET call_count = call_count - 1 WHERE device_id=%s;')
+
 @app.route('/demo')
 def demo():
 
   conn = pool.getconn()
 
-  print('demo ')
+  logger.debug('demo')
 
   try:
     device_id = request.args.get('device_id')
 
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    cursor.execute('SELECT * FROM "DemoDevices" where device_id=\'{}\';'.format(
-      device_id
-    ))
-
-    device = cursor.fetchone()
+    # one statement locks the device, defaults its prompt_group and claims the
+    # next occurrence, so overlapping polls each get their own call_count
+    with timed_query('demo_prompt'):
+      statements.execute(cursor, CLAIM_DEMO_PROMPT_STATEMENT, (device_id,))
+      device = cursor.fetchone()
 
     if device is None:
+      conn.rollback()
       return { 'prompt_type': 'customer_register' }
-    
-        # Check if 'prompt_group' exists and set it to 1 if not 
-    if 'prompt_group' not in device or device['prompt_group'] is None: 
-      prompt_group = 1 
-      print(f"Setting prompt_group to {prompt_group} for device_id {device_id}") 
-      cursor.execute('UPDATE "DemoDevices" SET prompt_group=%s WHERE device_id=%s;', (prompt_group, device_id)) 
-      conn.commit() 
-      
-      # Re-fetch the device to verify the update 
-      cursor.execute('SELECT * FROM "DemoDevices" WHERE device_id=%s;', (device_id,)) 
-      device = cursor.fetchone() 
-      print(f"Updated device: {device}")
-
-    print(device)
-    print(device['company'].replace(u'\xa0', u' '), device['department'].replace(u'\xa0', u' '), str(device['call_count']),device['prompt_group'])
-
-    cursor.execute('SELECT * FROM "DemoQuestions" where "PickerDB"=\'{}\' and department=\'{}\' and demo_occurence_no=\'{}\' and prompt_group=\'{}\';'.format(device['company'].replace(u'\xa0', u' '), device['department'].replace(u'\xa0', u' '), str(device['call_count']),device['prompt_group']))
-
-    r = cursor.fetchone()
 
-    print(r)
-    res = {}
+    if device['prompt_group_defaulted']:
+      logger.info('setting prompt_group to %s for device_id %s', device['prompt_group'], device_id)
 
-    for key in r.keys():
-      res[key] = r[key]
+    logger.debug('device', extra={'fields': {'device': dict(device)}})
 
-    cursor.execute('''
-      UPDATE "DemoDevices" set call_count = {}
-      WHERE device_id=\'{}\'
-      RETURNING id;
-    '''.format(device['call_count'] + 1, device_id))
+    r = question_catalog.demo_question(device['company'], device['department'], device['occurrence'], device['prompt_group'])
 
-    cursor.fetchone()
+    logger.debug('demo question', extra={'fields': {'question': r}})
+    if r is None:
+      # no question at this occurrence, call_count stays where it was
+      if device['prompt_group_defaulted']:
+        statements.execute(cursor, RELEASE_DEMO_PROMPT_STATEMENT, (device_id,))
+        cursor.close()
+        conn.commit()
+        device_cache.invalidate(('DemoDevices', device_id))
+      else:
+        cursor.close()
+        conn.rollback()
+      return {}
 
     cursor.close()
     conn.commit()
-    if r is None:
-      return {}
-    return res
+    if device['prompt_group_defaulted']:
+      device_cache.invalidate(('DemoDevices', device_id))
+    return dict(r)
   except Exception as e:
-    print(e)
+    logger.error('demo quiz popup request error: %s', e)
     conn.rollback()
     server_logs(device_id,'Demo Quiz popup request',str(e) )
   finally:
@@ -455,10 +2673,17 @@ def demo():
 
 
 
+INSERT_LOG_STATEMENT = statements.register('insert_log', '''
+INSERT INTO "Logs" (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+''')
+
 @app.route('/popup_logs_check', methods=["GET"])
 def popup_logs_check():
     conn = pool.getconn()
 
+    config_json = None
+
     try:
 
       response = {
@@ -474,31 +2699,20 @@ def popup_logs_check():
 
       # --------- Check if app window should be shown once more ---------
 
-      # db Logs layout rows slightly differs from Logsdemo layout
-      date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-      # date="2025-06-03 12:51:41.705712"
-
-      #check if returned date value [ 2025-04-27 23:04:00.896019 ] matches [ date] ignoring time
-      cursor.execute('SELECT * FROM "Logs" WHERE "device_id"=%s AND created_at::date = %s AND recived_status = %s', (device_id.replace(u'\xa0', u' '), date.split(' ')[0], 'true'))
-  
-      result = cursor.fetchone()
-
-      # If no logs found for today, return True to show the app window once more
-      if result is None:
+      # If the device did not acknowledge a popup today, show the app window once more
+      if not ack_tracker.acknowledged(cursor, device_id.replace(u'\xa0', u' ')):
         response["show_app_window_once_more"] = True
 
       # --------- Check if popup allowed time to display ---------
-      cursor.execute('SELECT * FROM "AppConfiguration";')
-      app_config_data = cursor.fetchall()
-      response["app_configuration"] = [dict(row) for row in app_config_data]
-      app_config_data = cursor.fetchone()
+      # clients that send back the version they hold get the configuration
+      # only when it changed
+      config_version, config_json = config_snapshot.current()
+      response["app_configuration_version"] = config_version
+      include_config = request.args.get('config_version') != config_version
       
       # --- check if prompt_group is a number ---
 
-      cursor.execute('SELECT * FROM "Devices" where device_id=\'{}\';'.format(  #enable
-        device_id
-      ))
-      device_data = cursor.fetchone()
+      device_data = lookup_device(cursor, 'Devices', device_id)
       if device_data is not None and device_data['prompt_group'] is not None:
         try:
           int(device_data['prompt_group'])
@@ -508,62 +2722,405 @@ def popup_logs_check():
       else:
         response["prompt_group_is_number"] = False
 
-      if response["prompt_group_is_number"] is False & response["show_app_window_once_more"] is True:
-        # print('popup restricted from displaying, prompt_group is not a number')
-        company= device_data['company']
-        department= device_data['department']
-        prompt_group= device_data['prompt_group']
-        prompt_id='n/a'  # No specific prompt_id for this case
-        answer='popup restricted from displaying, prompt_group is not a number'
-        recived_status='true'  # Assuming the status is true since no error occurred
-        error_log='n/a'
-
-        cursor.execute('''
-        INSERT INTO "Logs" (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-        ''', (device_id, company, department, prompt_group, prompt_id, answer, recived_status, error_log))
+      # Acknowledgements only come from popup logs flushed by write_logs, this
+      # route only reads them
 
+      # --- when the device should check again ---
+      popup_schedule.annotate(response, device_data, not response["show_app_window_once_more"])
 
       cursor.close()
       conn.commit()
 
 
     except Exception as e:
-      print('popup Logs check error : ',e)
+      logger.error('popup Logs check error: %s', e)
       conn.rollback()
       cursor.close()
       server_logs(device_id,'Popup alternative time to display checking',str(e) )
     finally:
       pool.putconn(conn)
-    return jsonify(response)
-
 
+    if config_json is None:
+      return jsonify(response)
+    # splice the pre-serialized configuration in instead of re-encoding it
+    config_snapshot.count(not include_config, len(config_json))
+    body = app.json.dumps(response)
+    if include_config:
+      body = body[:-1] + ', "app_configuration": ' + config_json + '}'
+    return app.response_class(body + '\n', mimetype='application/json',
+                              headers={'X-App-Configuration-Version': config_version})
+
+
+
+# ---- push channel -----
+
+PUSH_KEEPALIVE = float(os.getenv('PUSH_KEEPALIVE', '25'))
+PUSH_LONG_POLL_TIMEOUT = float(os.getenv('PUSH_LONG_POLL_TIMEOUT', '30'))
+PUSH_QUEUE_SIZE = int(os.getenv('PUSH_QUEUE_SIZE', '16'))
+
+class PushSubscription:
+    """One connected device, sends an event only when its content changed."""
+
+    def __init__(self, device_id, deliver, known=None):
+        self.device_id = device_id
+        self.deliver = deliver
+        # event name -> id of the content the client holds
+        self.known = dict(known or {})
+        self.closed = False
+        # set once an event could not be queued, the client has to resync
+        self.lagging = False
+
+    def send(self, event, data, event_id=None):
+        """Delivers `data` unless the client already has it, returns False when dropped."""
+        body = data if isinstance(data, str) else app.json.dumps(data)
+        event_id = event_id or hashlib.sha1(body.encode()).hexdigest()[:12]
+        if self.known.get(event) == event_id:
+            return True
+        self.known[event] = event_id
+        if not self.deliver(event, event_id, body):
+            self.lagging = True
+            return False
+        return True
+
+
+class PushHub:
+    """Devices waiting on /events for prompt and configuration changes.
+
+    Changes arrive through the reload listener, so a question, device or
+    configuration edit on any worker (or by the triggers in
+    create_service_tables.sh) reaches the subscribers of every worker. The
+    affected subscribers are refreshed on a background thread, from the device
+    cache and the in-memory snapshots; connected clients cost no queries
+    while nothing changes.
+    """
+
+    def __init__(self):
+        self._subscriptions = collections.defaultdict(set)
+        self._pending_devices = set()
+        self._pending_all = False
+        self._pending_configuration = False
+        self._cond = threading.Condition()
+        self._worker = BackgroundThread(self._run, 'push-hub')
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, device_id, deliver, known=None):
+        subscription = PushSubscription(device_id, deliver, known)
+        with self._cond:
+            self._subscriptions[device_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.closed = True
+        with self._cond:
+            subscriptions = self._subscriptions.get(subscription.device_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.device_id]
+
+    def initial_events(self, subscription, device):
+        """Sends the current prompt and configuration to a new subscriber."""
+        self._send(subscription, 'prompt', prompt_for(device))
+        version, config_json = config_snapshot.current()
+        self._send(subscription, 'app_configuration', config_json, version)
+
+    def _send(self, subscription, event, data, event_id=None):
+        delivered = subscription.send(event, data, event_id)
+        with self._cond:
+            if delivered:
+                self.delivered += 1
+            else:
+                self.dropped += 1
+
+    def device_changed(self, device_id):
+        device_cache.invalidate(('Devices', device_id))
+        self._schedule(devices=[device_id])
+
+    def questions_changed(self):
+        self._schedule(everyone=True)
+
+    def configuration_changed(self):
+        self._schedule(configuration=True)
+
+    def _schedule(self, devices=(), everyone=False, configuration=False):
+        self._worker.ensure_started()
+        with self._cond:
+            self._pending_devices.update(devices)
+            self._pending_all = self._pending_all or everyone
+            self._pending_configuration = self._pending_configuration or configuration
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._pending_devices or self._pending_all or self._pending_configuration):
+                    self._cond.wait()
+                if self._pending_all:
+                    devices = list(self._subscriptions)
+                else:
+                    devices = [device_id for device_id in self._pending_devices if device_id in self._subscriptions]
+                configuration = self._pending_configuration
+                everyone = [subscription for subscriptions in self._subscriptions.values() for subscription in subscriptions]
+                targets = {device_id: list(self._subscriptions[device_id]) for device_id in devices}
+                self._pending_devices = set()
+                self._pending_all = self._pending_configuration = False
+            try:
+                self._refresh(targets, everyone if configuration else [])
+            except Exception as e:
+                logger.error('push refresh error: %s', e)
+
+    def _refresh(self, targets, configuration_targets):
+        if targets:
+            with pool.connection() as conn:
+              cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+              for device_id, subscriptions in targets.items():
+                  prompt = prompt_for(lookup_device(cursor, 'Devices', device_id))
+                  for subscription in subscriptions:
+                      self._send(subscription, 'prompt', prompt)
+              cursor.close()
+              conn.commit()
+        if configuration_targets:
+            version, config_json = config_snapshot.current()
+            for subscription in configuration_targets:
+                self._send(subscription, 'app_configuration', config_json, version)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'devices': len(self._subscriptions),
+                'subscriptions': sum(len(subscriptions) for subscriptions in self._subscriptions.values()),
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+            }
+
+
+push_hub = PushHub()
+question_catalog.on_change(push_hub.questions_changed)
+config_snapshot.on_change(push_hub.configuration_changed)
+reload_listener.register('device', push_hub.device_changed)
+
+def sse_message(event, event_id, body):
+    return f'event: {event}\nid: {event_id}\ndata: {body}\n\n'
+
+def long_poll_body(event, event_id, body):
+    return f'{{"event": "{event}", "id": "{event_id}", "data": {body}}}\n'
+
+def push_known_versions(args):
+    """Content ids a long-polling client already holds."""
+    known = {}
+    if args.get('prompt_version'):
+        known['prompt'] = args['prompt_version']
+    if args.get('config_version'):
+        known['app_configuration'] = args['config_version']
+    return known
+
+@app.route('/events', methods=["GET"])
+def events():
+    """Pushes `prompt` and `app_configuration` events to one device.
+
+    Server-Sent Events by default. With ?wait=1 the request long-polls: it
+    returns the first event whose id differs from the prompt_version and
+    config_version the client sent, or 204 after PUSH_LONG_POLL_TIMEOUT.
+    Every stream holds a worker thread here; large fleets belong on asgi.py.
+    """
+    device_id = request.args.get('device_id')
+    if not device_id:
+      return {'error': 'device_id is required'}, 400
+    long_poll = request.args.get('wait') == '1'
+    pending = queue.Queue(PUSH_QUEUE_SIZE)
 
-# function that saved errors logs to the database table [ server_logs ]
-def server_logs(device_id, source_details, err_log ):
-    
-    conn = pool.getconn()
+    def deliver(event, event_id, body):
+        try:
+            pending.put_nowait((event, event_id, body))
+            return True
+        except queue.Full:
+            return False
 
+    subscription = push_hub.subscribe(device_id, deliver, push_known_versions(request.args) if long_poll else None)
     try:
-      # print('server logs save')
-      # return print(payload)
-      cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-      cursor.execute('''
-      INSERT INTO "ServerLogs" (device_id, source_details, error_log)
-      VALUES (%s, %s, %s);
-      ''', (device_id, source_details, err_log))
-      # result = cursor.fetchone()
-      cursor.close()
-      conn.commit()
-      # print(f"Logs added: {result}")
-      return {}
+      with pool.connection() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        device = lookup_device(cursor, 'Devices', device_id)
+        cursor.close()
+        conn.commit()
+      push_hub.initial_events(subscription, device)
     except Exception as e:
-      print('server logs add error : ',e)
-      conn.rollback()
-      cursor.close()
-    finally:
-      pool.putconn(conn)
+      push_hub.unsubscribe(subscription)
+      logger.error('push subscribe error: %s', e)
+      server_logs(device_id, 'Push subscription', str(e))
+      return {'error': 'subscription failed'}, 503
+
+    if long_poll:
+      try:
+        event = pending.get(timeout=PUSH_LONG_POLL_TIMEOUT)
+      except queue.Empty:
+        return '', 204
+      finally:
+        push_hub.unsubscribe(subscription)
+      return app.response_class(long_poll_body(*event), mimetype='application/json')
+
+    def stream():
+        try:
+            while True:
+                try:
+                    event, event_id, body = pending.get(timeout=PUSH_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield sse_message(event, event_id, body)
+                if subscription.lagging and pending.empty():
+                    # events were dropped, the client gets a fresh state when it reconnects
+                    return
+        finally:
+            push_hub.unsubscribe(subscription)
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# ---- server error logs -----
+
+SERVER_LOGS_BUFFER_SIZE = int(os.getenv('SERVER_LOGS_BUFFER_SIZE', '1000'))
+SERVER_LOGS_FLUSH_INTERVAL = float(os.getenv('SERVER_LOGS_FLUSH_INTERVAL', '2'))
+SERVER_LOGS_SPILL_FILE = os.getenv('SERVER_LOGS_SPILL_FILE', 'server-logs-spill.jsonl')
+
+INSERT_SERVER_LOGS_SQL = 'INSERT INTO "ServerLogs" (device_id, source_details, error_log, created_at) VALUES %s;'
+
+class ServerLogSink:
+    """Buffers server errors in memory and writes them to "ServerLogs" in the background.
+
+    Identical errors are coalesced into one row with a repeat count, and when
+    the buffer is full the oldest error is dropped, so an incident cannot grow
+    it without bound. Errors that cannot be written because the database is
+    unreachable are appended to a local spill file and replayed once it is
+    back. The request path never takes a pooled connection.
+    """
+
+    def __init__(self, capacity, interval, spill_path):
+        self.capacity = capacity
+        self.interval = interval
+        self.spill_path = spill_path
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.spilled = 0
+        self.by_source = collections.Counter()
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._writer = BackgroundThread(self._run, 'server-logs-writer')
+
+    def add(self, device_id, source_details, err_log):
+        key = (str(device_id), str(source_details), str(err_log))
+        with self._lock:
+            self.received += 1
+            self.by_source[key[1]] += 1
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry[0] += 1
+                self.coalesced += 1
+            else:
+                if len(self._pending) >= self.capacity:
+                    self._pending.popitem(last=False)
+                    self.dropped += 1
+                self._pending[key] = [1, datetime.datetime.now()]
+        self._writer.ensure_started()
+
+    def _run(self):
+        while not self._writer.stopping.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def _take(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = collections.OrderedDict()
+        rows = []
+        for (device_id, source_details, err_log), (count, first_seen) in pending.items():
+            if count > 1:
+                err_log = f'{err_log} [repeated {count} times]'
+            rows.append((device_id, source_details, err_log, first_seen.isoformat()))
+        return rows
+
+    def _insert(self, rows):
+        # a short timeout, the sink waits for its next turn rather than queue behind requests
+        with pool.connection(timeout=1) as conn:
+            cursor = conn.cursor()
+            psycopg2.extras.execute_values(cursor, INSERT_SERVER_LOGS_SQL, rows, page_size=1000)
+            cursor.close()
+            conn.commit()
+
+    def _replay_spill(self):
+        replay_path = self.spill_path + '.replay'
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.spill_path):
+                return
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path) as spill:
+            rows = [tuple(json.loads(line)) for line in spill if line.strip()]
+        if rows:
+            self._insert(rows)
+        os.remove(replay_path)
+        logger.info('replayed %d spilled server logs', len(rows))
+
+    def _spill(self, rows):
+        if not rows:
+            return
+        try:
+            with open(self.spill_path, 'a') as spill:
+                for row in rows:
+                    spill.write(json.dumps(row) + '\n')
+            with self._lock:
+                self.spilled += len(rows)
+        except OSError as e:
+            logger.error('server logs spill error: %s', e)
+
+    def flush(self):
+        rows = self._take()
+        try:
+            self._replay_spill()
+            if rows:
+                self._insert(rows)
+                with self._lock:
+                    self.written += len(rows)
+        except Exception as e:
+            logger.error('server logs add error: %s', e)
+            self._spill(rows)
+
+    def close(self, timeout=10):
+        self._writer.stop(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'written': self.written,
+                'spilled': self.spilled,
+                'by_source': dict(self.by_source),
+            }
+
+
+server_log_sink = ServerLogSink(SERVER_LOGS_BUFFER_SIZE, SERVER_LOGS_FLUSH_INTERVAL, SERVER_LOGS_SPILL_FILE)
+
+def shutdown():
+    """Flushes queued logs on graceful shutdown.
+
+    The log queues go first: their last flush may still report errors to
+    server_logs(), which the sink then writes before it stops.
+    """
+    logs_queue.close()
+    demo_logs_queue.close()
+    server_log_sink.close()
+
+atexit.register(shutdown)
+
+# function that saved errors logs to the database table [ server_logs ]
+def server_logs(device_id, source_details, err_log ):
+    server_log_sink.add(device_id, source_details, err_log)
     return {}
 
 # server_logs('test device_id','test source_detail','test err_log' )  # Example usage of server_logs function
@@ -586,6 +3143,388 @@ def create_directories():
 
 create_directories()  # Create directories
 
+# nginx (X-Accel-Redirect) or Apache/lighttpd (X-Sendfile) in front of the
+# service can send update files themselves, Range requests included
+UPDATES_SENDFILE_HEADER = os.getenv('UPDATES_SENDFILE_HEADER', '')
+# prefix of the X-Accel-Redirect/X-Sendfile value, e.g. an internal nginx
+# location; defaults to the absolute path of UPLOAD_FOLDER
+UPDATES_SENDFILE_PREFIX = os.getenv('UPDATES_SENDFILE_PREFIX', '')
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+# Delta blocks end after the first DELTA_ANCHOR at least DELTA_MIN_BLOCK_SIZE
+# bytes into the block, or at DELTA_MAX_BLOCK_SIZE. Boundaries follow the
+# content, so bytes inserted early in a release shift the later blocks
+# instead of changing them. On compressed installer payloads the two-byte
+# anchor occurs every 64 KiB on average. Changing these re-hashes files on
+# their next delta request.
+DELTA_ANCHOR = b'\x9e\x37'
+DELTA_MIN_BLOCK_SIZE = int(os.getenv('DELTA_MIN_BLOCK_SIZE', str(16 * 1024)))
+DELTA_MAX_BLOCK_SIZE = int(os.getenv('DELTA_MAX_BLOCK_SIZE', str(256 * 1024)))
+DELTA_CHUNKING = f'anchor:{DELTA_ANCHOR.hex()}:{DELTA_MIN_BLOCK_SIZE}:{DELTA_MAX_BLOCK_SIZE}'
+
+class FileHashers:
+    """sha256 and sha512 of a file fed in order, chunk by chunk.
+
+    Also splits the file into content-defined blocks on the way and hashes
+    each, for BlockIndex. At most one block is buffered.
+    """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.sha512 = hashlib.sha512()
+        self.size = 0
+        # [hash, length] per completed block
+        self.blocks = []
+        self._block = bytearray()
+        # how far the buffered block was searched for an anchor
+        self._scanned = 0
+
+    def update(self, chunk):
+        self.sha256.update(chunk)
+        self.sha512.update(chunk)
+        self.size += len(chunk)
+        self._block += chunk
+        while True:
+            # the first anchor ending past the minimum size, wherever the chunks were split
+            start = max(DELTA_MIN_BLOCK_SIZE - len(DELTA_ANCHOR), self._scanned - len(DELTA_ANCHOR) + 1, 0)
+            found = self._block.find(DELTA_ANCHOR, start, DELTA_MAX_BLOCK_SIZE)
+            if found != -1:
+                self._cut(found + len(DELTA_ANCHOR))
+            elif len(self._block) >= DELTA_MAX_BLOCK_SIZE:
+                self._cut(DELTA_MAX_BLOCK_SIZE)
+            else:
+                self._scanned = len(self._block)
+                return
+
+    def _cut(self, length):
+        self.blocks.append([hashlib.sha256(self._block[:length]).hexdigest()[:32], length])
+        del self._block[:length]
+        self._scanned = 0
+
+    def block_hashes(self):
+        """[hash, length] of the completed blocks and of the trailing one."""
+        if self._block:
+            return self.blocks + [[hashlib.sha256(self._block).hexdigest()[:32], len(self._block)]]
+        return list(self.blocks)
+
+    def update_from(self, f, limit=None):
+        """Hashes `f` from its current position, up to `limit` bytes."""
+        while limit is None or self.size < limit:
+            chunk = f.read(CHECKSUM_CHUNK_SIZE if limit is None else min(CHECKSUM_CHUNK_SIZE, limit - self.size))
+            if not chunk:
+                break
+            self.update(chunk)
+
+    def entry(self, stat):
+        return {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': self.sha256.hexdigest(),
+            # the encoding electron-updater expects in latest.yml
+            'sha512': base64.b64encode(self.sha512.digest()).decode(),
+        }
+
+
+class JsonFileIndex:
+    """A dict kept in a JSON file under UPLOAD_FOLDER and shared by the workers.
+
+    Readers re-read the file only when its mtime changed. Writers hold an
+    flock on a companion .lock file while they re-read, change and replace
+    it, so concurrent uploads on different workers do not lose entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._index_mtime = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _updating(self):
+        """Yields the entries to change, under both locks, and writes them back."""
+        with self._lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._reload()
+            yield self._entries
+            self._save()
+
+    def _reload(self):
+        # callers hold self._lock
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._index_mtime:
+            return
+        with open(self.path) as f:
+            self._entries = json.load(f)
+        self._index_mtime = mtime
+
+    def _save(self):
+        # callers hold self._lock; written under a temporary name so readers never see half a file
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+        self._index_mtime = os.stat(self.path).st_mtime_ns
+
+
+class ChecksumIndex(JsonFileIndex):
+    """sha256/sha512 of every update file, kept in UPLOAD_FOLDER/.checksums.json.
+
+    Computed once when a file is uploaded, so downloads get a strong ETag and
+    a Digest header without hashing the file per request. Entries are keyed
+    by the path under UPLOAD_FOLDER and remember the size and mtime they
+    were computed for; a file replaced by hand is hashed again on its first
+    download.
+    """
+
+    def __init__(self, folder):
+        super().__init__(os.path.join(folder, '.checksums.json'))
+        self.folder = folder
+        self.computed = 0
+
+    def compute(self, filename):
+        """Hashes UPLOAD_FOLDER/`filename` and records it in the index."""
+        with open(os.path.join(self.folder, filename), 'rb') as f:
+            hashers = FileHashers()
+            hashers.update_from(f)
+            entry = hashers.entry(os.fstat(f.fileno()))
+        self.computed += 1
+        block_index.save(filename, entry['sha256'], hashers)
+        return self.record(filename, entry)
+
+    def record(self, filename, entry):
+        """Stores checksums computed elsewhere, e.g. while a chunked upload arrived."""
+        with self._updating() as entries:
+            entries[filename] = entry
+        return entry
+
+    def get(self, filename):
+        """Returns the checksums of an existing file, hashing it if the index is stale."""
+        stat = os.stat(os.path.join(self.folder, filename))
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(filename)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            logger.info('computing checksums of %s', filename)
+            entry = self.compute(filename)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._entries), 'computed': self.computed}
+
+
+checksum_index = ChecksumIndex(UPLOAD_FOLDER)
+
+class BlockIndex:
+    """Per-file block hashes for delta updates, in UPLOAD_FOLDER/.blocks/<path>.json.
+
+    Written alongside the checksums when a file is uploaded. A file whose
+    sidecar is missing, or was computed for other content or another block
+    size, is hashed again on its first delta request.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.computed = 0
+
+    def _path(self, filename):
+        return os.path.join(self.folder, filename + '.json')
+
+    def save(self, filename, sha256, hashers):
+        path = self._path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomically(path, json.dumps({
+            'sha256': sha256,
+            'chunking': DELTA_CHUNKING,
+            'blocks': hashers.block_hashes(),
+        }))
+
+    def get(self, filename, checksums):
+        """Returns the block hashes of UPLOAD_FOLDER/`filename` with the given checksums."""
+        try:
+            with open(self._path(filename)) as f:
+                blocks = json.load(f)
+            if blocks['sha256'] == checksums['sha256'] and blocks.get('chunking') == DELTA_CHUNKING:
+                return blocks
+        except FileNotFoundError:
+            pass
+        logger.info('computing block hashes of %s', filename)
+        hashers = FileHashers()
+        with open(os.path.join(UPLOAD_FOLDER, filename), 'rb') as f:
+            hashers.update_from(f)
+        sha256 = hashers.sha256.hexdigest()
+        self.save(filename, sha256, hashers)
+        self.computed += 1
+        return {'sha256': sha256, 'chunking': DELTA_CHUNKING, 'blocks': hashers.block_hashes()}
+
+    def stats(self):
+        return {'chunking': DELTA_CHUNKING, 'computed': self.computed}
+
+
+block_index = BlockIndex(os.path.join(UPLOAD_FOLDER, '.blocks'))
+
+# installers listed in latest.yml, in order of preference for its `path`
+# (electron-updater installs macOS updates from the zip)
+INSTALLER_EXTENSIONS = {'win32': ('.exe',), 'darwin': ('.zip', '.dmg')}
+LATEST_YML_NAMES = {'win32': 'latest.yml', 'darwin': 'latest-mac.yml'}
+
+def version_key(version):
+    """Orders versions numerically part by part, "1.2.10" after "1.2.9"."""
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'[.-]', version)]
+
+class ReleaseIndex(JsonFileIndex):
+    """Every uploaded release, kept in UPLOAD_FOLDER/.releases.json.
+
+    {platform: {version: {'release_date', 'release_notes', 'files': {name:
+    {'size', 'mtime', 'sha256', 'sha512'}}}}}, maintained by upload_file(), so
+    /control and /my-app-updates/latest/<platform> never walk the folder.
+    Each upload also rewrites the platform's latest.yml (latest-mac.yml on
+    darwin) and the version's RELEASES.json. A missing index is rebuilt from
+    the folder once, on first use.
+    """
+
+    def __init__(self, folder):
+        super().__init__(os.path.join(folder, '.releases.json'))
+        self.folder = folder
+        self._checked = False
+
+    def _ensure_loaded(self):
+        if self._checked:
+            return
+        if not os.path.exists(self.path):
+            self.rebuild()
+        self._checked = True
+
+    def rebuild(self):
+        """Indexes the files already in UPLOAD_FOLDER/<platform>/<version>/."""
+        releases = {}
+        for platform in sorted(os.listdir(self.folder)):
+            platform_path = os.path.join(self.folder, platform)
+            if platform.startswith('.') or not os.path.isdir(platform_path):
+                continue
+            for version in os.listdir(platform_path):
+                version_path = os.path.join(platform_path, version)
+                if not os.path.isdir(version_path):
+                    continue
+                files = {}
+                for filename in os.listdir(version_path):
+                    if allowed_file(filename) and os.path.isfile(os.path.join(version_path, filename)):
+                        files[filename] = self._file_entry(checksum_index.get(f'{platform}/{version}/{filename}'))
+                if files:
+                    released = max(entry['mtime'] for entry in files.values())
+                    releases.setdefault(platform, {})[version] = {
+                        'release_date': datetime.datetime.fromtimestamp(released).isoformat(),
+                        'release_notes': None,
+                        'files': files,
+                    }
+        with self._updating() as entries:
+            entries.clear()
+            entries.update(releases)
+        logger.info('release index rebuilt: %d releases', sum(len(versions) for versions in releases.values()))
+
+    @staticmethod
+    def _file_entry(checksums):
+        return {
+            'size': checksums['size'],
+            'mtime': checksums['mtime_ns'] / 1e9,
+            'sha256': checksums['sha256'],
+            'sha512': checksums['sha512'],
+        }
+
+    def add(self, platform, version, filename, checksums, release_notes=None):
+        """Records an uploaded file and regenerates the platform's update metadata."""
+        self._ensure_loaded()
+        with self._updating() as entries:
+            release = entries.setdefault(platform, {}).setdefault(
+                version, {'release_date': None, 'release_notes': None, 'files': {}})
+            release['files'][filename] = self._file_entry(checksums)
+            release['release_date'] = datetime.datetime.now().isoformat()
+            if release_notes:
+                release['release_notes'] = release_notes
+            self._write_metadata(platform, version, release)
+            latest_version = max(entries[platform], key=version_key)
+            self._write_latest_yml(platform, latest_version, entries[platform][latest_version])
+
+    def _write_metadata(self, platform, version, release):
+        installers = self._installers(platform, release)
+        info = {
+            'releaseNotes': release['release_notes'] or 'No release notes',
+            'releaseDate': release['release_date'],
+            'url': url_for('download_file', filename=f'{platform}/{version}/{installers[0]}', _external=True)
+                   if installers and has_request_context() else None,
+            'version': version,
+        }
+        write_file_atomically(os.path.join(self.folder, platform, version, 'RELEASES.json'), json.dumps(info, indent=4))
+
+    def _write_latest_yml(self, platform, version, release):
+        installers = self._installers(platform, release)
+        if not installers or platform not in LATEST_YML_NAMES:
+            return
+        files = release['files']
+        lines = [f'version: {version}', 'files:']
+        for name in installers:
+            lines += [f'  - url: {version}/{name}', f'    sha512: {files[name]["sha512"]}', f'    size: {files[name]["size"]}']
+        lines += [
+            f'path: {version}/{installers[0]}',
+            f'sha512: {files[installers[0]]["sha512"]}',
+            f"releaseDate: '{release['release_date']}'",
+        ]
+        write_file_atomically(os.path.join(self.folder, platform, LATEST_YML_NAMES[platform]), '\n'.join(lines) + '\n')
+
+    @staticmethod
+    def _installers(platform, release):
+        extensions = INSTALLER_EXTENSIONS.get(platform, ())
+        names = [name for name in release['files'] if name.lower().endswith(extensions)]
+        # preferred extension first, most recent upload first within it
+        return sorted(names, key=lambda name: (extensions.index(os.path.splitext(name)[1].lower()),
+                                               -release['files'][name]['mtime']))
+
+    def latest(self, platform):
+        """Returns (version, release) of the highest version of `platform`, or None."""
+        self._ensure_loaded()
+        with self._lock:
+            self._reload()
+            versions = self._entries.get(platform)
+            if not versions:
+                return None
+            version = max(versions, key=version_key)
+            return version, versions[version]
+
+    def releases(self, platform):
+        """{version: release} of `platform`."""
+        self._ensure_loaded()
+        with self._lock:
+            self._reload()
+            return dict(self._entries.get(platform, {}))
+
+    def files(self, platform):
+        """Paths of every file of `platform`, most recently modified first."""
+        self._ensure_loaded()
+        with self._lock:
+            self._reload()
+            files = [(os.path.join(self.folder, platform, version, name), entry['mtime'])
+                     for version, release in self._entries.get(platform, {}).items()
+                     for name, entry in release['files'].items()]
+        files.sort(key=lambda file: file[1], reverse=True)
+        return [file[0] for file in files]
+
+    def stats(self):
+        with self._lock:
+            return {platform: len(versions) for platform, versions in self._entries.items()}
+
+
+def write_file_atomically(path, content):
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+release_index = ReleaseIndex(UPLOAD_FOLDER)
+
 def decrease_version(version):
   """Decreases the last number of a version string by 1.
 
@@ -606,36 +3545,186 @@ def decrease_version(version):
 # decreased_version = decrease_version(version)
 # print(decreased_version)  # Output: 4.6.0
 
+def update_file_response(filename, checksums):
+    """Hands the file to the front server named by UPDATES_SENDFILE_HEADER."""
+    headers = {'ETag': f'"{checksums["sha256"]}"', 'Accept-Ranges': 'bytes'}
+    if request.if_none_match.contains(checksums['sha256']):
+        return app.response_class(status=304, headers=headers)
+    prefix = UPDATES_SENDFILE_PREFIX or os.path.join(app.root_path, UPLOAD_FOLDER)
+    headers[UPDATES_SENDFILE_HEADER] = prefix.rstrip('/') + '/' + filename
+    return app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                              headers=headers)
+
 @app.route('/my-app-updates/<path:filename>')  # Static file server route
 def download_file(filename):
+    """Serves an update file with Range support and a sha256 ETag.
+
+    Resumed downloads (Range/If-Range) and revalidations (If-None-Match) are
+    answered by werkzeug; complete bodies go out through the server's
+    wsgi.file_wrapper, which gunicorn sends with sendfile(). With
+    UPDATES_SENDFILE_HEADER set, the front server sends the body instead.
+    """
+    # the checksum index and other dotfiles are not downloads
+    if werkzeug.security.safe_join(UPLOAD_FOLDER, filename) is None or \
+        any(part.startswith('.') for part in filename.split('/')):
+      abort(404)
     try:
-      return send_from_directory(UPLOAD_FOLDER, filename)
+      checksums = checksum_index.get(filename)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+      abort(404)
     except Exception as e:
-        server_logs('n/a','App update download', str(e) )
-       
+      server_logs('n/a','App update download', str(e) )
+      abort(500)
+
+    if UPDATES_SENDFILE_HEADER:
+      response = update_file_response(filename, checksums)
+    else:
+      response = werkzeug.utils.send_from_directory(
+          os.path.join(app.root_path, UPLOAD_FOLDER), filename, request.environ,
+          etag=checksums['sha256'], response_class=app.response_class)
+    response.headers['Digest'] = 'sha-256={}, sha-512={}'.format(
+        base64.b64encode(bytes.fromhex(checksums['sha256'])).decode(), checksums['sha512'])
+    return response
+
 
 @app.route('/media/<path:filename>')  # Static file server route
 def send_instruction(filename):
     return send_from_directory('media', filename)
 
+@app.route('/my-app-updates/latest/<platform>')
+def latest_release(platform):
+    """The highest released version of `platform` and its files, from the release index."""
+    latest = release_index.latest(platform)
+    if latest is None:
+      return jsonify({'error': f'no releases for {platform}'}), 404
+    version, release = latest
+    response = jsonify({
+        'platform': platform,
+        'version': version,
+        'release_date': release['release_date'],
+        'release_notes': release['release_notes'],
+        'files': [dict(entry, name=name, url=url_for('download_file', filename=f'{platform}/{version}/{name}'))
+                  for name, entry in sorted(release['files'].items())],
+    })
+    response.add_etag()
+    return response.make_conditional(request)
+
+def delta_operations(old_blocks, new_blocks):
+    """Builds the new file from the old one: ['copy', old offset, length] and ['fetch', new offset, length] runs.
+
+    A block of the new file is copied when the old file has a block with the
+    same hash anywhere, otherwise it is fetched. Adjacent runs of the same
+    kind are merged.
+    """
+    old_offsets = {}
+    offset = 0
+    for block, length in old_blocks['blocks']:
+        old_offsets.setdefault(block, offset)
+        offset += length
+
+    operations = []
+    offset = 0
+    for block, length in new_blocks['blocks']:
+        operation = ['copy', old_offsets[block], length] if block in old_offsets else ['fetch', offset, length]
+        offset += length
+        previous = operations[-1] if operations else None
+        if previous is not None and previous[0] == operation[0] and previous[1] + previous[2] == operation[1]:
+            previous[2] += length
+        else:
+            operations.append(operation)
+    return operations
+
+def delta_files(platform, version, filename, from_version):
+    """Resolves a delta request to (new path, new checksums, old path, old checksums)."""
+    releases = release_index.releases(platform)
+    new_release = releases.get(version)
+    old_release = releases.get(from_version)
+    if new_release is None or filename not in new_release['files'] or old_release is None:
+        return None
+    # the same name in the old release, else its installer with the same extension
+    extension = os.path.splitext(filename)[1].lower()
+    candidates = [filename] if filename in old_release['files'] else \
+        [name for name in ReleaseIndex._installers(platform, old_release) if name.lower().endswith(extension)]
+    if not candidates:
+        return None
+    new_path = f'{platform}/{version}/{filename}'
+    old_path = f'{platform}/{from_version}/{candidates[0]}'
+    return new_path, checksum_index.get(new_path), old_path, checksum_index.get(old_path)
+
+@app.route('/my-app-updates/delta/<platform>/<version>/<filename>')
+def delta_manifest(platform, version, filename):
+    """How to build `filename` of `version` from the client's copy of the ?from= version.
+
+    `operations` lists, in order, byte runs to copy from the old file
+    (["copy", old_offset, length]) and to fetch (["fetch", new_offset,
+    length]). The fetched runs are served concatenated by the /data route,
+    or one by one with Range requests on the file itself.
+    """
+    from_version = request.args.get('from', '')
+    try:
+      files = delta_files(platform, version, filename, from_version)
+      if files is None:
+        return jsonify({'error': 'no release to build a delta from'}), 404
+      new_path, new_checksums, old_path, old_checksums = files
+      operations = delta_operations(block_index.get(old_path, old_checksums), block_index.get(new_path, new_checksums))
+    except (FileNotFoundError, NotADirectoryError):
+      return jsonify({'error': 'release file missing'}), 404
+    except Exception as e:
+      server_logs('n/a', 'App update delta', str(e))
+      return jsonify({'error': 'delta could not be computed'}), 500
+
+    fetch_bytes = sum(operation[2] for operation in operations if operation[0] == 'fetch')
+    response = jsonify({
+        'from': {'version': from_version, 'path': old_path, 'sha256': old_checksums['sha256']},
+        'to': {'version': version, 'path': new_path, 'size': new_checksums['size'],
+               'sha256': new_checksums['sha256'], 'sha512': new_checksums['sha512']},
+        'operations': operations,
+        'fetch_bytes': fetch_bytes,
+        'copy_bytes': new_checksums['size'] - fetch_bytes,
+        'url': url_for('download_file', filename=new_path),
+        'data_url': url_for('delta_data', platform=platform, version=version, filename=filename, **{'from': from_version}),
+    })
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/my-app-updates/delta/<platform>/<version>/<filename>/data')
+def delta_data(platform, version, filename):
+    """The manifest's fetched runs of the new file, concatenated in order."""
+    from_version = request.args.get('from', '')
+    try:
+      files = delta_files(platform, version, filename, from_version)
+      if files is None:
+        return jsonify({'error': 'no release to build a delta from'}), 404
+      new_path, new_checksums, old_path, old_checksums = files
+      operations = delta_operations(block_index.get(old_path, old_checksums), block_index.get(new_path, new_checksums))
+    except (FileNotFoundError, NotADirectoryError):
+      return jsonify({'error': 'release file missing'}), 404
+    except Exception as e:
+      server_logs('n/a', 'App update delta', str(e))
+      return jsonify({'error': 'delta could not be computed'}), 500
+    runs = [(offset, length) for kind, offset, length in operations if kind == 'fetch']
+
+    def stream():
+        with open(os.path.join(UPLOAD_FOLDER, new_path), 'rb') as f:
+            for offset, length in runs:
+                f.seek(offset)
+                while length:
+                    chunk = f.read(min(CHECKSUM_CHUNK_SIZE, length))
+                    if not chunk:
+                        return
+                    length -= len(chunk)
+                    yield chunk
+
+    return app.response_class(stream(), mimetype='application/octet-stream', direct_passthrough=True, headers={
+        'Content-Length': str(sum(length for _, length in runs)),
+        'ETag': f'"{old_checksums["sha256"][:16]}-{new_checksums["sha256"][:16]}"',
+    })
+
 @app.route('/control')
 def control():
-    windows_files = []
-    mac_files = []
-    for (dirpath, dirnames, filenames) in os.walk(UPLOAD_FOLDER):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            if 'win32' in dirpath:
-                windows_files.append((file_path, os.path.getmtime(file_path)))
-            elif 'darwin' in dirpath:
-                mac_files.append((file_path, os.path.getmtime(file_path)))
-
-    # Sort files by modification time (latest first)
-    windows_files.sort(key=lambda x: x[1], reverse=True)
-    mac_files.sort(key=lambda x: x[1], reverse=True)
-
-    windows_files = [file[0] for file in windows_files]
-    mac_files = [file[0] for file in mac_files]
+    # file lists come from the release index, sorted by modification time (latest first)
+    windows_files = release_index.files('win32')
+    mac_files = release_index.files('darwin')
 
     return render_template('index.html', windows_files=windows_files, mac_files=mac_files)
 
@@ -644,6 +3733,18 @@ def logs_ui():
    return render_template('logs.html')
    
 
+def release_file_path(platform, version, filename):
+    """Where an uploaded release file goes, the version is appended to a name already taken."""
+    folder = os.path.join(UPLOAD_FOLDER, platform, version)
+    os.makedirs(folder, exist_ok=True)
+
+    file_path = os.path.join(folder, filename)
+    if os.path.exists(file_path):
+        file_name, file_extension = os.path.splitext(filename)
+        versioned_filename = f"{file_name}-{version}{file_extension}"
+        file_path = os.path.join(folder, versioned_filename)
+    return file_path
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     
@@ -668,62 +3769,311 @@ def upload_file():
             # version =  decrease_version(request.form.get('version', '1.0.0'))  # Ensure version is always set
             version =  request.form.get('version', '1.0.0') # Ensure version is always set
 
-            folder = os.path.join(UPLOAD_FOLDER, platform, version)
-            os.makedirs(folder, exist_ok=True)
-
-            file_path = os.path.join(folder, filename)
-            if os.path.exists(file_path):
-                file_name, file_extension = os.path.splitext(filename)
-                versioned_filename = f"{file_name}-{version}{file_extension}"
-                file_path = os.path.join(folder, versioned_filename)
+            file_path = release_file_path(platform, version, filename)
 
-            print(f"Saving file: {file_path}")
+            logger.info('saving file %s', file_path)
             file.save(file_path)
-            file_size = os.path.getsize(file_path)
-            print(f"Saved file: {file_path} (size: {file_size} bytes)")
-
-            # if filename.endswith('.exe'):
-            #     release_notes = request.form.get('releaseNotes', 'No release notes')
-            #     release_date = datetime.datetime.now().isoformat()
-            #     url = f"https://your-server.com/uploads/{platform}/{version}/{filename}"
-
-            #     release_info = f"{file_size} {filename} {version}\n"
-            #     with open(os.path.join(UPLOAD_FOLDER, platform, version, 'RELEASES'), 'w') as f:
-            #         f.write(release_info)
-            #     print(f"Written RELEASES info for {filename}")
-
-            # if filename.endswith('.yml'):
-            #     yml_info = f"YML file: {file_size} {filename} {version}\n"
-            #     with open(os.path.join(UPLOAD_FOLDER, platform, version, 'latest.yml'), 'w') as f:
-            #         f.write(yml_info)
-            #     print(f"Written latest.yml info for {filename}")
-
-            # if filename.endswith('.blockmap'):
-            #     blockmap_info = f"Blockmap file: {file_size} {filename} {version}\n"
-            #     with open(os.path.join(UPLOAD_FOLDER, platform, version, 'blockmap.info'), 'w') as f:
-            #         f.write(blockmap_info)
-            #     print(f"Written blockmap info for {filename}")
-
-            # if filename.endswith(('.dmg', '.zip')):
-            #     release_notes = request.form.get('releaseNotes', 'No release notes')
-            #     release_date = datetime.datetime.now().isoformat()
-            #     url = f"https://your-server.com/uploads/{platform}/{version}/{filename}"
-
-            #     release_info = {
-            #         "releaseNotes": release_notes,
-            #         "releaseDate": release_date,
-            #         "url": url,
-            #         "version": version
-            #     }
-            #     with open(os.path.join(UPLOAD_FOLDER, platform, version, 'RELEASES.json'), 'w') as f:
-            #         f.write(json.dumps(release_info, indent=4))
-            #     print(f"Written RELEASES.json info for {filename}")
+            checksums = checksum_index.compute(os.path.relpath(file_path, UPLOAD_FOLDER))
+            file_size = checksums['size']
+            logger.info('saved file %s (size: %d bytes, sha256: %s)', file_path, file_size, checksums['sha256'])
+
+            # latest.yml and RELEASES.json are regenerated from the release index
+            release_index.add(platform, version, os.path.basename(file_path), checksums,
+                              request.form.get('releaseNotes'))
 
     flash('Files have been uploaded successfully.')
     return redirect(url_for('control'))
   except Exception as e:
     server_logs('n/a','App update upload', str(e) )
 
+
+# ---- chunked uploads -----
+
+UPLOAD_INCOMING_FOLDER = os.path.join(UPLOAD_FOLDER, '.incoming')
+# unfinished uploads untouched for this long are deleted
+UPLOAD_STALE_SECONDS = int(os.getenv('UPLOAD_STALE_SECONDS', str(24 * 3600)))
+UPLOAD_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9._-]*$')
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadConflict(Exception):
+    """A chunk did not start at the upload's current offset, or another request is writing it."""
+
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+class ChunkedUploads:
+    """Resumable uploads of release files: initiate, PUT chunks at offsets, finalize.
+
+    An upload is a state file (<id>.json) and a data file (<id>.part) in
+    UPLOAD_FOLDER/.incoming. Chunks are streamed from the request straight
+    into the part file and hashed as they are written, so memory stays at one
+    read buffer whatever the file size. The part file's length is the offset
+    the next chunk must start at, which is what a client resumes from after
+    a dropped connection. Finalize renames the part file into
+    <platform>/<version>/ (same filesystem, so the file appears atomically)
+    and records it like upload_file() does.
+
+    Hashing state lives in the worker that received the previous chunk; a
+    chunk that lands on another worker, or after a restart, re-hashes the
+    bytes already received once before appending.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._hashers = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.completed = 0
+        self.bytes_received = 0
+        self.bytes_rehashed = 0
+
+    def _paths(self, upload_id):
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            raise KeyError(upload_id)
+        base = os.path.join(self.folder, upload_id)
+        return base + '.json', base + '.part'
+
+    def create(self, platform, version, filename, size=None, sha256=None, release_notes=None):
+        for label, value in (('platform', platform), ('version', version), ('filename', filename)):
+            if not isinstance(value, str) or not UPLOAD_NAME_PATTERN.match(value):
+                raise ValueError(f'invalid {label}')
+        if not allowed_file(filename):
+            raise ValueError('file type not allowed')
+        if size is not None and (not isinstance(size, int) or size < 0):
+            raise ValueError('invalid size')
+        self.cleanup()
+        os.makedirs(self.folder, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        state_path, part_path = self._paths(upload_id)
+        open(part_path, 'wb').close()
+        write_file_atomically(state_path, json.dumps({
+            'platform': platform,
+            'version': version,
+            'filename': filename,
+            'size': size,
+            'sha256': sha256,
+            'release_notes': release_notes,
+            'created_at': datetime.datetime.now().isoformat(),
+        }))
+        with self._lock:
+            self.started += 1
+        return upload_id
+
+    def state(self, upload_id):
+        """The upload's state with its current offset, KeyError when unknown."""
+        state_path, part_path = self._paths(upload_id)
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            state['offset'] = os.path.getsize(part_path)
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+        state['upload_id'] = upload_id
+        return state
+
+    @contextlib.contextmanager
+    def _locked_part(self, upload_id):
+        _, part_path = self._paths(upload_id)
+        try:
+            f = open(part_path, 'r+b')
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadConflict('another request is writing this upload', os.fstat(f.fileno()).st_size)
+            yield f
+
+    def _take_hashers(self, upload_id, f, offset):
+        with self._lock:
+            hashers = self._hashers.pop(upload_id, None)
+        if hashers is None or hashers.size != offset:
+            hashers = FileHashers()
+            f.seek(0)
+            hashers.update_from(f, offset)
+            with self._lock:
+                self.bytes_rehashed += offset
+        return hashers
+
+    def write(self, upload_id, offset, stream):
+        """Appends `stream` at `offset`, returns the new offset."""
+        size = self.state(upload_id)['size']
+        with self._locked_part(upload_id) as f:
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadConflict(f'expected offset {current}', current)
+            hashers = self._take_hashers(upload_id, f, current)
+            f.seek(current)
+            try:
+                for chunk in iter(lambda: stream.read(CHECKSUM_CHUNK_SIZE), b''):
+                    if size is not None and hashers.size + len(chunk) > size:
+                        raise ValueError(f'chunk runs past the declared size of {size} bytes')
+                    f.write(chunk)
+                    hashers.update(chunk)
+            finally:
+                f.flush()
+                written = f.tell() - current
+                with self._lock:
+                    self.bytes_received += written
+                    # kept only while they match the bytes on disk
+                    if f.tell() == hashers.size:
+                        self._hashers[upload_id] = hashers
+            return hashers.size
+
+    def finalize(self, upload_id):
+        """Moves the completed file into place, returns (file_path, checksums)."""
+        state = self.state(upload_id)
+        state_path, part_path = self._paths(upload_id)
+        with self._locked_part(upload_id) as f:
+            received = f.seek(0, os.SEEK_END)
+            if state['size'] is not None and received != state['size']:
+                raise UploadConflict(f'received {received} of {state["size"]} bytes', received)
+            hashers = self._take_hashers(upload_id, f, received)
+            os.fsync(f.fileno())
+            checksums = hashers.entry(os.fstat(f.fileno()))
+            if state['sha256'] and state['sha256'] != checksums['sha256']:
+                raise ValueError('sha256 does not match the received file')
+            file_path = release_file_path(state['platform'], state['version'], state['filename'])
+            os.replace(part_path, file_path)
+        os.remove(state_path)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+            self.completed += 1
+        checksum_index.record(os.path.relpath(file_path, UPLOAD_FOLDER), checksums)
+        block_index.save(os.path.relpath(file_path, UPLOAD_FOLDER), checksums['sha256'], hashers)
+        release_index.add(state['platform'], state['version'], os.path.basename(file_path), checksums,
+                          state['release_notes'])
+        return file_path, checksums
+
+    def abort(self, upload_id):
+        state_path, part_path = self._paths(upload_id)
+        if not os.path.exists(state_path):
+            raise KeyError(upload_id)
+        for path in (part_path, state_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+
+    def cleanup(self):
+        """Deletes uploads whose last chunk is older than UPLOAD_STALE_SECONDS.
+
+        The state file is only written when an upload starts, so an upload is
+        as old as the newest of its files, the part file once chunks arrive,
+        and its files are removed together.
+        """
+        if not os.path.isdir(self.folder):
+            return
+        cutoff = time.time() - UPLOAD_STALE_SECONDS
+        uploads = collections.defaultdict(list)
+        for name in os.listdir(self.folder):
+            # <id>.json, <id>.part and the <id>.json.<pid>.tmp of an interrupted write
+            uploads[name.split('.', 1)[0]].append(os.path.join(self.folder, name))
+        for upload_id, paths in uploads.items():
+            mtimes = []
+            for path in paths:
+                with contextlib.suppress(FileNotFoundError):
+                    mtimes.append(os.path.getmtime(path))
+            if not mtimes or max(mtimes) >= cutoff:
+                continue
+            # the part file goes first, so a chunk arriving meanwhile gets a 404 instead of writing into it
+            for path in sorted(paths, key=lambda path: not path.endswith('.part')):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            with self._lock:
+                self._hashers.pop(upload_id, None)
+            logger.info('removed stale upload %s', upload_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'completed': self.completed,
+                'in_progress_here': len(self._hashers),
+                'bytes_received': self.bytes_received,
+                'bytes_rehashed': self.bytes_rehashed,
+            }
+
+
+chunked_uploads = ChunkedUploads(UPLOAD_INCOMING_FOLDER)
+
+@app.route('/uploads', methods=['POST'])
+def initiate_upload():
+    """Starts a chunked upload of one release file.
+
+    Body: {"platform", "version", "filename", optional "size" in bytes,
+    "sha256" to verify on finalize and "releaseNotes"}.
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+      upload_id = chunked_uploads.create(
+          payload.get('platform'), payload.get('version'), str(payload.get('filename', '')).replace(' ', '-'),
+          payload.get('size'), payload.get('sha256'), payload.get('releaseNotes'))
+    except ValueError as e:
+      return jsonify({'error': str(e)}), 400
+    except Exception as e:
+      server_logs('n/a', 'App update chunked upload', str(e))
+      return jsonify({'error': 'upload could not be started'}), 500
+    return jsonify({'upload_id': upload_id, 'offset': 0,
+                    'upload_url': url_for('upload_chunk', upload_id=upload_id)}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """The offset to resume from."""
+    try:
+      return jsonify(chunked_uploads.state(upload_id))
+    except KeyError:
+      return jsonify({'error': 'unknown upload'}), 404
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Appends the request body at ?offset=, which must be the current offset."""
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+      return jsonify({'error': 'offset is required'}), 400
+    try:
+      return jsonify({'offset': chunked_uploads.write(upload_id, offset, request.stream)})
+    except KeyError:
+      return jsonify({'error': 'unknown upload'}), 404
+    except UploadConflict as e:
+      return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except ValueError as e:
+      return jsonify({'error': str(e)}), 400
+    except werkzeug.exceptions.ClientDisconnected:
+      # what arrived is kept, the client resumes from GET /uploads/<id>
+      return jsonify({'error': 'connection dropped'}), 400
+    except Exception as e:
+      server_logs('n/a', 'App update chunked upload', str(e))
+      return jsonify({'error': 'chunk could not be written'}), 500
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    try:
+      file_path, checksums = chunked_uploads.finalize(upload_id)
+    except KeyError:
+      return jsonify({'error': 'unknown upload'}), 404
+    except UploadConflict as e:
+      return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except ValueError as e:
+      return jsonify({'error': str(e)}), 422
+    except Exception as e:
+      server_logs('n/a', 'App update chunked upload', str(e))
+      return jsonify({'error': 'upload could not be finalized'}), 500
+    filename = os.path.relpath(file_path, UPLOAD_FOLDER)
+    logger.info('saved file %s (size: %d bytes, sha256: %s)', file_path, checksums['size'], checksums['sha256'])
+    return jsonify(dict(checksums, path=filename, url=url_for('download_file', filename=filename)))
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    try:
+      chunked_uploads.abort(upload_id)
+    except KeyError:
+      return jsonify({'error': 'unknown upload'}), 404
+    return '', 204
+
 # if __name__ == '__main__':
 #     app.run(debug=True)
 
@@ -0,0 +1,393 @@
+"""Monthly partitioning and retention for the append-only tables.
+
+"Logs", "DemoLogs", "ServerLogs" and "Answers" only ever grow. This module
+turns them into tables range-partitioned by month on created_at, keeps
+future partitions created ahead of time, and detaches partitions that fell
+out of the retention window, archiving each to a gzipped CSV before
+dropping it. Queries on recent rows then only touch the recent partitions,
+and expiring a month is a DROP instead of a DELETE over the whole table.
+
+  python schema.py partition [--tables Logs ServerLogs] [--keep-legacy]
+  python schema.py maintain [--dry-run]      # daily, e.g. from cron
+  python schema.py status
+
+`partition` is a one-off per table. In one short transaction it renames the
+table to "<table>_legacy", creates the partitioned table in its place (same
+columns, defaults and id sequence or identity) with partitions from the
+oldest row to SCHEMA_PREMAKE_MONTHS ahead plus a default partition, and its
+indexes; the service keeps writing to the new table from then on. History is
+then copied over one month per transaction and the legacy table dropped once
+the row counts match. Rows without created_at land in the default partition,
+and so do rows of months without a partition until `maintain` creates it and
+moves them there. The primary key becomes a plain index on id, since a unique
+index on a partitioned table has to include created_at.
+
+Retention, in whole months before the current one, is set per table with
+LOGS_RETENTION_MONTHS (default 12), DEMO_LOGS_RETENTION_MONTHS (3),
+SERVER_LOGS_RETENTION_MONTHS (6) and ANSWERS_RETENTION_MONTHS (0, keep
+everything). Archives go to SCHEMA_ARCHIVE_DIR/<table>/<partition>.csv.gz.
+Uses the DB_* variables of the service (.env is read).
+"""
+import argparse
+import datetime
+import gzip
+import os
+import re
+import sys
+
+import psycopg2
+import psycopg2.sql
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_CONNECT_ARGS = dict(
+    user=os.getenv('DB_USER', 'postgres'),
+    password=os.getenv('DB_PASSWORD'),
+    host=os.getenv('DB_HOST', 'localhost'),
+    port=os.getenv('DB_PORT', '5432'),
+    database=os.getenv('DB_NAME', 'defaultdb'),
+    sslmode=os.getenv('DB_SSL_MODE', 'prefer'),
+)
+
+SCHEMA_PREMAKE_MONTHS = int(os.getenv('SCHEMA_PREMAKE_MONTHS', '3'))
+SCHEMA_ARCHIVE_DIR = os.getenv('SCHEMA_ARCHIVE_DIR', 'archive')
+# DDL waits at most this long for the service's transactions, then fails
+# instead of queueing every request behind it
+SCHEMA_LOCK_TIMEOUT = os.getenv('SCHEMA_LOCK_TIMEOUT', '5s')
+
+# table -> retention in months (0 keeps everything) and indexes, as column lists
+PARTITIONED_TABLES = {
+    'Logs': {
+        'retention': int(os.getenv('LOGS_RETENTION_MONTHS', '12')),
+        # per-day acknowledgement backfill, keyset pagination of the log viewer
+        'indexes': [('device_id', 'created_at'), ('created_at', 'id'), ('id',)],
+    },
+    'DemoLogs': {
+        'retention': int(os.getenv('DEMO_LOGS_RETENTION_MONTHS', '3')),
+        'indexes': [('created_at', 'id'), ('id',)],
+    },
+    'ServerLogs': {
+        'retention': int(os.getenv('SERVER_LOGS_RETENTION_MONTHS', '6')),
+        'indexes': [('created_at', 'id'), ('id',)],
+    },
+    'Answers': {
+        'retention': int(os.getenv('ANSWERS_RETENTION_MONTHS', '0')),
+        'indexes': [('created_at', 'id'), ('device_id', 'question_id'), ('id',)],
+    },
+}
+
+BOUND_PATTERN = re.compile(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+# ---- helpers -----
+
+def connect():
+    conn = psycopg2.connect(**DB_CONNECT_ARGS)
+    with conn.cursor() as cursor:
+        cursor.execute('SET lock_timeout = %s;', (SCHEMA_LOCK_TIMEOUT,))
+    conn.commit()
+    return conn
+
+def month_start(value):
+    return datetime.date(value.year, value.month, 1)
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+def partition_name(table, month):
+    return f'{table}_{month.year:04d}_{month.month:02d}'
+
+def index_name(table, columns):
+    return f'{table}_{"_".join(columns)}_idx'
+
+def identifier(*names):
+    return psycopg2.sql.Identifier(*names)
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (f'"{table}"',))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0] == 'p'
+
+def partitions(cursor, table):
+    """[(name, lower month, upper month)] of `table`, oldest first; the default partition has None bounds."""
+    cursor.execute("""
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(%s);
+    """, (f'"{table}"',))
+    result = []
+    for name, bound in cursor.fetchall():
+        match = BOUND_PATTERN.search(bound)
+        if match is None:
+            result.append((name, None, None))
+            continue
+        lower, upper = (datetime.datetime.fromisoformat(value).date() for value in match.groups())
+        result.append((name, lower, upper))
+    result.sort(key=lambda partition: (partition[1] is None, partition[1] or datetime.date.min))
+    return result
+
+def create_partition(cursor, table, month):
+    """Creates the partition of `month`, moving the rows the default partition holds for it.
+
+    Postgres refuses to create a partition while the default partition has
+    rows in its range, so the default partition is detached, the month's rows
+    are moved into the new partition and it is attached again. This runs in
+    the caller's transaction, no one sees the table without its default.
+    """
+    name = partition_name(table, month)
+    default = f'{table}_default'
+    bounds = (month, add_months(month, 1))
+    create = psycopg2.sql.SQL('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);').format(
+        identifier(name), identifier(table))
+    stray = False
+    if is_partitioned(cursor, name) is None and is_partitioned(cursor, default) is not None:
+        cursor.execute(psycopg2.sql.SQL(
+            'SELECT EXISTS (SELECT 1 FROM {} WHERE created_at >= %s AND created_at < %s);').format(
+                identifier(default)), bounds)
+        stray = cursor.fetchone()[0]
+    if not stray:
+        cursor.execute(create, bounds)
+        return
+
+    cursor.execute(psycopg2.sql.SQL('ALTER TABLE {} DETACH PARTITION {};').format(
+        identifier(table), identifier(default)))
+    cursor.execute(create, bounds)
+    cursor.execute(psycopg2.sql.SQL(
+        'WITH moved AS (DELETE FROM {default} WHERE created_at >= %s AND created_at < %s RETURNING *) '
+        'INSERT INTO {table} OVERRIDING SYSTEM VALUE SELECT * FROM moved;').format(
+            default=identifier(default), table=identifier(table)), bounds)
+    moved = cursor.rowcount
+    cursor.execute(psycopg2.sql.SQL('ALTER TABLE {} ATTACH PARTITION {} DEFAULT;').format(
+        identifier(table), identifier(default)))
+    print(f'{table}: {moved} rows moved from "{default}" into "{name}"')
+
+
+# ---- partition -----
+
+def partition_table(conn, table, keep_legacy=False):
+    """Converts `table` to monthly partitions and copies its history over."""
+    legacy = f'{table}_legacy'
+    cursor = conn.cursor()
+    partitioned = is_partitioned(cursor, table)
+    if partitioned is None:
+        raise SystemExit(f'table "{table}" does not exist')
+    if partitioned:
+        print(f'{table}: already partitioned')
+    else:
+        swap(conn, table, legacy)
+
+    if is_partitioned(cursor, legacy) is None:
+        conn.commit()
+        return
+    copy_history(conn, table, legacy)
+    cursor.execute(psycopg2.sql.SQL('SELECT count(*) FROM {};').format(identifier(legacy)))
+    legacy_rows = cursor.fetchone()[0]
+    # the new table also holds what was written since the swap
+    cursor.execute(psycopg2.sql.SQL('SELECT count(*) FROM {} WHERE id IN (SELECT id FROM {});').format(
+        identifier(table), identifier(legacy)))
+    copied_rows = cursor.fetchone()[0]
+    cursor.execute(psycopg2.sql.SQL('ANALYZE {};').format(identifier(table)))
+    conn.commit()
+    if copied_rows != legacy_rows:
+        raise SystemExit(f'{table}: copied {copied_rows} of {legacy_rows} rows, "{legacy}" kept')
+    if keep_legacy:
+        print(f'{table}: {legacy_rows} rows copied, "{legacy}" kept')
+        return
+    cursor.execute(psycopg2.sql.SQL('DROP TABLE {};').format(identifier(legacy)))
+    conn.commit()
+    print(f'{table}: {legacy_rows} rows copied, "{legacy}" dropped')
+
+def swap(conn, table, legacy):
+    """Puts an empty partitioned `table` in place of the existing one, in one transaction."""
+    cursor = conn.cursor()
+    cursor.execute(psycopg2.sql.SQL('LOCK TABLE {} IN ACCESS EXCLUSIVE MODE;').format(identifier(table)))
+    cursor.execute(psycopg2.sql.SQL('SELECT min(created_at) FROM {};').format(identifier(table)))
+    oldest = cursor.fetchone()[0]
+    cursor.execute(psycopg2.sql.SQL('ALTER TABLE {} RENAME TO {};').format(identifier(table), identifier(legacy)))
+    # index names are unique per schema, the legacy ones make room for the new ones
+    cursor.execute("""
+        SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s;
+    """, (legacy,))
+    for (name,) in cursor.fetchall():
+        cursor.execute(psycopg2.sql.SQL('ALTER INDEX {} RENAME TO {};').format(
+            identifier(name), identifier((name + '_legacy')[-63:])))
+
+    # not INCLUDING ALL: the legacy primary key cannot be a unique index on a partitioned table
+    cursor.execute(psycopg2.sql.SQL(
+        'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS INCLUDING STORAGE '
+        'INCLUDING COMMENTS) PARTITION BY RANGE (created_at);').format(identifier(table), identifier(legacy)))
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id');", (f'"{legacy}"',))
+    sequence = cursor.fetchone()[0]
+    cursor.execute("SELECT attidentity <> '' FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'id';",
+                   (f'"{legacy}"',))
+    row = cursor.fetchone()
+    if sequence is not None and row is not None and row[0]:
+        # an identity column gets a sequence of its own, it carries on from the legacy one
+        cursor.execute(psycopg2.sql.SQL(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), last_value, is_called) FROM {};").format(
+                psycopg2.sql.SQL(sequence)), (f'"{table}"',))
+    elif sequence is not None:
+        # the serial id sequence would go with the legacy table otherwise
+        cursor.execute(psycopg2.sql.SQL('ALTER SEQUENCE {} OWNED BY {}.id;').format(
+            psycopg2.sql.SQL(sequence), identifier(table)))
+
+    current = month_start(datetime.date.today())
+    month = month_start(oldest) if oldest is not None else current
+    while month <= add_months(current, SCHEMA_PREMAKE_MONTHS):
+        create_partition(cursor, table, month)
+        month = add_months(month, 1)
+    cursor.execute(psycopg2.sql.SQL('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;').format(
+        identifier(f'{table}_default'), identifier(table)))
+    for columns in PARTITIONED_TABLES[table]['indexes']:
+        cursor.execute(psycopg2.sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} ({});').format(
+            identifier(index_name(table, columns)), identifier(table),
+            psycopg2.sql.SQL(', ').join(identifier(column) for column in columns)))
+    conn.commit()
+    print(f'{table}: partitioned, history in "{legacy}"')
+
+def copy_history(conn, table, legacy):
+    """Copies the legacy rows month by month, skipping months copied by an earlier run."""
+    cursor = conn.cursor()
+    existing = partitions(cursor, table)
+    ranged = [partition for partition in existing if partition[1] is not None]
+    for name, lower, upper in existing:
+        if lower is None:
+            condition = psycopg2.sql.SQL('created_at IS NULL OR created_at < %s OR created_at >= %s')
+            params = (ranged[0][1], ranged[-1][2])
+        else:
+            condition = psycopg2.sql.SQL('created_at >= %s AND created_at < %s')
+            params = (lower, upper)
+        cursor.execute(psycopg2.sql.SQL(
+            'INSERT INTO {table} OVERRIDING SYSTEM VALUE SELECT * FROM {legacy} WHERE ({condition}) '
+            'AND NOT EXISTS (SELECT 1 FROM {partition} WHERE {partition}.id = {legacy}.id);').format(
+                table=identifier(table), legacy=identifier(legacy), partition=identifier(name), condition=condition),
+            params)
+        conn.commit()
+        if cursor.rowcount:
+            print(f'{table}: {cursor.rowcount} rows copied into "{name}"')
+
+
+# ---- maintain -----
+
+def maintain(conn, tables, dry_run=False):
+    """Creates the coming partitions and archives the expired ones."""
+    cursor = conn.cursor()
+    current = month_start(datetime.date.today())
+    for table in tables:
+        if not is_partitioned(cursor, table):
+            print(f'{table}: not partitioned, run "python schema.py partition" first')
+            continue
+        existing = partitions(cursor, table)
+        months = {lower for _, lower, _ in existing if lower is not None}
+        for offset in range(SCHEMA_PREMAKE_MONTHS + 1):
+            month = add_months(current, offset)
+            if month not in months:
+                print(f'{table}: creating "{partition_name(table, month)}"')
+                if not dry_run:
+                    create_partition(cursor, table, month)
+                    conn.commit()
+
+        retention = PARTITIONED_TABLES[table]['retention']
+        if retention:
+            cutoff = add_months(current, -retention)
+            for name, lower, upper in existing:
+                if upper is not None and upper <= cutoff:
+                    print(f'{table}: archiving "{name}" ({lower} to {upper})')
+                    if not dry_run:
+                        cursor.execute(psycopg2.sql.SQL('ALTER TABLE {} DETACH PARTITION {};').format(
+                            identifier(table), identifier(name)))
+                        conn.commit()
+                        archive(conn, table, name)
+        # partitions detached by a run that stopped before archiving them
+        for name in detached_partitions(cursor, table):
+            print(f'{table}: archiving detached "{name}"')
+            if not dry_run:
+                archive(conn, table, name)
+
+        default = f'{table}_default'
+        cursor.execute(psycopg2.sql.SQL('SELECT count(*) FROM {};').format(identifier(default)))
+        stray = cursor.fetchone()[0]
+        conn.commit()
+        if stray:
+            print(f'{table}: {stray} rows in "{default}" (no created_at, or outside the monthly partitions)')
+
+def detached_partitions(cursor, table):
+    cursor.execute("""
+        SELECT relname FROM pg_class
+        WHERE relkind = 'r' AND NOT relispartition AND relnamespace = current_schema()::regnamespace
+          AND relname ~ %s;
+    """, ('^' + re.escape(table) + r'_\d{4}_\d{2}$',))
+    return sorted(row[0] for row in cursor.fetchall())
+
+def archive(conn, table, name):
+    """Writes a detached partition to SCHEMA_ARCHIVE_DIR as gzipped CSV, then drops it."""
+    folder = os.path.join(SCHEMA_ARCHIVE_DIR, table)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'{name}.csv.gz')
+    temporary = path + '.tmp'
+    cursor = conn.cursor()
+    with gzip.open(temporary, 'wb') as f:
+        cursor.copy_expert(psycopg2.sql.SQL('COPY {} TO STDOUT WITH (FORMAT csv, HEADER);').format(
+            identifier(name)).as_string(conn), f)
+    with open(temporary, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    cursor.execute(psycopg2.sql.SQL('DROP TABLE {};').format(identifier(name)))
+    conn.commit()
+    print(f'{table}: "{name}" archived to {path}')
+
+
+# ---- status -----
+
+def status(conn, tables):
+    cursor = conn.cursor()
+    for table in tables:
+        partitioned = is_partitioned(cursor, table)
+        if partitioned is None:
+            print(f'{table}: missing')
+            continue
+        if not partitioned:
+            cursor.execute("SELECT pg_total_relation_size(to_regclass(%s));", (f'"{table}"',))
+            print(f'{table}: not partitioned, {cursor.fetchone()[0] // 1024} KiB')
+            continue
+        print(f'{table}: retention {PARTITIONED_TABLES[table]["retention"] or "unlimited"} months')
+        for name, lower, upper in partitions(cursor, table):
+            cursor.execute("""
+                SELECT reltuples::bigint, pg_total_relation_size(oid) FROM pg_class WHERE oid = to_regclass(%s);
+            """, (f'"{name}"',))
+            rows, size = cursor.fetchone()
+            bounds = f'{lower} to {upper}' if lower is not None else 'default'
+            print(f'  {name:<24} {bounds:<26} ~{max(rows, 0):>10} rows {size // 1024:>10} KiB')
+    conn.commit()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', choices=('partition', 'maintain', 'status'))
+    parser.add_argument('--tables', nargs='+', choices=sorted(PARTITIONED_TABLES), default=list(PARTITIONED_TABLES))
+    parser.add_argument('--keep-legacy', action='store_true', help='partition: keep "<table>_legacy" after copying')
+    parser.add_argument('--dry-run', action='store_true', help='maintain: print what would be done')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    conn = connect()
+    try:
+        if options.command == 'partition':
+            for table in options.tables:
+                partition_table(conn, table, options.keep_legacy)
+        elif options.command == 'maintain':
+            maintain(conn, options.tables, options.dry_run)
+        else:
+            status(conn, options.tables)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())